@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Archive
+Moves finished records out of the hot collections into cold, date-partitioned
+segments and reads them back on request
+
+Cold segments are NDJSON files, one per collection per month, next to the
+hot collection:
+  database/archive/appointments/2024-03.ndjson
+A record is filed under the month of its 'date' (or the day of created_at),
+the same day list queries filter on, so a date_from/date_to query only opens
+the months it overlaps. Segments are append-only; records are never changed
+once archived.
+
+Moves happen under the hot collection's write lock: the records are appended
+to their segments (and fsynced), then the hot collection is saved without
+them. A marker file lists the keys being moved until the save is done; if a
+crash leaves one behind, the next move first drops from the hot collection
+whatever already reached the archive.
+
+Report views derived from an archived collection subclass ArchivedView, so
+their totals keep covering records after they move.
+"""
+
+import argparse
+import copy
+import heapq
+import json
+import os
+import threading
+import time
+from datetime import date, timedelta
+from itertools import chain
+from operator import itemgetter
+
+import metrics
+from storage import (MaterializedView, load_db, save_db, query_records, transaction,
+                     collection_name, key_field, sort_key)
+
+# Archive configuration
+# Records whose day is older than this (and whose status is final) are archived
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+# Seconds between archive runs in the server (0 = only `python3 archive.py run`)
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', 24 * 3600))
+
+# Archived collections: file name -> statuses a record must have to be
+# archived (None: any status). Notifications are archived by NotificationQueue.
+ARCHIVE_POLICIES = {
+    'appointments.json': ('completed', 'cancelled'),
+    'billing.json': ('paid', 'cancelled'),
+    'prescriptions.json': None,
+}
+
+# Segment for records without a usable day (only read by unbounded scans)
+UNDATED = 'undated'
+SEGMENT_SUFFIX = '.ndjson'
+MOVING_MARKER = 'moving.json'
+
+ARCHIVED_TOTAL = metrics.counter('hms_archived_records_total',
+                                 'Records moved from hot collections to cold segments',
+                                 ('collection',))
+ARCHIVE_SCAN_SECONDS = metrics.histogram('hms_archive_read_seconds',
+                                         'Reading one cold segment', ('collection',))
+
+
+def record_day(record):
+    """'YYYY-MM-DD' a record is filed and filtered under, or None"""
+    if not isinstance(record, dict):
+        return None
+    day = record.get('date') or str(record.get('created_at') or '')[:10]
+    if not isinstance(day, str):
+        return None
+    try:
+        return date.fromisoformat(day[:10]).isoformat()
+    except ValueError:
+        return None
+
+
+def segment_of(record):
+    """Segment name ('YYYY-MM' or UNDATED) for a record"""
+    day = record_day(record)
+    return day[:7] if day else UNDATED
+
+
+def _fsync_append(path, lines):
+    """Append lines to path and fsync, starting on a fresh line if a crash cut one short"""
+    with open(path, 'ab+') as f:
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        f.write(b''.join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class ColdStore:
+    """Month-partitioned archive segments of the hot collections"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.runs = 0
+        self.moved = {}
+        self.segments_read = 0
+
+    def directory(self, db_path):
+        """Segment directory for a collection (database/archive/<collection>)"""
+        return os.path.join(os.path.dirname(db_path), 'archive', collection_name(db_path))
+
+    def segments(self, db_path, date_from=None, date_to=None):
+        """Segment names overlapping date_from..date_to (inclusive), oldest first"""
+        try:
+            names = os.listdir(self.directory(db_path))
+        except FileNotFoundError:
+            return []
+        found = []
+        for name in names:
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            segment = name[:-len(SEGMENT_SUFFIX)]
+            if segment == UNDATED:
+                # Records without a day never match a date filter
+                if date_from or date_to:
+                    continue
+            elif (date_from and segment < date_from[:7]) or (date_to and segment > date_to[:7]):
+                continue
+            found.append(segment)
+        return sorted(found)
+
+    def version(self, db_path):
+        """Identity of the collection's archived contents, for caches and ETags"""
+        directory = self.directory(db_path)
+        version = []
+        for segment in self.segments(db_path):
+            try:
+                st = os.stat(os.path.join(directory, segment + SEGMENT_SUFFIX))
+            except FileNotFoundError:
+                continue
+            version.append((segment, st.st_size, st.st_mtime_ns))
+        return tuple(version)
+
+    def read_segment(self, db_path, segment):
+        """Records of one segment, in the order they were archived"""
+        path = os.path.join(self.directory(db_path), segment + SEGMENT_SUFFIX)
+        start = time.perf_counter()
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash mid-append
+                    continue
+                yield record
+        ARCHIVE_SCAN_SECONDS.observe(time.perf_counter() - start, collection_name(db_path))
+        with self._lock:
+            self.segments_read += 1
+
+    def scan(self, db_path, date_from=None, date_to=None):
+        """Archived records from the segments overlapping the date range"""
+        for segment in self.segments(db_path, date_from, date_to):
+            yield from self.read_segment(db_path, segment)
+
+    def query(self, db_path, q):
+        """(hot and archived records matching q, next cursor), like query_records"""
+        hot, hot_next = query_records(db_path, q)
+        cold = (r for r in self.scan(db_path, q.date_from, q.date_to) if q.matches(r))
+        if not q.paged:
+            return chain(hot, cold), None
+
+        key = key_field(db_path)
+        positioned = ((sort_key(r, r.get(key)), r) for r in cold)
+        if q.after is not None:
+            positioned = ((p, r) for p, r in positioned if p > q.after)
+        # Any record of the merged page is among the first limit + 1 of its tier
+        if q.limit is None:
+            page = list(positioned)
+        else:
+            page = heapq.nsmallest(q.limit + 1, positioned, key=itemgetter(0))
+        page += [(sort_key(r, r.get(key)), r) for r in hot]
+        page.sort(key=itemgetter(0))
+        if q.limit is None:
+            return [r for _, r in page], None
+        more = len(page) > q.limit or hot_next is not None
+        page = page[:q.limit]
+        return [r for _, r in page], (page[-1][0] if more and page else None)
+
+    # Moving records
+
+    def _marker(self, db_path):
+        return os.path.join(self.directory(db_path), MOVING_MARKER)
+
+    def _recover(self, db_path):
+        """Finish a move interrupted between the archive append and the hot save.
+
+        Returns the keys it dropped from the hot collection.
+        """
+        marker = self._marker(db_path)
+        try:
+            with open(marker) as f:
+                pending = json.load(f)
+        except FileNotFoundError:
+            return set()
+        except ValueError:
+            # The crash hit while the marker itself was written: nothing was appended
+            os.remove(marker)
+            return set()
+        key = key_field(db_path)
+        wanted = set(pending['keys'])
+        archived = set()
+        for segment in pending['segments']:
+            archived.update(r.get(key) for r in self.read_segment(db_path, segment)
+                            if isinstance(r, dict) and r.get(key) in wanted)
+        if archived:
+            save_db(db_path, [r for r in load_db(db_path, []) if r.get(key) not in archived])
+        os.remove(marker)
+        return archived
+
+    def move(self, db_path, records):
+        """Move records out of db_path into their segments; the caller holds transaction(db_path)"""
+        key = key_field(db_path)
+        recovered = self._recover(db_path)
+        records = [r for r in records if r.get(key) not in recovered]
+        if not records:
+            return 0
+        by_segment = {}
+        for record in records:
+            by_segment.setdefault(segment_of(record), []).append(
+                (json.dumps(record) + '\n').encode())
+        keys = {record.get(key) for record in records}
+
+        directory = self.directory(db_path)
+        os.makedirs(directory, exist_ok=True)
+        marker = self._marker(db_path)
+        with open(marker, 'w') as f:
+            json.dump({"segments": sorted(by_segment), "keys": sorted(keys)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        for segment, lines in by_segment.items():
+            _fsync_append(os.path.join(directory, segment + SEGMENT_SUFFIX), lines)
+        save_db(db_path, [r for r in load_db(db_path, []) if r.get(key) not in keys])
+        os.remove(marker)
+
+        name = collection_name(db_path)
+        ARCHIVED_TOTAL.inc(name, amount=len(records))
+        with self._lock:
+            self.moved[name] = self.moved.get(name, 0) + len(records)
+        return len(records)
+
+    def archive(self, db_path, statuses=None, before=None):
+        """Move records dated before `before` (a date) whose status is in statuses"""
+        cutoff = before.isoformat()
+        with transaction(db_path):
+            records = [r for r in load_db(db_path, [])
+                       if (record_day(r) or cutoff) < cutoff
+                       and (statuses is None or r.get('status') in statuses)]
+            return self.move(db_path, records)
+
+    def run(self, db_paths, today=None, after_days=ARCHIVE_AFTER_DAYS):
+        """Apply ARCHIVE_POLICIES to each collection; returns {collection: records moved}"""
+        before = (today or date.today()) - timedelta(days=after_days)
+        moved = {}
+        for db_path in db_paths:
+            statuses = ARCHIVE_POLICIES.get(os.path.basename(db_path))
+            moved[collection_name(db_path)] = self.archive(db_path, statuses, before)
+        with self._lock:
+            self.runs += 1
+        return moved
+
+    def start(self, db_paths, interval=ARCHIVE_INTERVAL):
+        """Run run(db_paths) now and then every interval seconds in a daemon thread"""
+        if self._thread is not None or interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run_loop, args=(db_paths, interval),
+                                        daemon=True, name='archiver')
+        self._thread.start()
+
+    def _run_loop(self, db_paths, interval):
+        while True:
+            try:
+                moved = {name: n for name, n in self.run(db_paths).items() if n}
+                if moved:
+                    print(f"Archived {moved}")
+            except Exception as e:
+                print(f"Archive run failed: {e}")
+            time.sleep(interval)
+
+    def stats(self):
+        """Archive counters"""
+        with self._lock:
+            return {"runs": self.runs, "moved": dict(self.moved),
+                    "segments_read": self.segments_read}
+
+
+ARCHIVE = ColdStore()
+
+
+class ArchivedView(MaterializedView):
+    """MaterializedView that also covers the collection's archived records.
+
+    The archived records' contribution is computed once per archive version
+    and kept as a copy of the view's state; a rebuild starts from that copy
+    and applies only the hot collection.
+    """
+
+    def __init__(self, db_path, cold=ARCHIVE):
+        self.cold = cold
+        self.cold_loads = 0
+        self._cold_version = None
+        self._cold_state = None
+        super().__init__(db_path)
+        # Everything set after this belongs to the derived state (see reset())
+        self._fixed = set(vars(self)) | {'_fixed'}
+
+    def _seed(self):
+        version = self.cold.version(self.db_path)
+        if version != self._cold_version:
+            self.reset()
+            for record in self.cold.scan(self.db_path):
+                if isinstance(record, dict):
+                    self.apply(record, 1)
+            self._cold_state = copy.deepcopy(
+                {k: v for k, v in vars(self).items() if k not in self._fixed})
+            self._cold_version = version
+            self.cold_loads += 1
+        vars(self).update(copy.deepcopy(self._cold_state))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move old, finished records to the archive')
+    parser.add_argument('command', choices=['run', 'stats'])
+    parser.add_argument('--db-dir', default='database')
+    parser.add_argument('--after-days', type=int, default=ARCHIVE_AFTER_DAYS,
+                        help=f'archive records older than this (default {ARCHIVE_AFTER_DAYS})')
+    args = parser.parse_args()
+    db_paths = [os.path.join(args.db_dir, name) for name in ARCHIVE_POLICIES]
+    if args.command == 'run':
+        for name, count in ARCHIVE.run(db_paths, after_days=args.after_days).items():
+            print(f'{name}: {count} records archived')
+    else:
+        for db_path in db_paths + [os.path.join(args.db_dir, 'notifications.json')]:
+            segments = ARCHIVE.segments(db_path)
+            span = f' ({segments[0]} .. {segments[-1]})' if segments else ''
+            print(f'{collection_name(db_path)}: {len(segments)} segments{span}')
+
+
+if __name__ == '__main__':
+    main()
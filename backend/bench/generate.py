@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Benchmark Data Generator
+Writes a synthetic hospital into <root>/database for benchmarking
+
+Sizes scale from the patient count: 3 appointments, 2 bills and half a
+prescription per patient, one doctor per 1000 patients, one live session per
+100 patients and a fixed pharmacy. The same seed always produces the same
+data (dates relative to today). Collections are streamed to disk, so
+generating a million patients does not need them all in memory at once.
+
+Usage:
+    python3 bench/generate.py DIR [--patients 100k] [--seed 42] [--backend json]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Per-patient proportions
+APPOINTMENTS_PER_PATIENT = 3
+BILLS_PER_PATIENT = 2
+PRESCRIPTIONS_PER_PATIENT = 0.5
+PATIENTS_PER_DOCTOR = 1000
+PATIENTS_PER_SESSION = 100
+PHARMACY_ITEMS = 500
+
+# Password of every generated user (admin keeps admin123)
+BENCH_PASSWORD = 'bench123'
+
+FIRST_NAMES = ['James', 'Mary', 'Ahmed', 'Fatima', 'Li', 'Wei', 'Maria', 'Jose', 'David', 'Sarah',
+               'Olga', 'Kenji', 'Amara', 'Noah', 'Priya', 'Lucas', 'Emma', 'Omar', 'Ines', 'Yuki']
+LAST_NAMES = ['Smith', 'Khan', 'Garcia', 'Wang', 'Muller', 'Rossi', 'Ivanov', 'Kumar', 'Sato',
+              'Brown', 'Silva', 'Okafor', 'Nguyen', 'Cohen', 'Haddad', 'Larsen', 'Novak', 'Diaz']
+DEPARTMENTS = ['General', 'Cardiology', 'Pediatrics', 'Orthopedics', 'Dermatology', 'Neurology']
+MEDICINES = ['Amoxicillin', 'Ibuprofen', 'Metformin', 'Atorvastatin', 'Omeprazole', 'Lisinopril',
+             'Salbutamol', 'Paracetamol', 'Cetirizine', 'Azithromycin']
+SLOTS = [f'{h:02d}:{m:02d}' for h in range(9, 17) for m in (0, 30)]
+
+
+def parse_size(value):
+    """Patient count from '10000', '10k', '100k' or '1m'"""
+    value = str(value).strip().lower()
+    scale = {'k': 1000, 'm': 1000000}.get(value[-1:], 1)
+    number = value[:-1] if scale > 1 else value
+    try:
+        count = int(float(number) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value}")
+    if count < 1:
+        raise argparse.ArgumentTypeError("size must be at least 1")
+    return count
+
+
+def _uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def _write_collection(path, records):
+    """Stream records to a JSON array file; returns how many were written"""
+    count = 0
+    with open(path, 'w') as f:
+        f.write('[')
+        for record in records:
+            f.write(',\n' if count else '\n')
+            f.write(json.dumps(record))
+            count += 1
+        f.write('\n]\n')
+    return count
+
+
+def generate(root, patients, seed=42, backend='json'):
+    """Create root/database with a synthetic hospital; returns a summary dict.
+
+    The summary holds record counts, generation time and samples of ids
+    (patients, doctors) for load generators to pick from.
+    """
+    started = time.time()
+    db_dir = os.path.join(root, 'database')
+    os.makedirs(db_dir, exist_ok=True)
+    rng = random.Random(seed)
+    now = datetime.now().replace(microsecond=0)
+    today = now.date()
+
+    def stamp(days_ago):
+        return (now - timedelta(days=days_ago, seconds=rng.randrange(86400))).isoformat()
+
+    def password(value):
+        # Same scheme as server.hash_password
+        return hashlib.sha256(value.encode()).hexdigest()
+
+    admin_id = _uuid(rng)
+    doctors = [{
+        "id": _uuid(rng),
+        "username": f"doctor{i + 1}",
+        "password": password(BENCH_PASSWORD),
+        "email": f"doctor{i + 1}@hospital.example",
+        "role": "doctor",
+        "full_name": f"Dr. {rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+        "phone": "",
+        "department": rng.choice(DEPARTMENTS),
+        "created_at": stamp(400),
+        "active": True
+    } for i in range(max(1, patients // PATIENTS_PER_DOCTOR))]
+    staff = [{
+        "id": _uuid(rng),
+        "username": f"{role}{i + 1}",
+        "password": password(BENCH_PASSWORD),
+        "email": f"{role}{i + 1}@hospital.example",
+        "role": role,
+        "full_name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+        "phone": "",
+        "created_at": stamp(400),
+        "active": True
+    } for role in ('nurse', 'receptionist') for i in range(max(1, len(doctors) // 2))]
+    admin = {
+        "id": admin_id,
+        "username": "admin",
+        "password": password("admin123"),
+        "email": "admin@hospital.com",
+        "role": "admin",
+        "full_name": "System Administrator",
+        "phone": "",
+        "created_at": stamp(400),
+        "active": True
+    }
+    counts = {'users': _write_collection(os.path.join(db_dir, 'users.json'),
+                                         [admin] + doctors + staff)}
+
+    # Patient ids are drawn from their own generator so other collections can
+    # regenerate them without keeping a million ids in memory
+    def patient_ids():
+        id_rng = random.Random(f'{seed}:patients')
+        for _ in range(patients):
+            yield _uuid(id_rng)
+
+    def patient_records():
+        for patient_id in patient_ids():
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            yield {
+                "id": patient_id,
+                "full_name": f"{first} {last}",
+                "date_of_birth": (today - timedelta(days=rng.randrange(365, 90 * 365))).isoformat(),
+                "gender": rng.choice(['male', 'female']),
+                "phone": '+1%010d' % rng.randrange(10 ** 10),
+                "email": f"{first}.{last}{rng.randrange(10000)}@mail.example".lower(),
+                "address": f"{rng.randrange(1, 999)} Main Street",
+                "blood_type": rng.choice(['A+', 'A-', 'B+', 'B-', 'O+', 'O-', 'AB+', 'AB-']),
+                "created_at": stamp(rng.randrange(400)),
+                "created_by": admin_id
+            }
+
+    def appointment_records():
+        for patient_id in patient_ids():
+            for _ in range(APPOINTMENTS_PER_PATIENT):
+                doctor = rng.choice(doctors)
+                offset = rng.randrange(-365, 31)
+                if offset >= 0:
+                    status = 'scheduled'
+                else:
+                    status = rng.choices(['completed', 'cancelled', 'scheduled'], [8, 1, 1])[0]
+                yield {
+                    "id": _uuid(rng),
+                    "patient_id": patient_id,
+                    "doctor_id": doctor['id'],
+                    "doctor_name": doctor['full_name'],
+                    "department": doctor['department'],
+                    "date": (today + timedelta(days=offset)).isoformat(),
+                    "time": rng.choice(SLOTS),
+                    "status": status,
+                    "reason": "Consultation",
+                    "created_at": stamp(max(-offset, 0) + 7),
+                    "created_by": admin_id
+                }
+
+    def bill_records():
+        for patient_id in patient_ids():
+            for _ in range(BILLS_PER_PATIENT):
+                days_ago = rng.randrange(365)
+                yield {
+                    "id": _uuid(rng),
+                    "patient_id": patient_id,
+                    "amount": round(rng.uniform(20, 2000), 2),
+                    "description": rng.choice(['Consultation', 'Lab tests', 'X-ray', 'Surgery']),
+                    "status": rng.choices(['paid', 'pending', 'overdue'], [6, 3, 1])[0],
+                    "date": (today - timedelta(days=days_ago)).isoformat(),
+                    "created_at": stamp(days_ago),
+                    "created_by": admin_id
+                }
+
+    pharmacy = [{
+        "id": _uuid(rng),
+        "name": f"{MEDICINES[i % len(MEDICINES)]} {(i // len(MEDICINES) + 1) * 50}mg",
+        "stock_quantity": rng.randrange(0, 500),
+        "reorder_level": 20,
+        "unit_price": round(rng.uniform(1, 80), 2),
+        "expiry_date": (today + timedelta(days=rng.randrange(-30, 720))).isoformat(),
+        "created_at": stamp(300)
+    } for i in range(PHARMACY_ITEMS)]
+
+    def prescription_records():
+        for patient_id in patient_ids():
+            if rng.random() >= PRESCRIPTIONS_PER_PATIENT:
+                continue
+            medicine = rng.choice(pharmacy)
+            yield {
+                "id": _uuid(rng),
+                "patient_id": patient_id,
+                "doctor_id": rng.choice(doctors)['id'],
+                "medicines": [{"medicine_id": medicine['id'], "name": medicine['name'],
+                               "quantity": rng.randrange(1, 4)}],
+                "notes": "Take after meals",
+                "created_at": stamp(rng.randrange(365))
+            }
+
+    def session_records():
+        users = [admin] + doctors + staff
+        for _ in range(max(1, patients // PATIENTS_PER_SESSION)):
+            yield {
+                "token": '%064x' % rng.getrandbits(256),
+                "user_id": rng.choice(users)['id'],
+                "created_at": (now - timedelta(seconds=rng.randrange(12 * 3600))).isoformat()
+            }
+
+    for name, records in [('patients', patient_records()),
+                          ('appointments', appointment_records()),
+                          ('billing', bill_records()),
+                          ('pharmacy', pharmacy),
+                          ('prescriptions', prescription_records()),
+                          ('sessions', session_records()),
+                          ('notifications', [])]:
+        counts[name] = _write_collection(os.path.join(db_dir, f'{name}.json'), records)
+
+    if backend == 'sqlite':
+        sys.path.insert(0, BACKEND_DIR)
+        from storage import migrate_json_to_sqlite
+        migrate_json_to_sqlite(db_dir, os.path.join(db_dir, 'hospital.db'))
+    elif backend == 'snapshot':
+        sys.path.insert(0, BACKEND_DIR)
+        from storage import convert_json_to_snapshot
+        convert_json_to_snapshot(db_dir)
+
+    sample = random.Random(seed + 1)
+    ids = patient_ids()
+    patient_sample = [next(ids) for _ in range(min(patients, 1000))]
+    return {
+        "patients": patients,
+        "seed": seed,
+        "backend": backend,
+        "counts": counts,
+        "seconds": round(time.time() - started, 2),
+        "patient_ids": sample.sample(patient_sample, len(patient_sample)),
+        "doctor_ids": [d['id'] for d in doctors]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic hospital database')
+    parser.add_argument('root', help='directory to create database/ in')
+    parser.add_argument('--patients', type=parse_size, default=10000,
+                        help='patient count, e.g. 10k, 100k, 1m (default 10k)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--backend', choices=['json', 'journal', 'sqlite', 'snapshot'],
+                        default='json', help='sqlite also migrates the data into '
+                        'database/hospital.db, snapshot writes .snap files next to the JSON')
+    args = parser.parse_args()
+    summary = generate(args.root, args.patients, args.seed, args.backend)
+    print(json.dumps({k: v for k, v in summary.items() if not k.endswith('_ids')}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Load Test
+Generates a synthetic hospital, serves it with run_server in this process
+and drives it with concurrent keep-alive clients
+
+Clients run in separate processes (so they do not compete with the server
+for the GIL), each with several threads. Every client logs in, then picks
+operations from the mix by weight until the duration is over. The report is
+JSON: per-operation and overall request counts, errors, req/s and p50/p95/p99
+latency, plus the server process's peak RSS.
+
+Usage (the server's request log goes to stderr):
+    python3 bench/loadtest.py --patients 10k --clients 32 --duration 30 2>/dev/null
+    python3 bench/loadtest.py --patients 100k --backend sqlite --output result.json
+"""
+
+import argparse
+import contextlib
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+from generate import generate, parse_size, BACKEND_DIR
+
+# Operation -> weight
+DEFAULT_MIX = {
+    'get_patient': 35,
+    'list_patients': 15,
+    'list_appointments': 10,
+    'search_patients': 10,
+    'create_appointment': 10,
+    'dashboard': 10,
+    'login': 5,
+    'availability': 5
+}
+
+
+def parse_mix(value):
+    """{'op': weight} from 'get_patient=40,login=5'"""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in DEFAULT_MIX or not weight.strip().isdigit():
+            raise argparse.ArgumentTypeError(
+                f"invalid mix entry {part!r}; operations: {', '.join(DEFAULT_MIX)}")
+        mix[name.strip()] = int(weight)
+    return mix
+
+
+def percentile(ordered, q):
+    """q-th percentile (0-100) of an already sorted list"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+def summarize(latencies, statuses, errors, seconds):
+    ordered = sorted(latencies)
+    ms = lambda v: None if v is None else round(v * 1000, 2)
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "statuses": dict(sorted(statuses.items())),
+        "rps": round(len(ordered) / seconds, 1) if seconds else None,
+        "p50_ms": ms(percentile(ordered, 50)),
+        "p95_ms": ms(percentile(ordered, 95)),
+        "p99_ms": ms(percentile(ordered, 99)),
+        "max_ms": ms(ordered[-1] if ordered else None)
+    }
+
+
+# Client side (runs in worker processes)
+
+class Client:
+    """One simulated user on one keep-alive connection"""
+
+    def __init__(self, port, rng, patient_ids, doctor_ids):
+        self.port = port
+        self.rng = rng
+        self.patient_ids = patient_ids
+        self.doctor_ids = doctor_ids
+        self.conn = None
+        self.token = None
+
+    def request(self, method, path, body=None):
+        """(status, parsed JSON or None); reconnects once if the server closed the connection"""
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        data = json.dumps(body).encode() if body is not None else None
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            try:
+                self.conn.request(method, path, body=data, headers=headers)
+                response = self.conn.getresponse()
+                raw = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.conn.close()
+                self.conn = None
+                if attempt == 2:
+                    raise
+                continue
+            if response.will_close:
+                self.conn.close()
+                self.conn = None
+            is_json = response.headers.get('Content-Type', '').startswith('application/json')
+            return response.status, (json.loads(raw) if raw and is_json else None)
+
+    def login(self):
+        self.token = None
+        status, body = self.request('POST', '/api/auth/login',
+                                    {'username': 'admin', 'password': 'admin123'})
+        if status == 200:
+            self.token = body['token']
+        return status
+
+    def run(self, op):
+        """Perform one operation; returns the HTTP status"""
+        rng = self.rng
+        if op == 'login':
+            return self.login()
+        if op == 'get_patient':
+            return self.request('GET', f'/api/patients/{rng.choice(self.patient_ids)}')[0]
+        if op == 'list_patients':
+            return self.request('GET', '/api/patients?limit=50')[0]
+        if op == 'list_appointments':
+            return self.request('GET', '/api/appointments?status=scheduled&limit=50')[0]
+        if op == 'search_patients':
+            prefix = rng.choice(['ja', 'mar', 'smi', 'kha', 'wang', 'li', 'sar', 'noa'])
+            return self.request('GET', f'/api/patients/search?q={prefix}&limit=20')[0]
+        if op == 'dashboard':
+            return self.request('GET', '/api/reports/dashboard')[0]
+        day = (date.today() + timedelta(days=rng.randrange(1, 60))).isoformat()
+        doctor = rng.choice(self.doctor_ids)
+        if op == 'availability':
+            return self.request('GET', f'/api/appointments/availability?doctor_id={doctor}&date={day}')[0]
+        if op == 'create_appointment':
+            return self.request('POST', '/api/appointments', {
+                'patient_id': rng.choice(self.patient_ids),
+                'doctor_id': doctor,
+                'date': day,
+                'time': f'{rng.randrange(9, 17):02d}:{rng.choice((0, 30)):02d}',
+                'reason': 'Load test'
+            })[0]
+        raise ValueError(f"unknown operation: {op}")
+
+
+def _client_loop(port, seed, deadline, mix, patient_ids, doctor_ids, results):
+    rng = random.Random(seed)
+    client = Client(port, rng, patient_ids, doctor_ids)
+    ops, weights = list(mix), list(mix.values())
+    local = {}
+    try:
+        client.login()
+    except OSError:
+        pass
+    while time.time() < deadline:
+        op = rng.choices(ops, weights)[0]
+        entry = local.setdefault(op, {'latencies': [], 'statuses': {}, 'errors': 0})
+        start = time.perf_counter()
+        try:
+            status = client.run(op)
+        except (OSError, http.client.HTTPException, ValueError):
+            entry['errors'] += 1
+            client.conn = None
+            continue
+        entry['latencies'].append(time.perf_counter() - start)
+        entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+        # 409 (slot already booked) is an expected answer for create_appointment
+        if status >= 500 or (status >= 400 and status != 409):
+            entry['errors'] += 1
+    results.append(local)
+
+
+def client_process(port, seed, threads, deadline, mix, patient_ids, doctor_ids):
+    """Run `threads` clients until deadline; returns their merged per-operation results"""
+    results = []
+    workers = [threading.Thread(target=_client_loop,
+                                args=(port, seed * 1000 + i, deadline, mix, patient_ids,
+                                      doctor_ids, results))
+               for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return _merge(results)
+
+
+def _merge(results):
+    merged = {}
+    for result in results:
+        for op, entry in result.items():
+            target = merged.setdefault(op, {'latencies': [], 'statuses': {}, 'errors': 0})
+            target['latencies'] += entry['latencies']
+            target['errors'] += entry['errors']
+            for status, n in entry['statuses'].items():
+                target['statuses'][status] = target['statuses'].get(status, 0) + n
+    return merged
+
+
+# Server side
+
+def _wait_ready(port, timeout=600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/api/health')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the API server')
+    parser.add_argument('--patients', type=parse_size, default=10000,
+                        help='dataset size, e.g. 10k, 100k, 1m (default 10k)')
+    parser.add_argument('--backend', choices=['json', 'journal', 'sqlite', 'snapshot'],
+                        default='json')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients (default 16)')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='client processes (default: up to the CPU count)')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load (default 20)')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='operation weights, e.g. get_patient=50,login=5')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--threads', type=int, default=None, help='server worker threads')
+    parser.add_argument('--dir', help='use (or create) the dataset in this directory')
+    parser.add_argument('--output', help='write the JSON report here as well as to stdout')
+    args = parser.parse_args()
+
+    root = args.dir or tempfile.mkdtemp(prefix='hms-bench-')
+    generated = not os.path.exists(os.path.join(root, 'database', 'patients.json'))
+    if generated:
+        print(f'Generating {args.patients} patients in {root}...', file=sys.stderr)
+        dataset = generate(root, args.patients, args.seed, args.backend)
+    else:
+        dataset = None
+
+    # The server reads its configuration and paths at import time
+    os.environ['STORAGE_BACKEND'] = args.backend
+    os.chdir(root)
+    sys.path.insert(0, BACKEND_DIR)
+    import server
+
+    if dataset is None:
+        patient_ids = [p['id'] for p in server.load_db(server.PATIENTS_DB, [])[:1000]]
+        doctor_ids = [u['id'] for u in server.load_db(server.USERS_DB, []) if u.get('role') == 'doctor']
+    else:
+        patient_ids, doctor_ids = dataset['patient_ids'], dataset['doctor_ids']
+
+    # Server banners go to stderr with its request log; stdout is the report
+    with contextlib.redirect_stdout(sys.stderr):
+        kwargs = {'port': args.port}
+        if args.threads is not None:
+            kwargs['threads'] = args.threads
+        started = time.time()
+        threading.Thread(target=server.run_server, kwargs=kwargs, daemon=True).start()
+        _wait_ready(args.port)
+        startup = time.time() - started
+
+        processes = args.processes or min(args.clients, os.cpu_count() or 1)
+        per_process = [args.clients // processes + (i < args.clients % processes)
+                       for i in range(processes)]
+        # Start every client at once, after the worker processes have spawned
+        deadline = time.time() + 2 + args.duration
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes) as pool:
+            pending = [pool.apply_async(client_process, (args.port, args.seed + i, n, deadline,
+                                                         args.mix, patient_ids, doctor_ids))
+                       for i, n in enumerate(per_process) if n]
+            results = _merge([p.get() for p in pending])
+
+    ops = {op: summarize(r['latencies'], r['statuses'], r['errors'], args.duration)
+           for op, r in sorted(results.items())}
+    total = _merge([{'all': r} for r in results.values()]).get('all')
+    report = {
+        "config": {
+            "patients": args.patients, "backend": args.backend, "clients": args.clients,
+            "processes": processes, "duration": args.duration, "mix": args.mix,
+            "seed": args.seed, "server_threads": kwargs.get('threads', server.SERVER_THREADS)
+        },
+        "dataset": ({k: v for k, v in dataset.items() if not k.endswith('_ids')}
+                    if dataset else {"reused": root}),
+        "startup_seconds": round(startup, 2),
+        "overall": summarize(total['latencies'], total['statuses'], total['errors'],
+                             args.duration) if total else None,
+        "operations": ops,
+        # Linux reports ru_maxrss in KiB
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    if not args.dir:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
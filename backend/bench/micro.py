@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Microbenchmarks
+Times hot functions against a generated dataset
+
+  load_db          - whole patients collection, served from the cache
+  load_db_cold     - the same after dropping the cache (read + parse)
+  save_db          - rewriting the whole patients collection
+  verify_token     - HospitalAPIHandler._verify_token for a live session
+  verify_token_bad - the same for an unknown token
+  process_notifications - draining a batch of queued notifications through a
+                   local stub provider (reported per notification)
+
+Results are JSON with the mean, p50 and p95 time per call and calls/s.
+
+Usage:
+    python3 bench/micro.py [--patients 10k] [--backend json] [--only load_db,save_db]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from generate import generate, parse_size, BACKEND_DIR
+from loadtest import percentile
+
+BENCHMARKS = ('load_db', 'load_db_cold', 'save_db', 'verify_token', 'verify_token_bad',
+              'process_notifications')
+
+
+def measure(fn, min_seconds, min_runs=5, per_call=1):
+    """Call fn repeatedly for at least min_seconds; per_call divides each timing"""
+    timings = []
+    deadline = time.perf_counter() + min_seconds
+    while len(timings) < min_runs or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) / per_call)
+    timings.sort()
+    mean = sum(timings) / len(timings)
+    return {
+        "runs": len(timings),
+        "mean_us": round(mean * 1e6, 2),
+        "p50_us": round(percentile(timings, 50) * 1e6, 2),
+        "p95_us": round(percentile(timings, 95) * 1e6, 2),
+        "per_second": round(1 / mean, 1) if mean else None
+    }
+
+
+class _StubProvider(BaseHTTPRequestHandler):
+    """Accepts every message, like a healthy WhatsApp API"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{"status": "queued"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks for storage, auth and notifications')
+    parser.add_argument('--patients', type=parse_size, default=10000,
+                        help='dataset size, e.g. 10k, 100k (default 10k)')
+    parser.add_argument('--backend', choices=['json', 'journal', 'sqlite', 'snapshot'],
+                        default='json')
+    parser.add_argument('--seconds', type=float, default=2, help='minimum time per benchmark')
+    parser.add_argument('--batch', type=int, default=200,
+                        help='notifications per process_notifications run (default 200)')
+    parser.add_argument('--only', help='comma-separated subset of: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON report here as well as to stdout')
+    args = parser.parse_args()
+    selected = args.only.split(',') if args.only else BENCHMARKS
+    unknown = set(selected) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    root = tempfile.mkdtemp(prefix='hms-micro-')
+    dataset = generate(root, args.patients, args.seed, args.backend)
+
+    # Storage configuration and paths are read at import time
+    os.environ['STORAGE_BACKEND'] = args.backend
+    os.chdir(root)
+    sys.path.insert(0, BACKEND_DIR)
+    import server
+    import storage
+    import whatsapp_service
+    from dispatcher import TokenBucket
+
+    server.initialize_database()
+    admin = server.find_record(server.USERS_DB, 'username', 'admin')
+    token = server.SESSIONS.create(admin)['token']
+    patients = server.load_db(server.PATIENTS_DB, [])
+    # _verify_token does not touch the handler's state
+    handler = server.HospitalAPIHandler.__new__(server.HospitalAPIHandler)
+
+    def load_cold():
+        storage._store.invalidate(server.PATIENTS_DB)
+        server.load_db(server.PATIENTS_DB, [])
+
+    results = {}
+    benchmarks = {
+        'load_db': lambda: measure(lambda: server.load_db(server.PATIENTS_DB, []), args.seconds),
+        'load_db_cold': lambda: measure(load_cold, args.seconds),
+        'save_db': lambda: measure(lambda: server.save_db(server.PATIENTS_DB, patients), args.seconds),
+        'verify_token': lambda: measure(lambda: handler._verify_token(token), args.seconds),
+        'verify_token_bad': lambda: measure(lambda: handler._verify_token('no-such-token'),
+                                            args.seconds),
+    }
+
+    def notifications():
+        stub = _StubServer(('127.0.0.1', 0), _StubProvider)
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        settings = server.load_db(server.SETTINGS_DB, {})
+        settings['whatsapp'].update({'enabled': True, 'api_key': 'bench',
+                                     'api_url': f'http://127.0.0.1:{stub.server_port}/send'})
+        server.save_db(server.SETTINGS_DB, settings)
+        # Measure the service itself, not the provider quota
+        whatsapp_service.RATE_LIMIT = TokenBucket(0, 1)
+        sample = dataset['patient_ids']
+
+        def run():
+            for i in range(args.batch):
+                whatsapp_service.QUEUE.enqueue('followup_reminder',
+                                               {'patient_id': sample[i % len(sample)]})
+            start = time.perf_counter()
+            whatsapp_service.process_notifications()
+            whatsapp_service.DISPATCHER.wait_idle()
+            return time.perf_counter() - start
+
+        timings = []
+        deadline = time.perf_counter() + args.seconds
+        while len(timings) < 3 or time.perf_counter() < deadline:
+            timings.append(run() / args.batch)
+            whatsapp_service.QUEUE.archive(older_than=0)
+        stub.shutdown()
+        timings.sort()
+        mean = sum(timings) / len(timings)
+        return {"runs": len(timings), "batch": args.batch,
+                "mean_us": round(mean * 1e6, 2),
+                "p50_us": round(percentile(timings, 50) * 1e6, 2),
+                "p95_us": round(percentile(timings, 95) * 1e6, 2),
+                "per_second": round(1 / mean, 1) if mean else None}
+
+    benchmarks['process_notifications'] = notifications
+
+    # The notification service logs every send; keep stdout for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        for name in BENCHMARKS:
+            if name in selected:
+                print(f'{name}...')
+                results[name] = benchmarks[name]()
+
+    report = {
+        "config": {"patients": args.patients, "backend": args.backend, "seed": args.seed},
+        "dataset": {k: v for k, v in dataset.items() if not k.endswith('_ids')},
+        "benchmarks": results
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Startup Benchmark
+Compares opening collections stored as JSON with the .snap snapshot format
+
+For each collection and format, with a fresh store on every run (nothing
+cached in memory):
+  open_get - open the collection and fetch one record, like a freshly
+             started server answering GET /api/patients/:id
+  load     - decode the whole collection (load_db)
+plus the size on disk. The files stay in the page cache, so this times
+decoding rather than the disk.
+
+It also times a whole server start in a fresh process per format
+(server_start: initialize_database and rebuild_views, without listening).
+The in-memory views decode every collection they cover, so that part
+still grows with the data on either format.
+
+Usage:
+    python3 bench/startup.py [--patients 100k] [--collections patients,appointments]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from generate import generate, parse_size, BACKEND_DIR
+from micro import measure
+
+FORMATS = ('json', 'snapshot')
+
+# Run in a fresh process from the data set directory; prints seconds taken
+SERVER_START = """
+import sys, time
+started = time.perf_counter()
+sys.path.insert(0, {backend_dir!r})
+import server
+server.initialize_database()
+server.rebuild_views()
+print(time.perf_counter() - started)
+"""
+
+
+def server_start(root, fmt):
+    """Seconds for a fresh server process to get ready to serve, imports included"""
+    env = {**os.environ, 'STORAGE_BACKEND': fmt}
+    result = subprocess.run([sys.executable, '-c', SERVER_START.format(backend_dir=BACKEND_DIR)],
+                            cwd=root, env=env, stdout=subprocess.PIPE, check=True)
+    return round(float(result.stdout.decode().split()[-1]), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collection load times: JSON vs snapshot')
+    parser.add_argument('--patients', type=parse_size, default=100000,
+                        help='dataset size, e.g. 10k, 100k (default 100k)')
+    parser.add_argument('--collections', default='patients,appointments,billing',
+                        help='comma-separated collections to time')
+    parser.add_argument('--seconds', type=float, default=2, help='minimum time per measurement')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON report here as well as to stdout')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='hms-startup-')
+    dataset = generate(root, args.patients, args.seed, 'snapshot')
+    sys.path.insert(0, BACKEND_DIR)
+    import storage
+
+    stores = {'json': storage.JsonStore, 'snapshot': storage.SnapshotStore}
+    rng = random.Random(args.seed)
+    results = {}
+    for name in args.collections.split(','):
+        db_path = os.path.join(root, 'database', f'{name}.json')
+        records = storage.JsonStore().load(db_path, None)
+        if records is None:
+            parser.error(f'unknown collection: {name}')
+        # Rewrite the JSON the way the server saves it
+        storage.JsonStore().save(db_path, records)
+        key = storage.key_field(db_path)
+        keys = [r[key] for r in rng.sample(records, min(len(records), 1000))]
+        del records
+
+        result = {"records": dataset['counts'][name]}
+        for fmt in FORMATS:
+            print(f'{name} ({fmt})...', file=sys.stderr)
+            new_store = stores[fmt]
+            path = new_store.snapshot_path(db_path) if fmt == 'snapshot' else db_path
+            picks = itertools.cycle(keys)
+
+            def open_get():
+                store = new_store()
+                assert store.get(db_path, next(picks)) is not None
+                store.invalidate()
+
+            def load():
+                store = new_store()
+                store.load(db_path, [])
+                store.invalidate()
+
+            result[fmt] = {"bytes": os.path.getsize(path),
+                           "open_get": measure(open_get, args.seconds),
+                           "load": measure(load, args.seconds)}
+        for op in ('open_get', 'load'):
+            result[f'{op}_speedup'] = round(
+                result['json'][op]['mean_us'] / result['snapshot'][op]['mean_us'], 1)
+        results[name] = result
+
+    starts = {}
+    for fmt in FORMATS:
+        print(f'server start ({fmt})...', file=sys.stderr)
+        starts[fmt] = {"seconds": server_start(root, fmt)}
+    starts['speedup'] = round(starts['json']['seconds'] / starts['snapshot']['seconds'], 1)
+
+    report = {
+        "config": {"patients": args.patients, "seed": args.seed},
+        "collections": results,
+        "server_start": starts
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
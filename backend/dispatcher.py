@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Notification Dispatcher
+Concurrent delivery of queued notifications to an HTTP API
+
+Claimed queue entries are sent on a bounded pool of threads. Each thread
+keeps one keep-alive connection to the provider, a shared token bucket keeps
+the request rate within the provider's quota, and failed sends are retried
+with exponential backoff until they run out of attempts (dead letters).
+"""
+
+import http.client
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+
+class DeliveryError(Exception):
+    """A send that did not succeed; retryable unless the provider rejected it for good"""
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+def backoff_delay(attempt, base, cap):
+    """Seconds to wait before retry number attempt (1, 2, ...), with jitter"""
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, in bursts of up to burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping until one is available"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ApiClient:
+    """POSTs JSON to one URL over a keep-alive connection per thread"""
+
+    def __init__(self, url, timeout=10):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"Invalid API URL: {url}")
+        self.url = url
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        self.timeout = timeout
+        self.connections = 0
+        self._local = threading.local()
+        self._counter_lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = cls(self.host, self.port, timeout=self.timeout)
+            self._local.conn = conn
+            self._local.reused = False
+            with self._counter_lock:
+                self.connections += 1
+        return conn
+
+    def close(self):
+        """Close this thread's connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def post(self, payload, headers=None):
+        """(status, response headers, body bytes) for one JSON POST"""
+        body = json.dumps(payload).encode()
+        headers = {'Content-Type': 'application/json', **(headers or {})}
+        while True:
+            conn = self._connection()
+            reused = self._local.reused
+            try:
+                conn.request('POST', self.path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.close()
+                # The provider closed an idle keep-alive connection before
+                # reading the request; send it again on a fresh one
+                if reused:
+                    continue
+                raise
+            except (OSError, http.client.HTTPException):
+                self.close()
+                raise
+            if response.will_close:
+                self.close()
+            else:
+                self._local.reused = True
+            return response.status, response.headers, data
+
+
+class Dispatcher:
+    """Sends claimed queue entries on a fixed number of threads"""
+
+    def __init__(self, queue, worker, threads=4):
+        self.queue = queue
+        self.worker = worker
+        self.threads = threads
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='dispatch')
+        self._slots = threading.BoundedSemaphore(threads)
+
+    def drain(self, send):
+        """Claim entries and run send(entry) on the pool until none are due; returns how many.
+
+        Entries are claimed only as threads free up, so a slow send holds up
+        one thread rather than the whole batch, and no entry sits leased for
+        long without being worked on.
+        """
+        dispatched = 0
+        while True:
+            batch = self.queue.claim(self.worker, limit=self.threads)
+            if not batch:
+                return dispatched
+            for notification in batch:
+                self._slots.acquire()
+                self._pool.submit(self._run, send, notification)
+            dispatched += len(batch)
+
+    def _run(self, send, notification):
+        try:
+            send(notification)
+        except Exception as e:
+            # The lease runs out and the entry is claimed again
+            print(f"Error sending notification {notification.get('id')}: {e}")
+        finally:
+            self._slots.release()
+
+    def wait_idle(self):
+        """Block until every handed-out entry has been sent"""
+        for _ in range(self.threads):
+            self._slots.acquire()
+        for _ in range(self.threads):
+            self._slots.release()
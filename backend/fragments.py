@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Response Fragments
+Records already encoded as JSON, joined into list responses
+
+List responses are assembled from each record's encoded bytes, so a record
+that has not changed since it was last sent is not encoded again. Entries
+are keyed by collection, record key and the fields left out (users are sent
+without 'password'), and remember the record they were encoded from: a hit
+needs that same record object or an equal one, so a record changed by any
+process, on any backend, is encoded afresh. Changes made in this process
+also re-encode (or drop) the entry right away, from storage change
+notifications.
+
+Entries are kept in least recently used order and the oldest are evicted
+once they exceed FRAGMENT_CACHE_BYTES, counting the records they hold as
+well as the encoded bytes: on SQLite every read decodes fresh records, so
+those are kept alive by the cache alone.
+"""
+
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from functools import partial
+
+from storage import key_field, subscribe
+
+# Most bytes of memory held by entries, records included (0 disables the cache)
+FRAGMENT_CACHE_BYTES = int(os.environ.get('FRAGMENT_CACHE_BYTES', 32 * 1024 * 1024))
+
+
+def encode(record, omit=()):
+    """record as JSON bytes, without the omit fields"""
+    if omit and isinstance(record, dict):
+        record = {k: v for k, v in record.items() if k not in omit}
+    return json.dumps(record).encode()
+
+
+def _size(value):
+    """Approximate bytes of memory held by a decoded JSON value"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_size(k) + _size(v) for k, v in value.items())
+    elif isinstance(value, list):
+        size += sum(_size(v) for v in value)
+    return size
+
+
+class FragmentCache:
+    """LRU cache of encoded records within a byte budget"""
+
+    def __init__(self, max_bytes=FRAGMENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        # (db_path, omit, key) -> (record, encoded, size), least recently used first
+        self._entries = OrderedDict()
+        # db_path -> omit tuples cached for it
+        self._variants = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def fragment(self, db_path, record, omit=()):
+        """encode(record, omit), reusing the cached bytes while the record is unchanged"""
+        key = record.get(key_field(db_path)) if isinstance(record, dict) else None
+        if key is None or self.max_bytes <= 0:
+            return encode(record, omit)
+        entry_key = (db_path, omit, key)
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            # Equality treats 1, 1.0 and True alike; such a change made by another
+            # process keeps its old spelling until the entry is evicted
+            if entry is not None and (entry[0] is record or entry[0] == record):
+                self._entries.move_to_end(entry_key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            watch = db_path not in self._variants
+            self._variants.setdefault(db_path, set()).add(omit)
+        if watch:
+            subscribe(db_path, partial(self._on_change, db_path))
+        encoded = encode(record, omit)
+        with self._lock:
+            self._put(entry_key, record, encoded)
+        return encoded
+
+    def _put(self, entry_key, record, encoded):
+        old = self._entries.pop(entry_key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        size = len(encoded) + _size(record)
+        if size > self.max_bytes:
+            return
+        self._entries[entry_key] = (record, encoded, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def _on_change(self, db_path, old, new, generation):
+        # Runs under the collection's write lock
+        if not isinstance(old, dict):
+            return
+        key = old.get(key_field(db_path))
+        with self._lock:
+            for omit in self._variants.get(db_path, ()):
+                entry_key = (db_path, omit, key)
+                if entry_key not in self._entries:
+                    continue
+                if isinstance(new, dict) and new.get(key_field(db_path)) == key:
+                    self._put(entry_key, new, encode(new, omit))
+                else:
+                    self.bytes -= self._entries.pop(entry_key)[2]
+
+    def stats(self):
+        """Cache counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None
+            }
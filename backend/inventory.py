@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Pharmacy Inventory
+Low-stock and expiry indexes over the pharmacy collection
+
+Items are kept in a min-heap keyed by expiry day and in a sorted list keyed
+by stock minus reorder level, both maintained from storage change
+notifications. "Expiring within N days" walks only the part of the heap at
+or below the cutoff, and "low stock" is the prefix of the sorted list with a
+margin of zero or less, so neither scans the catalog.
+"""
+
+import bisect
+import heapq
+import os
+
+from reports import day_ordinal, to_decimal
+from storage import MaterializedView
+
+# Inventory configuration
+# Reorder level for items that do not set their own reorder_level
+DEFAULT_REORDER_LEVEL = int(os.environ.get('DEFAULT_REORDER_LEVEL', 10))
+# Window for /api/pharmacy/expiring when no days= is given
+EXPIRY_WARNING_DAYS = int(os.environ.get('EXPIRY_WARNING_DAYS', 30))
+
+
+def stock_margin(record):
+    """Units in stock above the item's reorder level (<= 0 means reorder)"""
+    reorder = record.get('reorder_level')
+    reorder = DEFAULT_REORDER_LEVEL if reorder in (None, '') else to_decimal(reorder)
+    return to_decimal(record.get('stock_quantity', 0)) - reorder
+
+
+def dispense_quantities(prescription):
+    """{medicine id: units} for a prescription, or an error message"""
+    wanted = {}
+    for line in prescription.get('medicines') or []:
+        if not isinstance(line, dict) or not line.get('medicine_id'):
+            return "every medicine needs a medicine_id"
+        quantity = line.get('quantity', 1)
+        if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity < 1:
+            return "medicine quantity must be a positive integer"
+        key = str(line['medicine_id'])
+        wanted[key] = wanted.get(key, 0) + quantity
+    if not wanted:
+        return "prescription has no medicines to dispense"
+    return wanted
+
+
+class InventoryIndex(MaterializedView):
+    """Pharmacy items ordered by expiry day and by stock margin"""
+
+    def reset(self):
+        self._expiry = {}       # item id -> expiry ordinal
+        self._heap = []         # (expiry ordinal, item id); stale entries skipped
+        self._margin = {}       # item id -> stock margin
+        self._by_margin = []    # sorted (stock margin, item id)
+
+    def apply(self, record, sign):
+        key = record.get('id')
+        if key is None:
+            return
+        key = str(key)
+        if sign < 0:
+            self._expiry.pop(key, None)
+            margin = self._margin.pop(key, None)
+            if margin is not None:
+                i = bisect.bisect_left(self._by_margin, (margin, key))
+                if i < len(self._by_margin) and self._by_margin[i] == (margin, key):
+                    del self._by_margin[i]
+            return
+
+        ordinal = day_ordinal(record.get('expiry_date'))
+        if ordinal is not None:
+            self._expiry[key] = ordinal
+            heapq.heappush(self._heap, (ordinal, key))
+            # Removed items leave their heap entries behind; drop them in bulk
+            if len(self._heap) > 2 * len(self._expiry) + 64:
+                self._heap = [(o, k) for k, o in self._expiry.items()]
+                heapq.heapify(self._heap)
+        margin = stock_margin(record)
+        self._margin[key] = margin
+        bisect.insort(self._by_margin, (margin, key))
+
+    def _expiring(self, last):
+        """Live (ordinal, id) entries expiring on or before ordinal last"""
+        heap = self._heap
+        found = set()
+        # Children are never smaller than their parent, so stop descending
+        # at the first entry past the cutoff
+        stack = [0] if heap else []
+        while stack:
+            i = stack.pop()
+            ordinal, key = heap[i]
+            if ordinal > last:
+                continue
+            if self._expiry.get(key) == ordinal:
+                found.add((ordinal, key))
+            stack.extend(c for c in (2 * i + 1, 2 * i + 2) if c < len(heap))
+        return sorted(found)
+
+    def expiring(self, last, limit=None):
+        """[(expiry ordinal, item id)] expiring on or before last, soonest first"""
+        return self.read(lambda index: index._expiring(last)[:limit])
+
+    def low_stock(self, limit=None):
+        """[(stock margin, item id)] at or below their reorder level, lowest first"""
+        def low(index):
+            # Ids are strings, so this sorts after every (0, id) entry
+            stop = bisect.bisect_right(index._by_margin, (0, chr(0x10ffff)))
+            return index._by_margin[:stop if limit is None else min(stop, limit)]
+        return self.read(low)
+
+    def stats(self):
+        """Index sizes"""
+        return self.read(lambda index: {
+            "items": len(index._margin),
+            "with_expiry": len(index._expiry),
+            "expiry_heap": len(index._heap),
+            "rebuilds": index.rebuilds
+        })
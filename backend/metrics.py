@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Metrics
+In-process counters, histograms and gauges rendered in the Prometheus text
+exposition format
+
+Metrics are registered once at import time and updated on hot paths, so an
+update is a lock, a bisect and two additions. Each process keeps its own
+values (the API server serves them at /api/metrics, the WhatsApp service on
+its own localhost port).
+
+Histograms created with a span name also add their time to the current
+request's breakdown (see begin_request), which the slow-request log prints.
+"""
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Metrics configuration
+# Requests slower than this are logged with a timing breakdown (0 = off)
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0))
+# Label combinations kept per metric; further ones are counted under "other"
+METRICS_MAX_SERIES = int(os.environ.get('METRICS_MAX_SERIES', 500))
+
+# Seconds; fine-grained at the low end where cached reads live
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named family of series, one per combination of label values"""
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, values):
+        """Series key for label values, folding new ones into "other" past the cap"""
+        if values in self._series or len(self._series) < METRICS_MAX_SERIES:
+            return values
+        return ('other',) * len(self.labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            series = sorted(self._series.items())
+            lines += self._render_series(series)
+        return lines
+
+    def _render_series(self, series):
+        return [f'{self.name}{_format_labels(self.labels, values)} {_format_value(v)}'
+                for values, v in series]
+
+
+class Counter(Metric):
+    """Monotonic count per label combination"""
+
+    kind = 'counter'
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            key = self._key(values)
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    """Distribution of observed values (seconds) in fixed buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, span=None):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.span = span
+
+    def observe(self, value, *values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(values)
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (not cumulative), then sum and count
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+        if self.span:
+            spans = getattr(_local, 'spans', None)
+            if spans is not None:
+                total, count = spans.get(self.span, (0.0, 0))
+                spans[self.span] = (total + value, count + 1)
+
+    @contextmanager
+    def time(self, *values):
+        """Observe how long the with-block takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *values)
+
+    def _render_series(self, series):
+        lines = []
+        for values, data in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), data):
+                cumulative += count
+                le = 'le="%s"' % _format_value(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, values, le)} {cumulative}')
+            labels = _format_labels(self.labels, values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(data[-2])}')
+            lines.append(f'{self.name}_count{labels} {data[-1]}')
+        return lines
+
+
+class Gauge(Metric):
+    """Value read at scrape time: fn() returns a number, or {label values: number}"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn, labels=()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception as e:
+            return [f'# {self.name} unavailable: {_escape(e)}']
+        if not isinstance(value, dict):
+            value = {(): value}
+        series = sorted((k if isinstance(k, tuple) else (k,), v) for k, v in value.items())
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}'] + \
+            self._render_series(series)
+
+
+class Registry:
+    """Metrics of one process, rendered together"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            # Re-registering (e.g. a module imported twice) returns the existing one
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS, span=None):
+        return self._register(Histogram(name, help, labels, buckets, span))
+
+    def gauge(self, name, help, fn, labels=()):
+        return self._register(Gauge(name, help, fn, labels))
+
+    def render(self):
+        """All metrics in the Prometheus text format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.counter(name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS, span=None):
+    return REGISTRY.histogram(name, help, labels, buckets, span)
+
+
+def gauge(name, help, fn, labels=()):
+    return REGISTRY.gauge(name, help, fn, labels)
+
+
+def render():
+    return REGISTRY.render()
+
+
+# Per-request timing breakdown
+
+def begin_request():
+    """Start collecting span times for the request handled by this thread"""
+    _local.spans = {}
+
+
+def end_request():
+    """{span: (seconds, count)} collected since begin_request()"""
+    spans = getattr(_local, 'spans', None)
+    _local.spans = None
+    return spans or {}
+
+
+def format_spans(spans):
+    return ' '.join(f'{name}={total * 1000:.1f}ms/{count}'
+                    for name, (total, count) in sorted(spans.items()))
+
+
+# Standalone exporter for processes without an HTTP API
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, host='127.0.0.1'):
+    """Serve /metrics on host:port from a background thread; returns the server"""
+    server = _MetricsServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics').start()
+    return server
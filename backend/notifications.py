@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Notification Queue
+Durable queue of outgoing notifications shared by the server and the
+WhatsApp service
+
+Entries live in the notifications collection and move through
+  pending -> in_flight -> sent | failed | dead
+                       -> pending again (retry after available_at)
+A worker claims due entries under the collection write lock and holds a
+lease on them; if it dies, the lease expires and another worker claims the
+entries again. Entries that ran out of retries become dead letters and stay
+until requeued. Sent and failed entries are moved to the monthly archive
+segments (see archive.py) so the live collection only holds work still to do
+(plus recent history).
+
+Enqueueing sends a one-byte UDP datagram to the worker on localhost, so it
+wakes up immediately instead of at its next poll. The datagram is only a
+hint: if the worker is not running, the entry simply waits in the queue.
+"""
+
+import os
+import select
+import socket
+import time
+import uuid
+from datetime import datetime
+
+from archive import ARCHIVE
+from storage import get_record, find_records, insert_record, update_record, transaction
+
+# Queue configuration
+NOTIFY_WAKE_PORT = int(os.environ.get('NOTIFY_WAKE_PORT', 8001))
+NOTIFY_LEASE_SECONDS = float(os.environ.get('NOTIFY_LEASE_SECONDS', 60))
+# Finished entries stay in the live collection this long before archiving
+NOTIFY_ARCHIVE_AFTER = float(os.environ.get('NOTIFY_ARCHIVE_AFTER', 3600))
+
+PENDING, IN_FLIGHT, SENT, FAILED, DEAD = 'pending', 'in_flight', 'sent', 'failed', 'dead'
+# Final states that are archived; dead letters wait for requeue_dead()
+DONE_STATUSES = (SENT, FAILED)
+
+
+class NotificationQueue:
+    """Pending/in-flight/done notification entries with worker leases"""
+
+    def __init__(self, db_path, wake_port=NOTIFY_WAKE_PORT):
+        self.db_path = db_path
+        self.wake_port = wake_port
+        self._wake_socket = None
+
+    # Producer side
+
+    def enqueue(self, notification_type, data, notification_id=None):
+        """Store a new pending notification and wake the worker.
+
+        With an explicit notification_id the entry is only added once: if an
+        entry with that id is still in the collection, returns None.
+        """
+        notification = {
+            "id": notification_id or str(uuid.uuid4()),
+            "type": notification_type,
+            "data": data,
+            "created_at": datetime.now().isoformat(),
+            "status": PENDING,
+            "attempts": 0
+        }
+        with transaction(self.db_path):
+            if notification_id is not None and get_record(self.db_path, notification_id):
+                return None
+            insert_record(self.db_path, notification)
+        self.wake()
+        return notification
+
+    def wake(self):
+        """Tell a waiting worker there is new work (best effort)"""
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.sendto(b'!', ('127.0.0.1', self.wake_port))
+        except OSError:
+            pass
+
+    # Worker side
+
+    def listen(self):
+        """Bind the wakeup socket; call once in the worker before waiting"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', self.wake_port))
+        sock.setblocking(False)
+        self._wake_socket = sock
+
+    def wait(self, timeout):
+        """Sleep until woken by enqueue() or timeout seconds pass"""
+        if self._wake_socket is None:
+            time.sleep(timeout)
+            return False
+        readable, _, _ = select.select([self._wake_socket], [], [], timeout)
+        if not readable:
+            return False
+        # Several enqueues may have piled up; one pass handles them all
+        try:
+            while self._wake_socket.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def claim(self, worker, limit=100, lease_seconds=NOTIFY_LEASE_SECONDS):
+        """Lease up to limit entries that are due or whose lease has expired"""
+        now = time.time()
+        claimed = []
+        with transaction(self.db_path):
+            candidates = [n for n in find_records(self.db_path, 'status', PENDING)
+                          if (n.get('available_at') or 0) <= now]
+            candidates += [n for n in find_records(self.db_path, 'status', IN_FLIGHT)
+                           if (n.get('lease_expires') or 0) < now]
+            candidates.sort(key=lambda n: n.get('created_at') or '')
+            for notification in candidates[:limit]:
+                claimed.append(update_record(self.db_path, notification['id'], {
+                    'status': IN_FLIGHT,
+                    'lease_owner': worker,
+                    'lease_expires': now + lease_seconds,
+                    'attempts': notification.get('attempts', 0) + 1
+                }))
+        return [n for n in claimed if n is not None]
+
+    def next_due(self):
+        """Epoch time of the earliest pending retry still to come, None if there is none.
+
+        Entries already due are not counted: claim() has just had its chance at them.
+        """
+        now = time.time()
+        times = [n['available_at'] for n in find_records(self.db_path, 'status', PENDING)
+                 if isinstance(n.get('available_at'), (int, float)) and n['available_at'] > now]
+        return min(times) if times else None
+
+    def finish(self, notification_id, worker, changes):
+        """Apply a final (or retry) state if the worker still holds the lease"""
+        changes = {**changes, 'lease_owner': None, 'lease_expires': None}
+        if changes['status'] != PENDING:
+            changes['finished_at'] = datetime.now().isoformat()
+        with transaction(self.db_path):
+            current = get_record(self.db_path, notification_id)
+            if (current is None or current.get('status') != IN_FLIGHT
+                    or current.get('lease_owner') != worker):
+                return None
+            return update_record(self.db_path, notification_id, changes)
+
+    def complete(self, notification_id, worker):
+        return self.finish(notification_id, worker, {'status': SENT,
+                                                     'sent_at': datetime.now().isoformat()})
+
+    def fail(self, notification_id, worker, error):
+        return self.finish(notification_id, worker, {'status': FAILED, 'error': str(error)})
+
+    def retry(self, notification_id, worker, error, delay):
+        """Put an entry back in the queue, due again in delay seconds"""
+        return self.finish(notification_id, worker, {'status': PENDING, 'error': str(error),
+                                                     'available_at': time.time() + delay})
+
+    def dead(self, notification_id, worker, error):
+        """Give up on an entry after its last retry"""
+        return self.finish(notification_id, worker, {'status': DEAD, 'error': str(error)})
+
+    def requeue_dead(self):
+        """Make every dead letter pending again with fresh attempts; returns how many"""
+        with transaction(self.db_path):
+            dead = find_records(self.db_path, 'status', DEAD)
+            for notification in dead:
+                update_record(self.db_path, notification['id'], {
+                    'status': PENDING, 'attempts': 0, 'available_at': None, 'finished_at': None
+                })
+        if dead:
+            self.wake()
+        return len(dead)
+
+    def archive(self, older_than=NOTIFY_ARCHIVE_AFTER):
+        """Move entries finished more than older_than seconds ago to the archive"""
+        cutoff = datetime.fromtimestamp(time.time() - older_than).isoformat()
+        with transaction(self.db_path):
+            done = [n for status in DONE_STATUSES for n in find_records(self.db_path, 'status', status)
+                    if (n.get('finished_at') or n.get('created_at') or '') <= cutoff]
+            return ARCHIVE.move(self.db_path, done)
+
+    def stats(self):
+        """Entries per status in the live collection"""
+        return {status: len(find_records(self.db_path, 'status', status))
+                for status in (PENDING, IN_FLIGHT) + DONE_STATUSES + (DEAD,)}
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Reports
+Aggregates kept up to date as records change
+
+Each view subscribes to one collection and folds every insert, update and
+delete into its totals, so reports are answered without scanning the
+collection. A view tracks the collection generation it reflects; when that
+falls behind (another process wrote, or the whole collection was replaced)
+the view rebuilds from a full load on its next read.
+
+Views cover archived records too (see archive.ArchivedView), so totals do
+not change when old records move to the archive.
+
+Time-series reports read daily rollups: one array of doubles per series,
+indexed by day, so a range query touches one slot per day rather than
+every record.
+"""
+
+import csv
+import io
+from array import array
+from collections import Counter
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from archive import ArchivedView
+from storage import count_records
+
+
+def to_decimal(value):
+    """Decimal for a numeric record field, 0 if it is missing or not a number"""
+    if isinstance(value, bool) or value is None:
+        return Decimal(0)
+    try:
+        return Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        return Decimal(0)
+
+
+def to_number(value):
+    """Decimal as an int when integral, else a float (for JSON output)"""
+    return int(value) if value == value.to_integral_value() else float(value)
+
+
+class AppointmentStats(ArchivedView):
+    """Appointment counts per date and per status"""
+
+    def reset(self):
+        self.total = 0
+        self.by_date = Counter()
+        self.by_status = Counter()
+
+    def apply(self, record, sign):
+        self.total += sign
+        self.by_date[record.get('date')] += sign
+        self.by_status[record.get('status')] += sign
+
+
+class BillingStats(ArchivedView):
+    """Bill counts and amounts per status, and total revenue"""
+
+    def reset(self):
+        self.revenue = Decimal(0)
+        self.count_by_status = Counter()
+        self.amount_by_status = Counter()
+
+    def apply(self, record, sign):
+        amount = to_decimal(record.get('amount', 0)) * sign
+        status = record.get('status')
+        self.revenue += amount
+        self.count_by_status[status] += sign
+        self.amount_by_status[status] += amount
+
+
+# Time series
+
+INTERVALS = ('day', 'week', 'month')
+
+# Bill aging buckets as (label, min days, max days); None means no upper bound
+AGING_BUCKETS = (('0-30', 0, 30), ('31-60', 31, 60), ('61-90', 61, 90), ('90+', 91, None))
+
+# Days outside this range are treated as unparseable (they would make the
+# rollup arrays huge for no useful report)
+MIN_DAY = date(1900, 1, 1).toordinal()
+MAX_DAY = date(2200, 12, 31).toordinal()
+
+
+def day_ordinal(value):
+    """Date ordinal for a 'YYYY-MM-DD...' string, or None"""
+    if not isinstance(value, str) or len(value) < 10:
+        return None
+    try:
+        ordinal = date.fromisoformat(value[:10]).toordinal()
+    except ValueError:
+        return None
+    return ordinal if MIN_DAY <= ordinal <= MAX_DAY else None
+
+
+def period_start(ordinal, interval):
+    """Ordinal of the first day of the day/week/month containing ordinal"""
+    if interval == 'week':
+        return ordinal - date.fromordinal(ordinal).weekday()
+    if interval == 'month':
+        return date.fromordinal(ordinal).replace(day=1).toordinal()
+    return ordinal
+
+
+class DailySeries:
+    """Per-day values in a compact array of doubles, indexed from a start day"""
+
+    __slots__ = ('start', 'values')
+
+    def __init__(self):
+        self.start = None
+        self.values = array('d')
+
+    def add(self, ordinal, amount):
+        if self.start is None:
+            self.start = ordinal
+        if ordinal < self.start:
+            self.values[0:0] = array('d', bytes(8 * (self.start - ordinal)))
+            self.start = ordinal
+        i = ordinal - self.start
+        if i >= len(self.values):
+            self.values.extend(array('d', bytes(8 * (i + 1 - len(self.values)))))
+        self.values[i] += amount
+
+    def window(self, first, last):
+        """Copy of the values for days first..last (inclusive), zero-filled"""
+        out = array('d', bytes(8 * (last - first + 1)))
+        if self.start is None:
+            return out
+        lo = max(first, self.start)
+        hi = min(last, self.start + len(self.values) - 1)
+        if lo <= hi:
+            out[lo - first:hi - first + 1] = self.values[lo - self.start:hi - self.start + 1]
+        return out
+
+
+def bucket(values, first, interval):
+    """[(period start ordinal, total)] for a window of daily values"""
+    points = []
+    for i, value in enumerate(values):
+        period = period_start(first + i, interval)
+        if points and points[-1][0] == period:
+            points[-1][1] += value
+        else:
+            points.append([period, value])
+    return points
+
+
+def _series_add(table, name, ordinal, amount):
+    series = table.get(name)
+    if series is None:
+        series = table[name] = DailySeries()
+    series.add(ordinal, amount)
+
+
+class BillingRollup(ArchivedView):
+    """Bill counts and amounts per status per day the bill was created"""
+
+    def reset(self):
+        self.counts = {}
+        self.amounts = {}
+
+    def apply(self, record, sign):
+        ordinal = day_ordinal(record.get('created_at'))
+        if ordinal is None:
+            return
+        status = str(record.get('status') or 'unknown')
+        _series_add(self.counts, status, ordinal, sign)
+        _series_add(self.amounts, status, ordinal, float(to_decimal(record.get('amount', 0))) * sign)
+
+
+class AppointmentRollup(ArchivedView):
+    """Appointment counts per doctor and per department per appointment day"""
+
+    def reset(self):
+        self.by_doctor = {}
+        self.by_department = {}
+
+    def apply(self, record, sign):
+        ordinal = day_ordinal(record.get('date'))
+        if ordinal is None:
+            return
+        doctor = record.get('doctor_name') or record.get('doctor_id') or 'Unassigned'
+        _series_add(self.by_doctor, str(doctor), ordinal, sign)
+        _series_add(self.by_department, str(record.get('department') or 'General'), ordinal, sign)
+
+
+def _amount(value):
+    """Rollup sums are doubles; report money to the cent"""
+    return round(value, 2) + 0.0
+
+
+class TimeSeries:
+    """Date-range reports over daily rollups of billing and appointments"""
+
+    def __init__(self, appointments_db, billing_db):
+        self.appointment_rollup = AppointmentRollup(appointments_db)
+        self.billing_rollup = BillingRollup(billing_db)
+
+    def revenue(self, first, last, interval='day', status=None):
+        """[(period ordinal, amount, count)] of bills created first..last"""
+        def windows(view):
+            statuses = [status] if status else list(view.amounts)
+            amounts = array('d', bytes(8 * (last - first + 1)))
+            counts = array('d', bytes(8 * (last - first + 1)))
+            for name in statuses:
+                if name in view.amounts:
+                    for i, v in enumerate(view.amounts[name].window(first, last)):
+                        amounts[i] += v
+                    for i, v in enumerate(view.counts[name].window(first, last)):
+                        counts[i] += v
+            return amounts, counts
+
+        amounts, counts = self.billing_rollup.read(windows)
+        return [(period, _amount(amount), int(count))
+                for (period, amount), (_, count)
+                in zip(bucket(amounts, first, interval), bucket(counts, first, interval))]
+
+    def appointments(self, first, last, interval='day', group_by='doctor'):
+        """{group: [(period ordinal, count)]} for appointments dated first..last"""
+        def windows(view):
+            table = view.by_department if group_by == 'department' else view.by_doctor
+            return {name: series.window(first, last) for name, series in table.items()}
+
+        result = {}
+        for name, values in sorted(self.appointment_rollup.read(windows).items()):
+            if any(values):
+                result[name] = [(period, int(count))
+                                for period, count in bucket(values, first, interval)]
+        return result
+
+    def aging(self, as_of, statuses=('pending',)):
+        """{status: [(bucket label, count, amount)]} by bill age on day as_of"""
+        def windows(view):
+            out = {}
+            for status in statuses:
+                counts = view.counts.get(status)
+                if counts is None or counts.start is None or counts.start > as_of:
+                    continue
+                out[status] = (counts.start, counts.window(counts.start, as_of),
+                               view.amounts[status].window(counts.start, as_of))
+            return out
+
+        found = self.billing_rollup.read(windows)
+        result = {}
+        for status in statuses:
+            start, counts, amounts = found.get(status, (as_of, (), ()))
+            rows = []
+            for label, low, high in AGING_BUCKETS:
+                # A bill created on day start + i is as_of - start - i days old
+                lo = 0 if high is None else max(as_of - high - start, 0)
+                hi = as_of - low - start
+                rows.append((label, int(sum(counts[lo:hi + 1])) if hi >= 0 else 0,
+                             _amount(sum(amounts[lo:hi + 1])) if hi >= 0 else 0.0))
+            result[status] = rows
+        return result
+
+    def rebuild(self):
+        """Rebuild both rollups from scratch"""
+        self.appointment_rollup.rebuild()
+        self.billing_rollup.rebuild()
+
+    def stats(self):
+        """View counters"""
+        return {
+            "appointment_rollup_rebuilds": self.appointment_rollup.rebuilds,
+            "billing_rollup_rebuilds": self.billing_rollup.rebuilds
+        }
+
+
+def csv_rows(header, rows):
+    """Encode rows as CSV text one line at a time (for streaming)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in [header] if header else []:
+        writer.writerow(row)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= 8192:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _snapshot(view):
+    """Plain-value copy of a view's state, for comparing two builds"""
+    state = {}
+    for name, value in vars(view).items():
+        if name.startswith('_') or name in ('db_path', 'rebuilds', 'cold', 'cold_loads'):
+            continue
+        if isinstance(value, Counter):
+            value = {k: v for k, v in value.items() if v}
+        state[name] = value
+    return state
+
+
+class Dashboard:
+    """Totals behind /api/reports/dashboard"""
+
+    def __init__(self, patients_db, appointments_db, billing_db):
+        self.patients_db = patients_db
+        self.appointments = AppointmentStats(appointments_db)
+        self.billing = BillingStats(billing_db)
+
+    def report(self, today):
+        """Dashboard totals for the given YYYY-MM-DD date"""
+        appointments = self.appointments.read(
+            lambda v: (v.total, v.by_date.get(today, 0)))
+        billing = self.billing.read(
+            lambda v: (v.revenue, v.count_by_status.get('pending', 0)))
+        return {
+            "total_patients": count_records(self.patients_db),
+            "total_appointments": appointments[0],
+            "today_appointments": appointments[1],
+            "total_revenue": to_number(billing[0]),
+            "pending_bills": billing[1]
+        }
+
+    def rebuild(self):
+        """Rebuild every view from scratch"""
+        self.appointments.rebuild()
+        self.billing.rebuild()
+
+    def check(self):
+        """Rebuild and report whether the incremental totals matched"""
+        views = {'appointments': self.appointments, 'billing': self.billing}
+        result = {}
+        for name, view in views.items():
+            before = view.read(_snapshot)
+            generation = view._generation
+            view.rebuild()
+            # Only comparable if nothing was written between the two reads
+            if view._generation == generation:
+                result[name] = view.read(_snapshot) == before
+            else:
+                result[name] = None
+        return {"consistent": all(v is not False for v in result.values()), "views": result}
+
+    def stats(self):
+        """View counters"""
+        return {
+            "appointments_rebuilds": self.appointments.rebuilds,
+            "billing_rebuilds": self.billing.rebuilds
+        }
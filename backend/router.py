@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Routing
+Route table mapping method + path pattern to a handler and the roles allowed
+to call it
+
+Patterns are '/'-separated segments; a segment starting with ':' captures
+that part of the path (e.g. '/api/patients/:id/billing'). Routes are kept in
+a tree with one level per segment, so matching a path costs one dict lookup
+per segment however many routes there are. Literal segments win over
+captures, so '/api/patients/search' is never read as a patient id.
+"""
+
+from urllib.parse import unquote, parse_qs
+
+
+class Route:
+    """One registered endpoint"""
+
+    __slots__ = ('method', 'pattern', 'handler', 'roles', 'public', 'raw_body')
+
+    def __init__(self, method, pattern, handler, roles=None, public=False, raw_body=False):
+        self.method = method
+        self.pattern = pattern
+        # handler(request_handler, ctx)
+        self.handler = handler
+        # None: any signed-in user
+        self.roles = frozenset(roles) if roles is not None else None
+        # No sign-in needed
+        self.public = public
+        # The handler reads the request body itself (e.g. NDJSON uploads)
+        self.raw_body = raw_body
+
+    def allows(self, user):
+        if self.public:
+            return True
+        if not user:
+            return False
+        return self.roles is None or user.get('role') in self.roles
+
+
+class RequestContext:
+    """Per-request state handed to route handlers, resolved once by the dispatcher"""
+
+    __slots__ = ('route', 'params', 'query_string', '_query', 'body', 'token', 'user')
+
+    def __init__(self, route, params, query_string=''):
+        self.route = route
+        # Captured path segments by name
+        self.params = params
+        self.query_string = query_string
+        self._query = None
+        self.body = None
+        self.token = None
+        self.user = None
+
+    @property
+    def query(self):
+        """Query string as parse_qs() lists, parsed on first use"""
+        if self._query is None:
+            self._query = parse_qs(self.query_string)
+        return self._query
+
+
+class _Node:
+    __slots__ = ('children', 'capture', 'child', 'routes', 'pattern')
+
+    def __init__(self):
+        self.children = {}
+        # Name and subtree of a ':name' segment at this level
+        self.capture = None
+        self.child = None
+        self.routes = {}
+        self.pattern = None
+
+
+def _segments(path):
+    return [s for s in path.split('/') if s]
+
+
+class Router:
+    """Route tree; build it once at startup, then match() concurrently"""
+
+    def __init__(self):
+        self._root = _Node()
+        self.routes = []
+
+    def add(self, method, pattern, handler, roles=None, public=False, raw_body=False):
+        """Register handler for method + pattern; returns the Route"""
+        node = self._root
+        for segment in _segments(pattern):
+            if segment.startswith(':'):
+                name = segment[1:]
+                if node.child is None:
+                    node.capture, node.child = name, _Node()
+                elif node.capture != name:
+                    raise ValueError(f"{pattern}: ':{name}' clashes with ':{node.capture}'")
+                node = node.child
+            else:
+                node = node.children.setdefault(segment, _Node())
+        if method in node.routes:
+            raise ValueError(f"duplicate route {method} {pattern}")
+        route = Route(method, pattern, handler, roles, public, raw_body)
+        node.routes[method] = route
+        node.pattern = pattern
+        self.routes.append(route)
+        return route
+
+    def _find(self, node, segments, i, params):
+        """Node for segments[i:] below node, filling params; literals before captures"""
+        if i == len(segments):
+            return node if node.routes else None
+        child = node.children.get(segments[i])
+        if child is not None:
+            found = self._find(child, segments, i + 1, params)
+            if found is not None:
+                return found
+        if node.child is not None:
+            params[node.capture] = unquote(segments[i])
+            found = self._find(node.child, segments, i + 1, params)
+            if found is not None:
+                return found
+            del params[node.capture]
+        return None
+
+    def match(self, method, path):
+        """(route, params) for a request path without its query string.
+
+        route is None when nothing matches; params is then None if no route
+        has that path at all, or the sorted methods it does allow (for 405).
+        """
+        params = {}
+        node = self._find(self._root, _segments(path), 0, params)
+        if node is None:
+            return None, None
+        route = node.routes.get(method)
+        if route is None:
+            return None, sorted(node.routes)
+        return route, params
+
+    def pattern(self, path):
+        """Pattern of the routes at path, whatever the method (for metrics labels)"""
+        node = self._find(self._root, _segments(path), 0, {})
+        return node.pattern if node is not None else None
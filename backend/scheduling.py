@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Scheduling
+Per-doctor, per-day interval index over appointments
+
+Every booked appointment is an interval [start, end) in minutes after
+midnight, kept in a sorted list per (doctor, date). Overlap checks and
+free-slot queries only look at that one day's list instead of scanning
+all appointments.
+"""
+
+import bisect
+import os
+
+from storage import MaterializedView
+
+# Scheduling configuration
+APPOINTMENT_MINUTES = int(os.environ.get('APPOINTMENT_MINUTES', 30))
+
+# Appointments in these states no longer hold their slot
+FREE_STATUSES = ('cancelled',)
+
+# Working day used for availability when settings have no "scheduling" section
+DEFAULT_HOURS = {"day_start": "09:00", "day_end": "17:00", "slot_minutes": APPOINTMENT_MINUTES}
+
+
+def parse_time(value):
+    """Minutes after midnight for 'HH:MM' (or 'HH:MM:SS'), else None"""
+    if not isinstance(value, str):
+        return None
+    parts = value.strip().split(':')
+    if len(parts) not in (2, 3) or not all(p.isdigit() for p in parts):
+        return None
+    hours, minutes = int(parts[0]), int(parts[1])
+    if hours > 23 or minutes > 59:
+        return None
+    return hours * 60 + minutes
+
+
+def format_time(minutes):
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+
+def doctor_key(value):
+    """Normalized doctor identifier (doctor_id, or doctor_name when there is no id)"""
+    if value is None:
+        return None
+    value = str(value).strip().lower()
+    return value or None
+
+
+def duration_of(record):
+    """Appointment length in minutes, or None if the record's duration is invalid"""
+    duration = record.get('duration', APPOINTMENT_MINUTES)
+    if isinstance(duration, str) and duration.isdigit():
+        duration = int(duration)
+    if isinstance(duration, bool) or not isinstance(duration, int) or duration <= 0:
+        return None
+    return duration
+
+
+def interval_of(record):
+    """((doctor, date), start, end) for an appointment holding a slot, else None"""
+    if record.get('status') in FREE_STATUSES:
+        return None
+    doctor = doctor_key(record.get('doctor_id') or record.get('doctor_name'))
+    day = record.get('date')
+    start = parse_time(record.get('time'))
+    duration = duration_of(record)
+    if doctor is None or not isinstance(day, str) or start is None or duration is None:
+        return None
+    return (doctor, day), start, start + duration
+
+
+def validate(record):
+    """Error message if the appointment's time or duration is malformed, else None"""
+    if record.get('time') not in (None, '') and parse_time(record.get('time')) is None:
+        return "time must be HH:MM"
+    if duration_of(record) is None:
+        return "duration must be a positive number of minutes"
+    return None
+
+
+class ScheduleIndex(MaterializedView):
+    """Booked intervals per doctor and day"""
+
+    def reset(self):
+        self._days = {}   # (doctor, date) -> sorted [(start, end, appointment id)]
+
+    def apply(self, record, sign):
+        interval = interval_of(record)
+        if interval is None or record.get('id') is None:
+            return
+        day, start, end = interval
+        entry = (start, end, str(record['id']))
+        slots = self._days.setdefault(day, [])
+        if sign > 0:
+            bisect.insort(slots, entry)
+            return
+        i = bisect.bisect_left(slots, entry)
+        if i < len(slots) and slots[i] == entry:
+            del slots[i]
+        if not slots:
+            del self._days[day]
+
+    def _overlapping(self, day, start, end, ignore=None):
+        slots = self._days.get(day, ())
+        # Only intervals starting before `end` can overlap [start, end)
+        stop = bisect.bisect_left(slots, (end,))
+        return [i for s, e, i in slots[:stop] if e > start and i != ignore]
+
+    def conflicts(self, record):
+        """Ids of other appointments overlapping this one's slot.
+
+        Call inside transaction() on the appointments collection and write the
+        record before leaving it, so no other booking can slip in between.
+        """
+        interval = interval_of(record)
+        if interval is None:
+            return []
+        day, start, end = interval
+        return self.read(lambda index: index._overlapping(day, start, end, record.get('id')))
+
+    def conflicts_many(self, records):
+        """conflicts() for each of several new appointments, counting earlier ones in the list"""
+        def check(index):
+            pending = {}   # (doctor, date) -> [(start, end, id)] from earlier records
+            result = []
+            for record in records:
+                interval = interval_of(record)
+                if interval is None:
+                    result.append([])
+                    continue
+                day, start, end = interval
+                ignore = record.get('id')
+                clash = index._overlapping(day, start, end, ignore)
+                clash += [i for s, e, i in pending.get(day, ()) if s < end and e > start]
+                if not clash:
+                    pending.setdefault(day, []).append((start, end, ignore))
+                result.append(clash)
+            return result
+        return self.read(check)
+
+    def availability(self, doctor, day, day_start, day_end, slot_minutes, duration):
+        """Free [(start, end)] slots of `duration` minutes, aligned to slot_minutes"""
+        def free(index):
+            slots = []
+            start = day_start
+            while start + duration <= day_end:
+                if not index._overlapping((doctor, day), start, start + duration):
+                    slots.append((start, start + duration))
+                start += slot_minutes
+            return slots
+        return self.read(free)
+
+    def booked(self, doctor, day):
+        """[(start, end, appointment id)] booked for a doctor on a day"""
+        return self.read(lambda index: list(index._days.get((doctor, day), ())))
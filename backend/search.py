@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Patient Search
+In-memory inverted index over patient names and phone numbers
+
+Names are split into normalized tokens; each token maps to the patients that
+contain it, and a sorted vocabulary answers prefix queries with a bisect.
+Typo tolerance comes from a trigram index over the vocabulary (not over
+patients): tokens sharing enough trigrams with the query (or, for short
+words, the same first letter) are candidates, confirmed with a bounded edit
+distance, so fuzzy matching only looks at distinct tokens. Phone numbers are indexed by their digit n-grams, so any run of
+PHONE_NGRAM or more digits finds the numbers containing it.
+"""
+
+import bisect
+import heapq
+import os
+import re
+import unicodedata
+from collections import Counter
+
+from storage import MaterializedView
+
+# Search configuration
+SEARCH_DEFAULT_LIMIT = int(os.environ.get('SEARCH_DEFAULT_LIMIT', 20))
+SEARCH_MAX_LIMIT = int(os.environ.get('SEARCH_MAX_LIMIT', 100))
+# Stop collecting matches for a query after this many patients
+SEARCH_MAX_CANDIDATES = int(os.environ.get('SEARCH_MAX_CANDIDATES', 5000))
+PHONE_NGRAM = 4
+# Typos tolerated per query word: one from FUZZY_MIN_LENGTH letters, two from 8
+FUZZY_MIN_LENGTH = 4
+
+# Scores per matched query term
+EXACT_SCORE = 3.0
+PREFIX_SCORE = 2.0
+FUZZY_SCORE = 1.0
+PHONE_SCORE = 3.0
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def normalize(text):
+    """Lowercase ASCII form of text (accents removed)"""
+    text = unicodedata.normalize('NFKD', str(text))
+    return text.encode('ascii', 'ignore').decode().lower()
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(normalize(text))
+
+
+def digits_of(text):
+    return ''.join(ch for ch in str(text) if ch.isdigit())
+
+
+def trigrams(token):
+    padded = f'${token}$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def ngrams(digits, n=PHONE_NGRAM):
+    return {digits[i:i + n] for i in range(len(digits) - n + 1)}
+
+
+def edit_distance(a, b, limit):
+    """Edit distance with adjacent transpositions, or limit + 1 once it exceeds limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (previous2 is not None and i > 1 and j > 1
+                    and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def _remove(index, term, doc):
+    """Drop doc from index[term]; True if that emptied the term"""
+    postings = index.get(term)
+    if postings is None:
+        return False
+    postings.discard(doc)
+    if postings:
+        return False
+    del index[term]
+    return True
+
+
+class PatientSearchIndex(MaterializedView):
+    """Ranked patient lookup by name prefix, phone digits and fuzzy name"""
+
+    def __init__(self, patients_db):
+        super().__init__(patients_db)
+
+    def reset(self):
+        self._doc_ids = {}       # patient id -> doc number
+        self._docs = {}          # doc number -> (patient id, name, tokens, phone digits)
+        self._next_doc = 0
+        self._tokens = {}        # name token -> doc numbers
+        self._vocabulary = []    # sorted name tokens, for prefix ranges
+        self._token_grams = {}   # trigram -> name tokens containing it
+        self._phone_grams = {}   # digit n-gram -> doc numbers
+
+    def apply(self, record, sign):
+        key = record.get('id')
+        if key is None:
+            return
+        if sign < 0:
+            self._unindex(key)
+        else:
+            self._unindex(key)
+            self._index(key, record)
+
+    def _index(self, key, record):
+        doc = self._next_doc
+        self._next_doc += 1
+        name = str(record.get('full_name') or '')
+        tokens = tuple(dict.fromkeys(tokenize(name)))
+        phone = digits_of(record.get('phone') or '')
+        self._doc_ids[key] = doc
+        self._docs[doc] = (key, normalize(name), tokens, phone)
+        for token in tokens:
+            postings = self._tokens.get(token)
+            if postings is None:
+                postings = self._tokens[token] = set()
+                bisect.insort(self._vocabulary, token)
+                for gram in trigrams(token):
+                    self._token_grams.setdefault(gram, set()).add(token)
+            postings.add(doc)
+        for gram in ngrams(phone):
+            self._phone_grams.setdefault(gram, set()).add(doc)
+
+    def _unindex(self, key):
+        doc = self._doc_ids.pop(key, None)
+        if doc is None:
+            return
+        _, _, tokens, phone = self._docs.pop(doc)
+        for token in tokens:
+            if _remove(self._tokens, token, doc):
+                i = bisect.bisect_left(self._vocabulary, token)
+                del self._vocabulary[i]
+                for gram in trigrams(token):
+                    _remove(self._token_grams, gram, token)
+        for gram in ngrams(phone):
+            _remove(self._phone_grams, gram, doc)
+
+    # Query side
+
+    def _word_matches(self, term):
+        """[(token, score)] for a query word: exact, then prefix, then fuzzy"""
+        matches = []
+        if term in self._tokens:
+            matches.append((term, EXACT_SCORE))
+        i = bisect.bisect_left(self._vocabulary, term)
+        while i < len(self._vocabulary) and self._vocabulary[i].startswith(term):
+            if self._vocabulary[i] != term:
+                matches.append((self._vocabulary[i], PREFIX_SCORE))
+            i += 1
+            if len(matches) >= SEARCH_MAX_CANDIDATES:
+                return matches
+        if len(term) >= FUZZY_MIN_LENGTH and term.isalpha():
+            limit = 1 if len(term) < 8 else 2
+            shared = Counter()
+            for gram in trigrams(term):
+                shared.update(self._token_grams.get(gram, ()))
+            # One edit changes at most four trigrams (a transposition), so a
+            # close enough token shares at least this many with the query
+            needed = len(term) - 4 * limit
+            candidates = {token for token, count in shared.items() if count >= needed}
+            if needed < 1:
+                # Short terms are not bounded that way ("jhon" shares no trigram
+                # with "john"): also try tokens with the same first letter, a
+                # length within limit and (each edit changing at most two
+                # letters of the set) a letter set close enough
+                letters = set(term)
+                start = bisect.bisect_left(self._vocabulary, term[0])
+                stop = bisect.bisect_left(self._vocabulary, chr(ord(term[0]) + 1), start)
+                for i in range(start, stop):
+                    token = self._vocabulary[i]
+                    if (abs(len(token) - len(term)) <= limit
+                            and len(letters.symmetric_difference(token)) <= 2 * limit):
+                        candidates.add(token)
+            fuzzy = []
+            for token in candidates:
+                if token.startswith(term):
+                    continue
+                distance = edit_distance(term, token, limit)
+                if distance <= limit:
+                    fuzzy.append((distance, token))
+            fuzzy.sort()
+            matches.extend((token, FUZZY_SCORE / distance) for distance, token in fuzzy)
+        return matches
+
+    def _term_matches(self, term):
+        """({token: score}, phone n-gram postings or None) for one query term"""
+        tokens = {}
+        for token, score in self._word_matches(term):
+            if tokens.get(token, 0) < score:
+                tokens[token] = score
+        phone = None
+        if term.isdigit() and len(term) >= PHONE_NGRAM:
+            phone = min((self._phone_grams.get(g, set()) for g in ngrams(term)), key=len)
+        return tokens, phone
+
+    def _score(self, doc, term, tokens, phone):
+        """Score of one patient for one query term, 0 if it does not match"""
+        _, _, doc_tokens, digits = self._docs[doc]
+        score = max([tokens.get(token, 0) for token in doc_tokens] or [0])
+        if phone is not None and term in digits:
+            score = max(score, PHONE_SCORE)
+        return score
+
+    def _search(self, query, limit):
+        text = normalize(query)
+        # A query of only digits and phone punctuation is one phone number
+        if not re.search(r'[a-z]', text) and len(digits_of(text)) >= PHONE_NGRAM:
+            terms = [digits_of(text)]
+        else:
+            terms = list(dict.fromkeys(TOKEN_RE.findall(text)))
+        if not terms:
+            return []
+
+        # Every term must match: intersect the other terms' postings, then walk
+        # those of the most selective term (exact matches first) for patients
+        # in all of them, so the candidate cap counts whole-query matches
+        terms = [(term, *self._term_matches(term)) for term in terms]
+        postings = []
+        for term, tokens, phone in terms:
+            docs = [self._tokens[token] for token in tokens]
+            if phone is not None:
+                docs.append(phone)
+            postings.append(docs)
+        sizes = [sum(map(len, docs)) for docs in postings]
+        selective = sizes.index(min(sizes))
+        others = None
+        for i, docs in enumerate(postings):
+            # Set operations on the other terms' postings filter faster than
+            # scoring each patient, unless the selective term is far rarer
+            if i != selective and sizes[selective] * 50 > sum(sizes) - sizes[selective]:
+                matching = set().union(*docs)
+                others = matching if others is None else others & matching
+        totals = {}
+        for docs in postings[selective]:
+            for doc in (docs if others is None else docs & others):
+                if doc in totals:
+                    continue
+                # Phone n-gram postings can hold numbers without the whole term
+                scores = [self._score(doc, *term) for term in terms]
+                if all(scores):
+                    totals[doc] = sum(scores)
+                    if len(totals) >= SEARCH_MAX_CANDIDATES:
+                        break
+            if len(totals) >= SEARCH_MAX_CANDIDATES:
+                break
+
+        best = heapq.nsmallest(limit, totals.items(),
+                               key=lambda item: (-item[1], self._docs[item[0]][1]))
+        return [(self._docs[doc][0], score) for doc, score in best]
+
+    def search(self, query, limit=SEARCH_DEFAULT_LIMIT):
+        """[(patient id, score)] best matches first, at most limit"""
+        return self.read(lambda index: index._search(query, limit))
+
+    def stats(self):
+        """Index sizes"""
+        return self.read(lambda index: {
+            "patients": len(index._docs),
+            "tokens": len(index._tokens),
+            "phone_ngrams": len(index._phone_grams),
+            "rebuilds": index.rebuilds
+        })
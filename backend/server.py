@@ -4,16 +4,47 @@ Hospital Management System - Main Server
 Handles all API endpoints and business logic
 """
 
+import argparse
+import base64
+import binascii
+import collections
 import json
 import os
 import hashlib
-import secrets
+import queue
+import select
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
 import uuid
-from datetime import datetime, timedelta
+import zlib
+from functools import partial
+from datetime import date, datetime, timedelta
+from email.utils import formatdate, parsedate_to_datetime
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 import re
 
+from storage import (load_db, save_db, db_exists, get_record, find_record,
+                     query_records, insert_record, insert_records, update_record,
+                     delete_record, transaction, db_version, cache_stats,
+                     IntegrityError, Query)
+from sessions import SessionManager
+from reports import Dashboard, TimeSeries, INTERVALS, csv_rows, to_decimal, to_number
+from search import PatientSearchIndex, SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT
+from scheduling import (ScheduleIndex, DEFAULT_HOURS, doctor_key, parse_time, format_time,
+                        validate as validate_appointment)
+from inventory import InventoryIndex, EXPIRY_WARNING_DAYS, dispense_quantities
+from notifications import NotificationQueue
+from router import Router, RequestContext
+from archive import ARCHIVE, ARCHIVE_POLICIES
+from fragments import FragmentCache, encode
+import metrics
+
 # Database file paths
 DB_DIR = 'database'
 USERS_DB = os.path.join(DB_DIR, 'users.json')
@@ -26,41 +57,254 @@ SETTINGS_DB = os.path.join(DB_DIR, 'settings.json')
 SESSIONS_DB = os.path.join(DB_DIR, 'sessions.json')
 NOTIFICATIONS_DB = os.path.join(DB_DIR, 'notifications.json')
 
+# Server configuration
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 16))
+SERVER_QUEUE_DEPTH = int(os.environ.get('SERVER_QUEUE_DEPTH', 128))
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 1))
+
+# List endpoint paging
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+
+# Query parameters accepted as equality filters on list endpoints
+LIST_FILTERS = ('status', 'doctor_id', 'patient_id')
+
+# Streamed responses are written in chunks of about this many bytes
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 64 * 1024))
+NDJSON = 'application/x-ndjson'
+
+# HTTP transport: idle keep-alive connections are closed after KEEPALIVE_TIMEOUT
+# seconds or KEEPALIVE_MAX_REQUESTS responses; bodies of at least
+# COMPRESS_MIN_SIZE bytes are compressed when the client accepts it
+KEEPALIVE_TIMEOUT = float(os.environ.get('KEEPALIVE_TIMEOUT', 5))
+KEEPALIVE_MAX_REQUESTS = int(os.environ.get('KEEPALIVE_MAX_REQUESTS', 100))
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+CORS_MAX_AGE = int(os.environ.get('CORS_MAX_AGE', 86400))
+
+# Time-series reports: default and maximum date range in days
+TIMESERIES_DEFAULT_DAYS = int(os.environ.get('TIMESERIES_DEFAULT_DAYS', 30))
+TIMESERIES_MAX_DAYS = int(os.environ.get('TIMESERIES_MAX_DAYS', 366 * 20))
+
+# Bulk import: most rows accepted in one request
+BULK_MAX_ROWS = int(os.environ.get('BULK_MAX_ROWS', 500000))
+
+# Fields every new record starts with, per collection (the request body overrides them)
+RECORD_DEFAULTS = {
+    'appointments': {"status": "scheduled"},
+    'billing': {"status": "pending"},
+}
+
 # Initialize database directory
 os.makedirs(DB_DIR, exist_ok=True)
 
-# Database helper functions
-def load_db(db_path, default=None):
-    """Load database from JSON file"""
-    if default is None:
-        default = []
-    if not os.path.exists(db_path):
-        return default
+def encode_cursor(after):
+    """Opaque page cursor for a (created_at, key) position"""
+    raw = json.dumps(list(after), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(created_at, key) from a page cursor; raises ValueError if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        after = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError('invalid cursor') from e
+    if (not isinstance(after, list) or len(after) != 2
+            or not all(isinstance(part, str) for part in after)):
+        raise ValueError('invalid cursor')
+    return tuple(after)
+
+
+def list_query(params, equals=None):
+    """Build a storage Query from list endpoint query parameters"""
+    def single(name):
+        values = params.get(name)
+        return values[-1] if values else None
+
+    filters = dict(equals or {})
+    for field in LIST_FILTERS:
+        value = single(field)
+        if value is not None and field not in filters:
+            filters[field] = value
+
+    limit = single('limit')
+    cursor = single('cursor')
+    if limit is not None:
+        if not limit.isdigit() or int(limit) < 1:
+            raise ValueError('limit must be a positive integer')
+        limit = min(int(limit), MAX_PAGE_SIZE)
+    elif cursor is not None:
+        limit = DEFAULT_PAGE_SIZE
+
+    return Query(equals=filters, date_from=single('date_from'), date_to=single('date_to'),
+                 after=decode_cursor(cursor) if cursor is not None else None, limit=limit)
+
+
+def new_record(resource, body, user):
+    """A record for a create request: generated id and audit fields, then the body"""
+    record = {"id": str(uuid.uuid4()), "created_at": datetime.now().isoformat()}
+    if resource == 'prescriptions':
+        record["doctor_id"] = user.get('id')
+    elif resource != 'pharmacy':
+        record["created_by"] = user.get('id')
+    return {**record, **RECORD_DEFAULTS.get(resource, {}), **body}
+
+
+def update_changes(body):
+    """Changes for an update request: the body without its id, and updated_at"""
+    changes = {k: v for k, v in body.items() if k != 'id'}
+    changes['updated_at'] = datetime.now().isoformat()
+    return changes
+
+
+def report_range(params, today):
+    """(first, last, interval) from from/to/interval query parameters; dates as ordinals"""
+    def single(name):
+        values = params.get(name)
+        return values[-1] if values else None
+
     try:
-        with open(db_path, 'r') as f:
-            return json.load(f)
-    except:
-        return default
+        last = date.fromisoformat(single('to')) if single('to') else today
+        first = (date.fromisoformat(single('from')) if single('from')
+                 else last - timedelta(days=TIMESERIES_DEFAULT_DAYS - 1))
+    except ValueError:
+        raise ValueError('dates must be YYYY-MM-DD')
+    if first > last:
+        raise ValueError("'from' must not be after 'to'")
+    if (last - first).days >= TIMESERIES_MAX_DAYS:
+        raise ValueError(f'range is limited to {TIMESERIES_MAX_DAYS} days')
+    interval = single('interval') or 'day'
+    if interval not in INTERVALS:
+        raise ValueError(f"interval must be one of {', '.join(INTERVALS)}")
+    return first.toordinal(), last.toordinal(), interval
+
+
+def accepted_encoding(accept_encoding):
+    """'gzip', 'deflate' or None for an Accept-Encoding header value"""
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    for encoding in ('gzip', 'deflate'):
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def compressor(encoding):
+    """Streaming compressor for a Content-Encoding"""
+    # wbits 31 writes a gzip container, 15 the zlib format HTTP calls deflate
+    return zlib.compressobj(6, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if if_none_match.strip() == '*':
+        return True
+    opaque = _opaque_tag(etag)
+    return any(_opaque_tag(tag.strip()) == opaque for tag in if_none_match.split(','))
+
+
+def _opaque_tag(tag):
+    return tag[2:] if tag.startswith('W/') else tag
+
+
+def project(record, fields):
+    """Copy of record with only the given fields"""
+    return {f: record[f] for f in fields if f in record}
 
-def save_db(db_path, data):
-    """Save database to JSON file"""
-    with open(db_path, 'w') as f:
-        json.dump(data, f, indent=2)
 
 def hash_password(password):
     """Hash password using SHA256"""
     return hashlib.sha256(password.encode()).hexdigest()
 
-def generate_token():
-    """Generate secure random token"""
-    return secrets.token_urlsafe(32)
+# Every role; the route table lists narrower sets inline
+ALL_STAFF = ['admin', 'doctor', 'nurse', 'receptionist']
+
+# Per-patient history endpoints: resource -> (collection, allowed roles)
+PATIENT_HISTORY = {
+    'appointments': (APPOINTMENTS_DB, ['admin', 'doctor', 'nurse', 'receptionist']),
+    'billing': (BILLING_DB, ['admin', 'receptionist']),
+    'prescriptions': (PRESCRIPTIONS_DB, ['admin', 'doctor', 'nurse'])
+}
+
+# Bulk import/export: resource -> (collection, roles that may export, roles that may import)
+BULK_COLLECTIONS = {
+    'patients': (PATIENTS_DB, ['admin', 'doctor', 'nurse', 'receptionist'], ['admin', 'receptionist']),
+    'appointments': (APPOINTMENTS_DB, ['admin', 'doctor', 'nurse', 'receptionist'],
+                     ['admin', 'receptionist', 'doctor']),
+    'billing': (BILLING_DB, ['admin', 'receptionist'], ['admin', 'receptionist']),
+    'pharmacy': (PHARMACY_DB, ['admin', 'doctor', 'nurse'], ['admin']),
+    'prescriptions': (PRESCRIPTIONS_DB, ['admin', 'doctor', 'nurse'], ['admin', 'doctor'])
+}
+
+# Login sessions (token -> user lookups and expiry sweeping)
+SESSIONS = SessionManager(SESSIONS_DB, USERS_DB)
+
+# Dashboard totals and daily rollups, maintained as appointments and bills change
+DASHBOARD = Dashboard(PATIENTS_DB, APPOINTMENTS_DB, BILLING_DB)
+TIMESERIES = TimeSeries(APPOINTMENTS_DB, BILLING_DB)
+
+# Patient name/phone search
+SEARCH = PatientSearchIndex(PATIENTS_DB)
+
+# Booked appointment slots per doctor and day
+SCHEDULE = ScheduleIndex(APPOINTMENTS_DB)
+
+# Pharmacy low-stock and expiry indexes
+INVENTORY = InventoryIndex(PHARMACY_DB)
+
+# Outgoing WhatsApp notifications, sent by whatsapp_service.py
+NOTIFICATIONS = NotificationQueue(NOTIFICATIONS_DB)
+
+# Records already encoded as JSON, joined into list responses
+FRAGMENTS = FragmentCache()
+
+# Collections whose old, finished records move to monthly archive segments
+ARCHIVED_COLLECTIONS = [os.path.join(DB_DIR, name) for name in ARCHIVE_POLICIES]
+
+# Time-series report -> collection it is built from
+TIMESERIES_REPORTS = {
+    'revenue': BILLING_DB,
+    'appointments': APPOINTMENTS_DB,
+    'billing-aging': BILLING_DB
+}
+
+# Instrumentation (served at /api/metrics)
+HTTP_REQUESTS = metrics.counter('hms_http_requests_total', 'HTTP requests by route and status',
+                                ('method', 'route', 'status'))
+HTTP_SECONDS = metrics.histogram('hms_http_request_duration_seconds',
+                                 'Time from request line to response sent', ('method', 'route'))
+AUTH_SECONDS = metrics.histogram('hms_auth_seconds', 'Resolving a bearer token to a user',
+                                 span='auth')
+ENCODE_SECONDS = metrics.histogram('hms_json_encode_seconds', 'Encoding JSON response bodies',
+                                   span='encode')
+metrics.gauge('hms_notification_queue_depth', 'Notification queue entries by status',
+              NOTIFICATIONS.stats, ('status',))
+metrics.gauge('hms_sessions_active', 'Active login sessions', lambda: SESSIONS.stats()['active'])
+metrics.gauge('hms_storage_cache_events', 'Collection cache counters since start',
+              lambda: {k: v for k, v in cache_stats().items() if isinstance(v, int)}, ('event',))
+metrics.gauge('hms_fragment_cache_events', 'Encoded record cache lookups and evictions since start',
+              lambda: {k: v for k, v in FRAGMENTS.stats().items()
+                       if k in ('hits', 'misses', 'evictions')}, ('event',))
+metrics.gauge('hms_fragment_cache_bytes', 'Bytes of encoded and decoded records held by the cache',
+              lambda: FRAGMENTS.stats()['bytes'])
+
 
 # Initialize default data
 def initialize_database():
     """Initialize database with default data"""
     
     # Initialize settings with all features enabled by default
-    if not os.path.exists(SETTINGS_DB):
+    if not db_exists(SETTINGS_DB):
         default_settings = {
             "features": {
                 "patient_management": True,
@@ -75,6 +319,7 @@ def initialize_database():
             },
             "whatsapp": {
                 "api_key": "",
+                "api_url": "",
                 "phone_number": "",
                 "enabled": False
             },
@@ -82,12 +327,13 @@ def initialize_database():
                 "hospital_name": "General Hospital",
                 "timezone": "UTC",
                 "currency": "USD"
-            }
+            },
+            "scheduling": dict(DEFAULT_HOURS)
         }
         save_db(SETTINGS_DB, default_settings)
     
     # Initialize users with default admin
-    if not os.path.exists(USERS_DB):
+    if not db_exists(USERS_DB):
         default_admin = {
             "id": str(uuid.uuid4()),
             "username": "admin",
@@ -104,494 +350,849 @@ def initialize_database():
     # Initialize other databases
     for db_path in [PATIENTS_DB, APPOINTMENTS_DB, BILLING_DB, PHARMACY_DB, 
                     PRESCRIPTIONS_DB, SESSIONS_DB, NOTIFICATIONS_DB]:
-        if not os.path.exists(db_path):
+        if not db_exists(db_path):
             save_db(db_path, [])
 
 class HospitalAPIHandler(BaseHTTPRequestHandler):
     """HTTP Request Handler for Hospital Management System"""
+
+    # HTTP/1.1: persistent connections and chunked transfer encoding
+    protocol_version = 'HTTP/1.1'
+
+    # Socket timeout; also how long an idle keep-alive connection is kept
+    timeout = KEEPALIVE_TIMEOUT
+
+    # Headers and body go out in separate writes; with Nagle's algorithm the
+    # body waits for the client's delayed ACK (~40 ms per keep-alive request)
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        resumed = getattr(self.server, 'resumed', None)
+        self._served = resumed(self.request) if resumed else 0
+        self._started = None
+        self.idle = None
+
+    def handle(self):
+        # A pooled server watches idle connections itself: serve what the client
+        # sends (within the server's linger time), then return the worker thread
+        if not hasattr(self.server, 'resumed'):
+            return super().handle()
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._request_waiting():
+            self.handle_one_request()
+        # Responses sent so far if the connection stays open
+        self.idle = None if self.close_connection else self._served
+
+    def _request_waiting(self):
+        """Whether more of the client's input arrives within the server's linger time"""
+        # Pipelined requests may already sit in rfile's buffer, out of sight of select()
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except OSError:
+            self.close_connection = True
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+        linger = self.server.linger()
+        return bool(linger and select.select([self.connection], [], [], linger)[0])
+
+    def parse_request(self):
+        # Request timing starts once the request line is in, so time spent
+        # idle on a keep-alive connection is not counted
+        self._started = time.perf_counter()
+        self._status = None
+        self._route = None
+        self._body_read = False
+        # Until the request line parses (error responses are still recorded)
+        self.path = ''
+        metrics.begin_request()
+        return super().parse_request()
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        finally:
+            if self._started is not None:
+                self._record_request()
+
+    def _record_request(self):
+        """Update request metrics and write the slow-request log line"""
+        elapsed = time.perf_counter() - self._started
+        self._started = None
+        spans = metrics.end_request()
+        if self._status is None:
+            return
+        # Route pattern, so record ids do not become label values
+        route = self._route or ROUTER.pattern(urlparse(self.path).path) or 'unmatched'
+        method = self.command or '-'
+        HTTP_REQUESTS.inc(method, route, str(self._status))
+        HTTP_SECONDS.observe(elapsed, method, route)
+        if metrics.SLOW_REQUEST_MS and elapsed * 1000 >= metrics.SLOW_REQUEST_MS:
+            print(f"SLOW {elapsed * 1000:.1f}ms {method} {self.path} {self._status} "
+                  f"{metrics.format_spans(spans)}".rstrip(), flush=True)
+
+    def log_error(self, format, *args):
+        # An idle keep-alive connection timing out is not an error
+        if self._served and format.startswith('Request timed out'):
+            return
+        super().log_error(format, *args)
+
+    def _keep_alive(self):
+        """Whether the connection can stay open after this response"""
+        if self._served >= KEEPALIVE_MAX_REQUESTS:
+            return False
+        # Anything left of an unread request body would be parsed as the next request
+        return self._body_read or self.headers.get('Content-Length', '0') == '0'
     
-    def _set_headers(self, status=200, content_type='application/json'):
-        """Set response headers"""
+    def _set_headers(self, status=200, content_type='application/json', length=None,
+                     headers=None):
+        """Set response headers (chunked transfer encoding if length is None)"""
+        self._served += 1
+        # HTTP/1.0 clients do not know chunked encoding: a body of unknown
+        # length is sent as is and ends when the connection closes
+        self._chunked = length is None and self.request_version >= 'HTTP/1.1'
+        unframed = length is None and not self._chunked and status != 304
         self.send_response(status)
-        self.send_header('Content-Type', content_type)
+        if status != 304:
+            self.send_header('Content-Type', content_type)
+            if self._chunked:
+                self.send_header('Transfer-Encoding', 'chunked')
+            elif length is not None:
+                self.send_header('Content-Length', str(length))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Vary', 'Accept, Accept-Encoding, Authorization')
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        if unframed or not self._keep_alive():
+            self.send_header('Connection', 'close')
         self.end_headers()
     
     def do_OPTIONS(self):
         """Handle CORS preflight requests"""
-        self._set_headers()
+        self._set_headers(length=0, headers={'Access-Control-Max-Age': str(CORS_MAX_AGE)})
+
+    def _encoding(self):
+        return accepted_encoding(self.headers.get('Accept-Encoding'))
     
-    def _send_json(self, data, status=200):
-        """Send JSON response"""
-        self._set_headers(status)
-        self.wfile.write(json.dumps(data).encode())
+    def _send_json(self, data, status=200, headers=None):
+        """Send JSON response (compressed if large and the client accepts it)"""
+        with ENCODE_SECONDS.time():
+            body = json.dumps(data).encode()
+        self._send_encoded(body, status, headers)
+
+    def _send_encoded(self, body, status=200, headers=None):
+        """Send an already encoded JSON body (compressed if large and the client accepts it)"""
+        encoding = self._encoding() if len(body) >= COMPRESS_MIN_SIZE else None
+        if encoding:
+            compress = compressor(encoding)
+            body = compress.compress(body) + compress.flush()
+            headers = {**(headers or {}), 'Content-Encoding': encoding}
+        self._set_headers(status, length=len(body), headers=headers)
+        self.wfile.write(body)
+
+    def _not_modified(self, db_paths, extra=()):
+        """Validator headers for a response built from db_paths.
+
+        Returns (headers, sent): sent is True when the client's copy is still
+        current and a 304 has already been sent instead of the body.
+        """
+        # Read versions before the data so a concurrent write can only make the
+        # tag older than the body, never newer
+        versions = [db_version(p) for p in db_paths]
+        key = repr((self.path, self.headers.get('Accept', ''), extra,
+                    [tag for tag, _ in versions]))
+        etag = 'W/"%s"' % hashlib.sha1(key.encode()).hexdigest()[:24]
+        modified = max((m for _, m in versions), default=0)
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        # Last-Modified has one-second resolution; only send it once that
+        # second is over, so a later write always gets a later date
+        if modified and not extra and time.time() >= int(modified) + 1:
+            headers['Last-Modified'] = formatdate(int(modified), usegmt=True)
+
+        if_none_match = self.headers.get('If-None-Match')
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_none_match is not None:
+            fresh = etag_matches(if_none_match, etag)
+        elif if_modified_since and 'Last-Modified' in headers:
+            try:
+                fresh = int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                fresh = False
+        else:
+            fresh = False
+
+        if fresh:
+            self._set_headers(304, headers=headers)
+        return headers, fresh
+
+    def _write_chunk(self, data):
+        if data:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data) if self._chunked else data)
+
+    def _stream(self, pieces, content_type='application/json', status=200, headers=None):
+        """Send an iterable of bytes pieces as a chunked response.
+
+        Pieces are buffered up to STREAM_CHUNK_SIZE, so memory stays bounded
+        by the chunk size rather than the response size. HTTP/1.0 clients get
+        the body unframed, ended by closing the connection.
+        """
+        encoding = self._encoding()
+        if encoding:
+            headers = {**(headers or {}), 'Content-Encoding': encoding}
+            compress = compressor(encoding)
+        self._set_headers(status, content_type, headers=headers)
+        buffer, size = [], 0
+        try:
+            for data in pieces:
+                buffer.append(data)
+                size += len(data)
+                if size >= STREAM_CHUNK_SIZE:
+                    data = b''.join(buffer)
+                    self._write_chunk(compress.compress(data) if encoding else data)
+                    buffer, size = [], 0
+            data = b''.join(buffer)
+            if encoding:
+                data = compress.compress(data) + compress.flush()
+            self._write_chunk(data)
+            if self._chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away mid-response
+            self.close_connection = True
+
+    def _stream_json(self, fragments, status=200, headers=None):
+        """Stream encoded records as a JSON array"""
+        def pieces():
+            yield b'['
+            first = True
+            for fragment in fragments:
+                yield fragment if first else b', ' + fragment
+                first = False
+            yield b']'
+        self._stream(pieces(), status=status, headers=headers)
+
+    def _stream_ndjson(self, fragments, headers=None):
+        """Stream encoded records as newline-delimited JSON, one record per line"""
+        self._stream((fragment + b'\n' for fragment in fragments), NDJSON, headers=headers)
+
+    def _send_records(self, db_path, records, omit=()):
+        """Send records of db_path as a JSON array, reusing their cached encodings"""
+        with ENCODE_SECONDS.time():
+            body = b'[%s]' % b', '.join(FRAGMENTS.fragment(db_path, r, omit) for r in records)
+        self._send_encoded(body)
+
+    def _wants_ndjson(self):
+        return NDJSON in self.headers.get('Accept', '')
+    
+    def _send_list(self, db_path, equals=None):
+        """Send a filtered, optionally paged and projected list of records"""
+        params = parse_qs(urlparse(self.path).query)
+        try:
+            q = list_query(params, equals)
+        except ValueError as e:
+            self._send_json({"error": str(e)}, 400)
+            return
+        # include_archived=1 also reads the cold segments the date range overlaps
+        archived = params.get('include_archived', [''])[-1] in ('1', 'true')
+        headers, sent = self._not_modified(
+            [db_path], extra=(ARCHIVE.version(db_path),) if archived else ())
+        if sent:
+            return
+        if archived:
+            records, next_after = ARCHIVE.query(db_path, q)
+        else:
+            records, next_after = query_records(db_path, q)
+
+        fields = [f for v in params.get('fields', []) for f in v.split(',') if f]
+        if fields:
+            fragments = (encode(project(r, fields)) for r in records)
+        else:
+            fragments = (FRAGMENTS.fragment(db_path, r) for r in records)
+
+        if self._wants_ndjson():
+            # Paging details travel in headers so the body stays one record per line
+            if next_after:
+                headers['X-Next-Cursor'] = encode_cursor(next_after)
+            self._stream_ndjson(fragments, headers)
+        elif q.paged:
+            # Same bytes as json.dumps of {"items": [...], "next_cursor": ..., "limit": ...}
+            with ENCODE_SECONDS.time():
+                body = b'{"items": [%s], %s' % (b', '.join(fragments), json.dumps({
+                    "next_cursor": encode_cursor(next_after) if next_after else None,
+                    "limit": q.limit
+                }).encode()[1:])
+            self._send_encoded(body, headers=headers)
+        else:
+            self._stream_json(fragments, headers=headers)
     
     def _get_body(self):
-        """Get request body"""
+        """Request body as a JSON object; raises ValueError if it is not one"""
         content_length = int(self.headers.get('Content-Length', 0))
         body = self.rfile.read(content_length)
-        return json.loads(body.decode()) if body else {}
-    
+        self._body_read = True
+        data = json.loads(body) if body else {}
+        if not isinstance(data, dict):
+            raise ValueError('body must be a JSON object')
+        return data
+
     def _get_auth_token(self):
         """Extract auth token from Authorization header"""
         auth_header = self.headers.get('Authorization', '')
         if auth_header.startswith('Bearer '):
             return auth_header[7:]
         return None
-    
+
     def _verify_token(self, token):
         """Verify authentication token"""
-        if not token:
-            return None
-        sessions = load_db(SESSIONS_DB, [])
-        for session in sessions:
-            if session.get('token') == token:
-                # Check if session is still valid (24 hours)
-                created_at = datetime.fromisoformat(session.get('created_at'))
-                if datetime.now() - created_at < timedelta(hours=24):
-                    return session.get('user_id')
-        return None
-    
-    def _get_current_user(self):
-        """Get current authenticated user"""
-        token = self._get_auth_token()
-        user_id = self._verify_token(token)
-        if not user_id:
-            return None
-        users = load_db(USERS_DB, [])
-        for user in users:
-            if user.get('id') == user_id:
-                return user
-        return None
-    
-    def _check_permission(self, required_roles):
-        """Check if current user has required role"""
-        user = self._get_current_user()
-        if not user:
-            return False
-        return user.get('role') in required_roles
-    
-    def do_GET(self):
-        """Handle GET requests"""
-        parsed_path = urlparse(self.path)
-        path = parsed_path.path
-        
-        # Public endpoints
-        if path == '/api/health':
-            self._send_json({"status": "healthy"})
-            return
-        
-        # Authentication required endpoints
-        user = self._get_current_user()
-        if not user:
-            self._send_json({"error": "Unauthorized"}, 401)
-            return
-        
-        # User info
-        if path == '/api/auth/me':
-            user_copy = user.copy()
-            user_copy.pop('password', None)
-            self._send_json(user_copy)
-            return
-        
-        # Patients
-        if path == '/api/patients':
-            if self._check_permission(['admin', 'doctor', 'nurse', 'receptionist']):
-                patients = load_db(PATIENTS_DB, [])
-                self._send_json(patients)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
-            return
-        
-        if path.startswith('/api/patients/'):
-            patient_id = path.split('/')[-1]
-            if self._check_permission(['admin', 'doctor', 'nurse', 'receptionist']):
-                patients = load_db(PATIENTS_DB, [])
-                patient = next((p for p in patients if p.get('id') == patient_id), None)
-                if patient:
-                    self._send_json(patient)
-                else:
-                    self._send_json({"error": "Patient not found"}, 404)
+        return SESSIONS.verify(token)
+
+    def _dispatch(self):
+        """Match the route, resolve the user once, check the route's roles and run it"""
+        parsed = urlparse(self.path)
+        route, params = ROUTER.match(self.command, parsed.path)
+        if route is None:
+            if params:
+                self._send_json({"error": "Method not allowed"}, 405,
+                                headers={'Allow': ', '.join(params + ['OPTIONS'])})
             else:
-                self._send_json({"error": "Forbidden"}, 403)
+                self._send_json({"error": "Not found"}, 404)
             return
-        
-        # Appointments
-        if path == '/api/appointments':
-            if self._check_permission(['admin', 'doctor', 'nurse', 'receptionist']):
-                appointments = load_db(APPOINTMENTS_DB, [])
-                self._send_json(appointments)
-            else:
+        self._route = route.pattern
+        ctx = RequestContext(route, params, parsed.query)
+
+        # Read the body before answering, so the connection stays usable
+        # whatever the answer (raw_body routes read it themselves)
+        if self.command in ('POST', 'PUT') and not route.raw_body:
+            try:
+                ctx.body = self._get_body()
+            except ValueError as e:
+                self._send_json({"error": f"Invalid request: {e}"}, 400)
+                return
+
+        if not route.public:
+            ctx.token = self._get_auth_token()
+            with AUTH_SECONDS.time():
+                ctx.user = SESSIONS.user_for_token(ctx.token)
+            if not ctx.user:
+                self._send_json({"error": "Unauthorized"}, 401)
+                return
+            if not route.allows(ctx.user):
                 self._send_json({"error": "Forbidden"}, 403)
+                return
+        route.handler(self, ctx)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+    # GET handlers
+
+    def _health(self, ctx):
+        self._send_json({"status": "healthy"})
+
+    def _me(self, ctx):
+        user_copy = ctx.user.copy()
+        user_copy.pop('password', None)
+        self._send_json(user_copy)
+
+    def _list(self, ctx, db_path):
+        self._send_list(db_path)
+
+    def _search_patients(self, ctx):
+        """Patient search: /api/patients/search?q=...&limit=..."""
+        query = ctx.query.get('q', [''])[-1]
+        limit = ctx.query.get('limit', [str(SEARCH_DEFAULT_LIMIT)])[-1]
+        if not limit.isdigit() or int(limit) < 1:
+            self._send_json({"error": "limit must be a positive integer"}, 400)
             return
-        
-        # Billing
-        if path == '/api/billing':
-            if self._check_permission(['admin', 'receptionist']):
-                billing = load_db(BILLING_DB, [])
-                self._send_json(billing)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
+        matches = SEARCH.search(query, min(int(limit), SEARCH_MAX_LIMIT))
+        patients = [get_record(PATIENTS_DB, key) for key, _ in matches]
+        self._send_records(PATIENTS_DB, [p for p in patients if p is not None])
+
+    def _get_patient(self, ctx):
+        patient = get_record(PATIENTS_DB, ctx.params['id'])
+        if patient:
+            self._send_json(patient)
+        else:
+            self._send_json({"error": "Patient not found"}, 404)
+
+    def _patient_history(self, ctx, db_path):
+        """A patient's appointments, bills or prescriptions"""
+        if get_record(PATIENTS_DB, ctx.params['id']):
+            self._send_list(db_path, {'patient_id': ctx.params['id']})
+        else:
+            self._send_json({"error": "Patient not found"}, 404)
+
+    def _low_stock(self, ctx):
+        """Items at or below their reorder level, lowest stock first"""
+        limit = ctx.query.get('limit', [''])[-1]
+        if limit and (not limit.isdigit() or int(limit) < 1):
+            self._send_json({"error": "limit must be a positive integer"}, 400)
             return
-        
-        # Pharmacy
-        if path == '/api/pharmacy':
-            if self._check_permission(['admin', 'doctor', 'nurse']):
-                pharmacy = load_db(PHARMACY_DB, [])
-                self._send_json(pharmacy)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
+        entries = INVENTORY.low_stock(int(limit) if limit else None)
+        self._send_records(PHARMACY_DB, self._pharmacy_items(entries))
+
+    def _expiring(self, ctx):
+        """Items expired or expiring within ?days=, soonest first"""
+        days = ctx.query.get('days', [str(EXPIRY_WARNING_DAYS)])[-1]
+        limit = ctx.query.get('limit', [''])[-1]
+        if not days.isdigit() or (limit and (not limit.isdigit() or int(limit) < 1)):
+            self._send_json({"error": "days and limit must be positive integers"}, 400)
             return
-        
-        # Prescriptions
-        if path == '/api/prescriptions':
-            if self._check_permission(['admin', 'doctor', 'nurse']):
-                prescriptions = load_db(PRESCRIPTIONS_DB, [])
-                self._send_json(prescriptions)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
+        last = min(date.today().toordinal() + int(days), date.max.toordinal())
+        entries = INVENTORY.expiring(last, int(limit) if limit else None)
+        self._send_records(PHARMACY_DB, self._pharmacy_items(entries))
+
+    def _get_settings(self, ctx):
+        self._send_json(load_db(SETTINGS_DB, {}))
+
+    def _list_users(self, ctx):
+        # Passwords are left out of the cached encodings
+        self._send_records(USERS_DB, load_db(USERS_DB, []), omit=('password',))
+
+    def _metrics(self, ctx):
+        body = metrics.render().encode()
+        self._set_headers(200, metrics.CONTENT_TYPE, length=len(body))
+        self.wfile.write(body)
+
+    def _system_stats(self, ctx):
+        self._send_json({
+            "storage": cache_stats(),
+            "sessions": SESSIONS.stats(),
+            "reports": {**DASHBOARD.stats(), **TIMESERIES.stats()},
+            "search": SEARCH.stats(),
+            "inventory": INVENTORY.stats(),
+            "notifications": NOTIFICATIONS.stats(),
+            "archive": ARCHIVE.stats(),
+            "responses": FRAGMENTS.stats()
+        })
+
+    def _dashboard(self, ctx):
+        today = datetime.now().strftime('%Y-%m-%d')
+        headers, sent = self._not_modified([PATIENTS_DB, APPOINTMENTS_DB, BILLING_DB],
+                                           extra=(today,))
+        if sent:
             return
-        
-        # Settings (Admin only)
-        if path == '/api/settings':
-            if self._check_permission(['admin']):
-                settings = load_db(SETTINGS_DB, {})
-                self._send_json(settings)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
+        self._send_json(DASHBOARD.report(today), headers=headers)
+
+    def _read_rows(self):
+        """Records of a bulk request body: a JSON array, or NDJSON (one record per line).
+
+        Returns (rows, errors) where errors maps 1-based row numbers to
+        messages for NDJSON lines that are not valid JSON. Raises ValueError
+        if the body is not a JSON array at all. NDJSON is read no further than
+        BULK_MAX_ROWS + 1 rows.
+        """
+        length = int(self.headers.get('Content-Length', 0))
+        self._body_read = True
+        if NDJSON not in self.headers.get('Content-Type', ''):
+            try:
+                rows = json.loads(self.rfile.read(length) or b'[]')
+            except ValueError:
+                raise ValueError('body must be a JSON array or NDJSON')
+            if not isinstance(rows, list):
+                raise ValueError('body must be a JSON array or NDJSON')
+            return rows, {}
+
+        rows, errors = [], {}
+        remaining = length
+        while remaining > 0:
+            line = self.rfile.readline(remaining)
+            if not line:
+                break
+            remaining -= len(line)
+            if not line.strip():
+                continue
+            if len(rows) == BULK_MAX_ROWS:
+                # Already too many; the rest of the body is left unread, which
+                # closes the connection after the response
+                rows.append(None)
+                self._body_read = False
+                break
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                rows.append(None)
+                errors[len(rows)] = "invalid JSON"
+        return rows, errors
+
+    def _bulk_import(self, ctx, resource):
+        """Validate and insert many records in one storage write, reporting errors per row"""
+        db_path = BULK_COLLECTIONS[resource][0]
+        user = ctx.user
+        try:
+            rows, errors = self._read_rows()
+        except ValueError as e:
+            self._send_json({"error": str(e)}, 400)
             return
-        
-        # Users (Admin only)
-        if path == '/api/users':
-            if self._check_permission(['admin']):
-                users = load_db(USERS_DB, [])
-                # Remove passwords from response
-                users_safe = []
-                for u in users:
-                    u_copy = u.copy()
-                    u_copy.pop('password', None)
-                    users_safe.append(u_copy)
-                self._send_json(users_safe)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
+        if len(rows) > BULK_MAX_ROWS:
+            self._send_json({"error": f"at most {BULK_MAX_ROWS} rows per request"}, 413)
             return
-        
-        # Reports
-        if path == '/api/reports/dashboard':
-            if self._check_permission(['admin', 'doctor']):
-                patients = load_db(PATIENTS_DB, [])
-                appointments = load_db(APPOINTMENTS_DB, [])
-                billing = load_db(BILLING_DB, [])
-                
-                report = {
-                    "total_patients": len(patients),
-                    "total_appointments": len(appointments),
-                    "today_appointments": len([a for a in appointments if a.get('date') == datetime.now().strftime('%Y-%m-%d')]),
-                    "total_revenue": sum([b.get('amount', 0) for b in billing]),
-                    "pending_bills": len([b for b in billing if b.get('status') == 'pending'])
-                }
-                self._send_json(report)
+        atomic = ctx.query.get('atomic', [''])[-1] in ('1', 'true')
+
+        records, seen = [], set()
+        for row, body in enumerate(rows, 1):
+            if row in errors:
+                continue
+            if not isinstance(body, dict):
+                errors[row] = "row must be a JSON object"
+                continue
+            record = new_record(resource, body, user)
+            key = record.get('id')
+            error = validate_appointment(record) if resource == 'appointments' else None
+            if not isinstance(key, str) or not key:
+                errors[row] = "id must be a non-empty string"
+            elif key in seen:
+                errors[row] = f"duplicate id '{key}' in this request"
+            elif error:
+                errors[row] = error
             else:
-                self._send_json({"error": "Forbidden"}, 403)
-            return
-        
-        self._send_json({"error": "Not found"}, 404)
-    
-    def do_POST(self):
-        """Handle POST requests"""
-        path = self.path
-        body = self._get_body()
-        
-        # Login (public)
-        if path == '/api/auth/login':
-            username = body.get('username')
-            password = body.get('password')
-            
-            users = load_db(USERS_DB, [])
-            user = next((u for u in users if u.get('username') == username), None)
-            
-            if user and user.get('password') == hash_password(password):
-                if not user.get('active', True):
-                    self._send_json({"error": "Account disabled"}, 403)
+                seen.add(key)
+                records.append((row, record))
+
+        inserted = 0
+        with transaction(db_path):
+            accepted = []
+            for row, record in records:
+                if get_record(db_path, record['id']) is not None:
+                    errors[row] = f"id '{record['id']}' already exists"
+                else:
+                    accepted.append((row, record))
+            if resource == 'appointments':
+                clashes = SCHEDULE.conflicts_many([record for _, record in accepted])
+                for (row, _), clash in zip(accepted, clashes):
+                    if clash:
+                        errors[row] = f"doctor is already booked at that time ({', '.join(clash)})"
+                accepted = [(row, record) for row, record in accepted if row not in errors]
+            if accepted and not (atomic and errors):
+                try:
+                    insert_records(db_path, [record for _, record in accepted])
+                except IntegrityError as e:
+                    self._send_json({"error": str(e)}, 409)
                     return
-                
-                # Create session
-                token = generate_token()
-                sessions = load_db(SESSIONS_DB, [])
-                session = {
-                    "token": token,
-                    "user_id": user.get('id'),
-                    "created_at": datetime.now().isoformat()
-                }
-                sessions.append(session)
-                save_db(SESSIONS_DB, sessions)
-                
-                user_copy = user.copy()
-                user_copy.pop('password', None)
-                
-                self._send_json({
-                    "token": token,
-                    "user": user_copy
-                })
-            else:
-                self._send_json({"error": "Invalid credentials"}, 401)
-            return
-        
-        # All other endpoints require authentication
-        user = self._get_current_user()
-        if not user:
-            self._send_json({"error": "Unauthorized"}, 401)
-            return
-        
-        # Logout
-        if path == '/api/auth/logout':
-            token = self._get_auth_token()
-            sessions = load_db(SESSIONS_DB, [])
-            sessions = [s for s in sessions if s.get('token') != token]
-            save_db(SESSIONS_DB, sessions)
-            self._send_json({"message": "Logged out successfully"})
-            return
-        
-        # Create patient
-        if path == '/api/patients':
-            if self._check_permission(['admin', 'receptionist']):
-                patients = load_db(PATIENTS_DB, [])
-                patient = {
-                    "id": str(uuid.uuid4()),
-                    "created_at": datetime.now().isoformat(),
-                    "created_by": user.get('id'),
-                    **body
-                }
-                patients.append(patient)
-                save_db(PATIENTS_DB, patients)
-                self._send_json(patient, 201)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
-            return
-        
-        # Create appointment
-        if path == '/api/appointments':
-            if self._check_permission(['admin', 'receptionist', 'doctor']):
-                appointments = load_db(APPOINTMENTS_DB, [])
-                appointment = {
-                    "id": str(uuid.uuid4()),
-                    "created_at": datetime.now().isoformat(),
-                    "created_by": user.get('id'),
-                    "status": "scheduled",
-                    **body
-                }
-                appointments.append(appointment)
-                save_db(APPOINTMENTS_DB, appointments)
-                
-                # Send WhatsApp notification if enabled
-                self._send_whatsapp_notification(appointment, 'appointment_scheduled')
-                
-                self._send_json(appointment, 201)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
-            return
-        
-        # Create billing
-        if path == '/api/billing':
-            if self._check_permission(['admin', 'receptionist']):
-                billing = load_db(BILLING_DB, [])
-                bill = {
-                    "id": str(uuid.uuid4()),
-                    "created_at": datetime.now().isoformat(),
-                    "created_by": user.get('id'),
-                    "status": "pending",
-                    **body
-                }
-                billing.append(bill)
-                save_db(BILLING_DB, billing)
-                self._send_json(bill, 201)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
-            return
-        
-        # Create pharmacy item
-        if path == '/api/pharmacy':
-            if self._check_permission(['admin']):
-                pharmacy = load_db(PHARMACY_DB, [])
-                item = {
-                    "id": str(uuid.uuid4()),
-                    "created_at": datetime.now().isoformat(),
-                    **body
-                }
-                pharmacy.append(item)
-                save_db(PHARMACY_DB, pharmacy)
-                self._send_json(item, 201)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
-            return
-        
-        # Create prescription
-        if path == '/api/prescriptions':
-            if self._check_permission(['admin', 'doctor']):
-                prescriptions = load_db(PRESCRIPTIONS_DB, [])
-                prescription = {
-                    "id": str(uuid.uuid4()),
-                    "created_at": datetime.now().isoformat(),
-                    "doctor_id": user.get('id'),
-                    **body
-                }
-                prescriptions.append(prescription)
-                save_db(PRESCRIPTIONS_DB, prescriptions)
-                self._send_json(prescription, 201)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
-            return
-        
-        # Create user (Admin only)
-        if path == '/api/users':
-            if self._check_permission(['admin']):
-                users = load_db(USERS_DB, [])
-                new_user = {
-                    "id": str(uuid.uuid4()),
-                    "created_at": datetime.now().isoformat(),
-                    "password": hash_password(body.get('password', 'password123')),
-                    "active": True,
-                    **{k: v for k, v in body.items() if k != 'password'}
-                }
-                users.append(new_user)
-                save_db(USERS_DB, users)
-                
-                new_user_copy = new_user.copy()
-                new_user_copy.pop('password', None)
-                self._send_json(new_user_copy, 201)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
+                inserted = len(accepted)
+
+        self._send_json({
+            "received": len(rows),
+            "inserted": inserted,
+            "failed": len(errors),
+            "errors": [{"row": row, "error": errors[row]} for row in sorted(errors)]
+        }, 422 if atomic and errors else 200)
+
+    def _send_export(self, ctx, resource):
+        """Stream a whole (optionally filtered) collection, a page at a time"""
+        db_path, params = BULK_COLLECTIONS[resource][0], ctx.query
+        try:
+            q = list_query({k: v for k, v in params.items() if k not in ('limit', 'cursor')})
+        except ValueError as e:
+            self._send_json({"error": str(e)}, 400)
             return
-        
-        self._send_json({"error": "Not found"}, 404)
-    
-    def do_PUT(self):
-        """Handle PUT requests"""
-        path = self.path
-        body = self._get_body()
-        
-        user = self._get_current_user()
-        if not user:
-            self._send_json({"error": "Unauthorized"}, 401)
+        fields = [f for v in params.get('fields', []) for f in v.split(',') if f]
+
+        def records():
+            # Keyset pages keep memory and lock hold times bounded on large collections
+            after = None
+            while True:
+                page, after = query_records(db_path, Query(
+                    equals=q.equals, date_from=q.date_from, date_to=q.date_to,
+                    after=after, limit=MAX_PAGE_SIZE))
+                for record in page:
+                    yield project(record, fields) if fields else record
+                if after is None:
+                    return
+
+        # Not cached: one export would push every other entry out
+        fragments = (encode(record) for record in records())
+        if params.get('format', [''])[-1] == 'json':
+            headers = {'Content-Disposition': f'attachment; filename="{resource}.json"'}
+            self._stream_json(fragments, headers=headers)
+        else:
+            headers = {'Content-Disposition': f'attachment; filename="{resource}.ndjson"'}
+            self._stream_ndjson(fragments, headers)
+
+    def _pharmacy_items(self, entries):
+        """Pharmacy records for (sort key, id) index entries, in order"""
+        items = (get_record(PHARMACY_DB, key) for _, key in entries)
+        return [item for item in items if item is not None]
+
+    def _dispense(self, prescription_id, user):
+        """Take a prescription's medicines out of stock, all or nothing"""
+        # Lock order: prescriptions, then pharmacy
+        with transaction(PRESCRIPTIONS_DB):
+            prescription = get_record(PRESCRIPTIONS_DB, prescription_id)
+            if not prescription:
+                return {"error": "Prescription not found"}, 404
+            if prescription.get('dispensed_at'):
+                return {"error": "Prescription already dispensed"}, 409
+            wanted = dispense_quantities(prescription)
+            if isinstance(wanted, str):
+                return {"error": wanted}, 400
+
+            with transaction(PHARMACY_DB):
+                items = {key: get_record(PHARMACY_DB, key) for key in wanted}
+                missing = [key for key, item in items.items() if item is None]
+                if missing:
+                    return {"error": "Medicine not found", "medicine_ids": missing}, 400
+                shortages = []
+                for key, quantity in wanted.items():
+                    available = to_decimal(items[key].get('stock_quantity', 0))
+                    if available < quantity:
+                        shortages.append({"medicine_id": key, "requested": quantity,
+                                          "available": to_number(available)})
+                if shortages:
+                    return {"error": "Insufficient stock", "shortages": shortages}, 409
+
+                now = datetime.now().isoformat()
+                dispensed = []
+                for key, quantity in wanted.items():
+                    stock = to_number(to_decimal(items[key].get('stock_quantity', 0)) - quantity)
+                    update_record(PHARMACY_DB, key, {'stock_quantity': stock, 'updated_at': now})
+                    dispensed.append({"medicine_id": key, "quantity": quantity,
+                                      "stock_quantity": stock})
+
+            record = update_record(PRESCRIPTIONS_DB, prescription_id, {
+                'status': 'dispensed',
+                'dispensed_at': now,
+                'dispensed_by': user.get('id')
+            })
+        return {"prescription": record, "dispensed": dispensed}, 200
+
+    def _send_availability(self, ctx):
+        """Send a doctor's free and booked slots for one day"""
+        params = ctx.query
+        doctor = params.get('doctor_id', params.get('doctor_name', ['']))[-1]
+        day = params.get('date', [''])[-1]
+        try:
+            date.fromisoformat(day)
+        except ValueError:
+            self._send_json({"error": "date must be YYYY-MM-DD"}, 400)
             return
-        
-        # Update settings (Admin only)
-        if path == '/api/settings':
-            if self._check_permission(['admin']):
-                settings = load_db(SETTINGS_DB, {})
-                settings.update(body)
-                save_db(SETTINGS_DB, settings)
-                self._send_json(settings)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
+        if not doctor_key(doctor):
+            self._send_json({"error": "doctor_id or doctor_name is required"}, 400)
             return
-        
-        # Update patient
-        if path.startswith('/api/patients/'):
-            patient_id = path.split('/')[-1]
-            if self._check_permission(['admin', 'doctor', 'nurse', 'receptionist']):
-                patients = load_db(PATIENTS_DB, [])
-                for i, p in enumerate(patients):
-                    if p.get('id') == patient_id:
-                        patients[i].update(body)
-                        patients[i]['updated_at'] = datetime.now().isoformat()
-                        save_db(PATIENTS_DB, patients)
-                        self._send_json(patients[i])
-                        return
-                self._send_json({"error": "Patient not found"}, 404)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
+
+        hours = {**DEFAULT_HOURS, **(load_db(SETTINGS_DB, {}).get('scheduling') or {})}
+        day_start, day_end = parse_time(hours['day_start']), parse_time(hours['day_end'])
+        slot_minutes = hours['slot_minutes']
+        duration = params.get('duration', [str(slot_minutes)])[-1]
+        if not str(duration).isdigit() or int(duration) < 1:
+            self._send_json({"error": "duration must be a positive number of minutes"}, 400)
             return
-        
-        # Update appointment
-        if path.startswith('/api/appointments/'):
-            appointment_id = path.split('/')[-1]
-            if self._check_permission(['admin', 'doctor', 'receptionist']):
-                appointments = load_db(APPOINTMENTS_DB, [])
-                for i, a in enumerate(appointments):
-                    if a.get('id') == appointment_id:
-                        appointments[i].update(body)
-                        appointments[i]['updated_at'] = datetime.now().isoformat()
-                        save_db(APPOINTMENTS_DB, appointments)
-                        self._send_json(appointments[i])
-                        return
-                self._send_json({"error": "Appointment not found"}, 404)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
+        if day_start is None or day_end is None or not isinstance(slot_minutes, int) or slot_minutes < 1:
+            self._send_json({"error": "Invalid scheduling settings"}, 500)
             return
-        
-        # Update billing
-        if path.startswith('/api/billing/'):
-            bill_id = path.split('/')[-1]
-            if self._check_permission(['admin', 'receptionist']):
-                billing = load_db(BILLING_DB, [])
-                for i, b in enumerate(billing):
-                    if b.get('id') == bill_id:
-                        billing[i].update(body)
-                        billing[i]['updated_at'] = datetime.now().isoformat()
-                        save_db(BILLING_DB, billing)
-                        self._send_json(billing[i])
-                        return
-                self._send_json({"error": "Bill not found"}, 404)
+
+        key = doctor_key(doctor)
+        free = SCHEDULE.availability(key, day, day_start, day_end, slot_minutes, int(duration))
+        booked = SCHEDULE.booked(key, day)
+        self._send_json({
+            "doctor": doctor,
+            "date": day,
+            "duration": int(duration),
+            "free": [{"start": format_time(s), "end": format_time(e)} for s, e in free],
+            "booked": [{"start": format_time(s), "end": format_time(e), "appointment_id": i}
+                       for s, e, i in booked]
+        })
+
+    def _send_timeseries(self, ctx, report):
+        """Send one time-series report as JSON, or as CSV with format=csv"""
+        params = ctx.query
+        today = date.today()
+        try:
+            if report == 'billing-aging':
+                as_of = params.get('as_of', [None])[-1]
+                as_of = date.fromisoformat(as_of) if as_of else today
             else:
-                self._send_json({"error": "Forbidden"}, 403)
+                first, last, interval = report_range(params, today)
+        except ValueError as e:
+            self._send_json({"error": str(e)}, 400)
             return
-        
-        # Update pharmacy item
-        if path.startswith('/api/pharmacy/'):
-            item_id = path.split('/')[-1]
-            if self._check_permission(['admin']):
-                pharmacy = load_db(PHARMACY_DB, [])
-                for i, item in enumerate(pharmacy):
-                    if item.get('id') == item_id:
-                        pharmacy[i].update(body)
-                        pharmacy[i]['updated_at'] = datetime.now().isoformat()
-                        save_db(PHARMACY_DB, pharmacy)
-                        self._send_json(pharmacy[i])
-                        return
-                self._send_json({"error": "Item not found"}, 404)
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
+        headers, sent = self._not_modified([TIMESERIES_REPORTS[report]], extra=(today,))
+        if sent:
             return
-        
-        self._send_json({"error": "Not found"}, 404)
+
+        day = lambda ordinal: date.fromordinal(ordinal).isoformat()
+        if report == 'revenue':
+            status = params.get('status', [None])[-1]
+            points = TIMESERIES.revenue(first, last, interval, status)
+            header = ['period', 'amount', 'count']
+            rows = [(day(p), amount, count) for p, amount, count in points]
+            result = {
+                "from": day(first), "to": day(last), "interval": interval, "status": status,
+                "points": [dict(zip(header, row)) for row in rows]
+            }
+        elif report == 'appointments':
+            group_by = params.get('group_by', ['doctor'])[-1]
+            if group_by not in ('doctor', 'department'):
+                self._send_json({"error": "group_by must be doctor or department"}, 400)
+                return
+            series = TIMESERIES.appointments(first, last, interval, group_by)
+            header = ['period', group_by, 'count']
+            rows = [(day(p), name, count) for name, points in series.items()
+                    for p, count in points]
+            result = {
+                "from": day(first), "to": day(last), "interval": interval, "group_by": group_by,
+                "series": {name: [{"period": day(p), "count": count} for p, count in points]
+                           for name, points in series.items()}
+            }
+        else:
+            statuses = [v for value in params.get('status', ['pending'])
+                        for v in value.split(',') if v]
+            aging = TIMESERIES.aging(as_of.toordinal(), statuses)
+            header = ['status', 'bucket', 'count', 'amount']
+            rows = [(status, label, count, amount) for status, buckets in aging.items()
+                    for label, count, amount in buckets]
+            result = {
+                "as_of": as_of.isoformat(),
+                "statuses": {status: [{"bucket": label, "count": count, "amount": amount}
+                                      for label, count, amount in buckets]
+                             for status, buckets in aging.items()}
+            }
+
+        if params.get('format', [''])[-1] == 'csv':
+            headers['Content-Disposition'] = f'attachment; filename="{report}.csv"'
+            self._stream((line.encode() for line in csv_rows(header, rows)),
+                         'text/csv; charset=utf-8', headers=headers)
+        else:
+            self._send_json({"report": report, **result}, headers=headers)
     
-    def do_DELETE(self):
-        """Handle DELETE requests"""
-        path = self.path
-        
-        user = self._get_current_user()
-        if not user:
-            self._send_json({"error": "Unauthorized"}, 401)
+    # POST handlers
+
+    def _login(self, ctx):
+        username = ctx.body.get('username')
+        password = ctx.body.get('password')
+
+        user = find_record(USERS_DB, 'username', username)
+
+        if user and user.get('password') == hash_password(password):
+            if not user.get('active', True):
+                self._send_json({"error": "Account disabled"}, 403)
+                return
+
+            # Create session
+            token = SESSIONS.create(user)['token']
+
+            user_copy = user.copy()
+            user_copy.pop('password', None)
+
+            self._send_json({
+                "token": token,
+                "user": user_copy
+            })
+        else:
+            self._send_json({"error": "Invalid credentials"}, 401)
+
+    def _logout(self, ctx):
+        SESSIONS.revoke(ctx.token)
+        self._send_json({"message": "Logged out successfully"})
+
+    def _create(self, ctx, resource, db_path):
+        """Create a patient, bill, pharmacy item or prescription"""
+        record = new_record(resource, ctx.body, ctx.user)
+        insert_record(db_path, record)
+        self._send_json(record, 201)
+
+    def _create_appointment(self, ctx):
+        appointment = new_record('appointments', ctx.body, ctx.user)
+        error = validate_appointment(appointment)
+        if error:
+            self._send_json({"error": error}, 400)
             return
-        
-        # Delete patient
-        if path.startswith('/api/patients/'):
-            patient_id = path.split('/')[-1]
-            if self._check_permission(['admin']):
-                patients = load_db(PATIENTS_DB, [])
-                patients = [p for p in patients if p.get('id') != patient_id]
-                save_db(PATIENTS_DB, patients)
-                self._send_json({"message": "Patient deleted"})
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
+        # Check and book under the collection lock so two requests
+        # (in any worker process) cannot take the same slot
+        with transaction(APPOINTMENTS_DB):
+            clash = SCHEDULE.conflicts(appointment)
+            if not clash:
+                insert_record(APPOINTMENTS_DB, appointment)
+        if clash:
+            self._send_json({"error": "Doctor is already booked at that time",
+                             "conflicts": clash}, 409)
             return
-        
-        # Delete appointment
-        if path.startswith('/api/appointments/'):
-            appointment_id = path.split('/')[-1]
-            if self._check_permission(['admin', 'receptionist']):
-                appointments = load_db(APPOINTMENTS_DB, [])
-                appointments = [a for a in appointments if a.get('id') != appointment_id]
-                save_db(APPOINTMENTS_DB, appointments)
-                self._send_json({"message": "Appointment deleted"})
-            else:
-                self._send_json({"error": "Forbidden"}, 403)
+
+        # Send WhatsApp notification if enabled
+        self._send_whatsapp_notification(appointment, 'appointment_scheduled')
+
+        self._send_json(appointment, 201)
+
+    def _dispense_prescription(self, ctx):
+        result, status = self._dispense(ctx.params['id'], ctx.user)
+        self._send_json(result, status)
+
+    def _create_user(self, ctx):
+        body = ctx.body
+        new_user = {
+            "id": str(uuid.uuid4()),
+            "created_at": datetime.now().isoformat(),
+            "password": hash_password(body.get('password', 'password123')),
+            "active": True,
+            **{k: v for k, v in body.items() if k != 'password'}
+        }
+        try:
+            insert_record(USERS_DB, new_user)
+        except IntegrityError as e:
+            self._send_json({"error": str(e)}, 409)
             return
-        
-        self._send_json({"error": "Not found"}, 404)
+
+        new_user_copy = new_user.copy()
+        new_user_copy.pop('password', None)
+        self._send_json(new_user_copy, 201)
+
+    def _rebuild_dashboard(self, ctx):
+        """Rebuild dashboard totals and check them against the running ones"""
+        self._send_json(DASHBOARD.check())
+
+    # PUT handlers
+
+    def _update_settings(self, ctx):
+        with transaction(SETTINGS_DB):
+            settings = load_db(SETTINGS_DB, {})
+            settings.update(ctx.body)
+            save_db(SETTINGS_DB, settings)
+        self._send_json(settings)
+
+    def _update(self, ctx, db_path, missing):
+        """Update a patient, bill or pharmacy item"""
+        record = update_record(db_path, ctx.params['id'], update_changes(ctx.body))
+        if record:
+            self._send_json(record)
+        else:
+            self._send_json({"error": missing}, 404)
+
+    def _update_appointment(self, ctx):
+        appointment_id = ctx.params['id']
+        changes = update_changes(ctx.body)
+        error = clash = record = None
+        with transaction(APPOINTMENTS_DB):
+            current = get_record(APPOINTMENTS_DB, appointment_id)
+            if current:
+                merged = {**current, **changes}
+                error = validate_appointment(merged)
+                clash = None if error else SCHEDULE.conflicts(merged)
+                if not error and not clash:
+                    record = update_record(APPOINTMENTS_DB, appointment_id, changes)
+        if error:
+            self._send_json({"error": error}, 400)
+        elif clash:
+            self._send_json({"error": "Doctor is already booked at that time",
+                             "conflicts": clash}, 409)
+        elif record:
+            self._send_json(record)
+        else:
+            self._send_json({"error": "Appointment not found"}, 404)
+
+    # DELETE handlers
+
+    def _delete(self, ctx, db_path, message):
+        delete_record(db_path, ctx.params['id'])
+        self._send_json({"message": message})
     
     def _send_whatsapp_notification(self, data, notification_type):
         """Send WhatsApp notification"""
@@ -601,26 +1202,355 @@ class HospitalAPIHandler(BaseHTTPRequestHandler):
         if not whatsapp.get('enabled'):
             return
         
-        # Store notification for processing
-        notifications = load_db(NOTIFICATIONS_DB, [])
-        notification = {
-            "id": str(uuid.uuid4()),
-            "type": notification_type,
-            "data": data,
-            "created_at": datetime.now().isoformat(),
-            "status": "pending"
-        }
-        notifications.append(notification)
-        save_db(NOTIFICATIONS_DB, notifications)
+        # Queue for the WhatsApp service and wake it up
+        NOTIFICATIONS.enqueue(notification_type, data)
+
+
+# Route table: method, pattern, handler, allowed roles (None: any signed-in user)
+ROUTER = Router()
+H = HospitalAPIHandler
+
+ROUTER.add('GET', '/api/health', H._health, public=True)
+ROUTER.add('POST', '/api/auth/login', H._login, public=True)
+ROUTER.add('POST', '/api/auth/logout', H._logout)
+ROUTER.add('GET', '/api/auth/me', H._me)
+
+ROUTER.add('GET', '/api/patients', partial(H._list, db_path=PATIENTS_DB), ALL_STAFF)
+ROUTER.add('POST', '/api/patients', partial(H._create, resource='patients', db_path=PATIENTS_DB),
+           ['admin', 'receptionist'])
+ROUTER.add('GET', '/api/patients/search', H._search_patients, ALL_STAFF)
+ROUTER.add('GET', '/api/patients/:id', H._get_patient, ALL_STAFF)
+ROUTER.add('PUT', '/api/patients/:id', partial(H._update, db_path=PATIENTS_DB,
+                                                missing="Patient not found"), ALL_STAFF)
+ROUTER.add('DELETE', '/api/patients/:id', partial(H._delete, db_path=PATIENTS_DB,
+                                                   message="Patient deleted"), ['admin'])
+for resource, (db_path, roles) in PATIENT_HISTORY.items():
+    ROUTER.add('GET', f'/api/patients/:id/{resource}', partial(H._patient_history, db_path=db_path),
+               roles)
+
+ROUTER.add('GET', '/api/appointments', partial(H._list, db_path=APPOINTMENTS_DB), ALL_STAFF)
+ROUTER.add('POST', '/api/appointments', H._create_appointment, ['admin', 'receptionist', 'doctor'])
+ROUTER.add('GET', '/api/appointments/availability', H._send_availability, ALL_STAFF)
+ROUTER.add('PUT', '/api/appointments/:id', H._update_appointment,
+           ['admin', 'doctor', 'receptionist'])
+ROUTER.add('DELETE', '/api/appointments/:id', partial(H._delete, db_path=APPOINTMENTS_DB,
+                                                       message="Appointment deleted"),
+           ['admin', 'receptionist'])
+
+ROUTER.add('GET', '/api/billing', partial(H._list, db_path=BILLING_DB), ['admin', 'receptionist'])
+ROUTER.add('POST', '/api/billing', partial(H._create, resource='billing', db_path=BILLING_DB),
+           ['admin', 'receptionist'])
+ROUTER.add('PUT', '/api/billing/:id', partial(H._update, db_path=BILLING_DB,
+                                               missing="Bill not found"), ['admin', 'receptionist'])
 
-def run_server(port=8000):
+ROUTER.add('GET', '/api/pharmacy', partial(H._list, db_path=PHARMACY_DB), ['admin', 'doctor', 'nurse'])
+ROUTER.add('POST', '/api/pharmacy', partial(H._create, resource='pharmacy', db_path=PHARMACY_DB),
+           ['admin'])
+ROUTER.add('GET', '/api/pharmacy/low-stock', H._low_stock, ['admin', 'doctor', 'nurse'])
+ROUTER.add('GET', '/api/pharmacy/expiring', H._expiring, ['admin', 'doctor', 'nurse'])
+ROUTER.add('PUT', '/api/pharmacy/:id', partial(H._update, db_path=PHARMACY_DB,
+                                                missing="Item not found"), ['admin'])
+
+ROUTER.add('GET', '/api/prescriptions', partial(H._list, db_path=PRESCRIPTIONS_DB),
+           ['admin', 'doctor', 'nurse'])
+ROUTER.add('POST', '/api/prescriptions', partial(H._create, resource='prescriptions',
+                                                  db_path=PRESCRIPTIONS_DB), ['admin', 'doctor'])
+ROUTER.add('POST', '/api/prescriptions/:id/dispense', H._dispense_prescription,
+           ['admin', 'doctor', 'nurse'])
+
+# Streaming export and bulk import: /api/<collection>/export|bulk
+for resource, (db_path, export_roles, import_roles) in BULK_COLLECTIONS.items():
+    ROUTER.add('GET', f'/api/{resource}/export', partial(H._send_export, resource=resource),
+               export_roles)
+    # Bulk bodies may be NDJSON and are read row by row by the handler
+    ROUTER.add('POST', f'/api/{resource}/bulk', partial(H._bulk_import, resource=resource),
+               import_roles, raw_body=True)
+
+ROUTER.add('GET', '/api/settings', H._get_settings, ['admin'])
+ROUTER.add('PUT', '/api/settings', H._update_settings, ['admin'])
+ROUTER.add('GET', '/api/users', H._list_users, ['admin'])
+ROUTER.add('POST', '/api/users', H._create_user, ['admin'])
+ROUTER.add('GET', '/api/metrics', H._metrics, ['admin'])
+ROUTER.add('GET', '/api/system/stats', H._system_stats, ['admin'])
+
+ROUTER.add('GET', '/api/reports/dashboard', H._dashboard, ['admin', 'doctor'])
+ROUTER.add('POST', '/api/reports/dashboard/rebuild', H._rebuild_dashboard, ['admin'])
+for report in TIMESERIES_REPORTS:
+    ROUTER.add('GET', f'/api/reports/timeseries/{report}',
+               partial(H._send_timeseries, report=report), ['admin', 'doctor'])
+del H
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer that hands connections to a fixed pool of worker threads.
+
+    Accepted connections wait in a bounded queue; when it is full the client
+    gets an immediate 503 instead of piling up behind slow requests. Between
+    requests a keep-alive connection is parked with one selector thread, not a
+    worker, and queued again once the client sends its next request.
+    """
+
+    BUSY_RESPONSE = (
+        b'HTTP/1.1 503 Service Unavailable\r\n'
+        b'Content-Type: application/json\r\n'
+        b'Access-Control-Allow-Origin: *\r\n'
+        b'Retry-After: 1\r\n'
+        b'Content-Length: 25\r\n'
+        b'Connection: close\r\n\r\n'
+        b'{"error": "Server busy"}\n'
+    )
+
+    def __init__(self, server_address, handler_class, threads=SERVER_THREADS,
+                 queue_depth=SERVER_QUEUE_DEPTH, bind_and_activate=True):
+        # listen() backlog; the default of 5 resets bursts of new connections
+        self.request_queue_size = max(queue_depth, 5)
+        super().__init__(server_address, handler_class, bind_and_activate)
+        self._requests = queue.Queue(maxsize=max(queue_depth, 1))
+        # Idle connections: socket -> (client_address, responses sent, deadline)
+        self._idle = {}
+        self._parked = collections.deque()
+        self._resumed = {}
+        self._closing = False
+        self._selector = selectors.DefaultSelector()
+        self._wakeup, self._wakeup_writer = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        threading.Thread(target=self._watch_idle, daemon=True, name='http-idle').start()
+        self._workers = []
+        for i in range(max(threads, 1)):
+            worker = threading.Thread(target=self._work, daemon=True, name=f'http-worker-{i}')
+            worker.start()
+            self._workers.append(worker)
+
+    # How long a worker waits for a connection's next request before parking
+    # it, while no other connection is queued: a client sending requests back
+    # to back then skips the round trip through the idle thread
+    LINGER = 0.002
+
+    def linger(self):
+        """Seconds a worker may wait for its connection's next request"""
+        return 0 if self._requests.qsize() else self.LINGER
+
+    def resumed(self, request):
+        """Responses already sent on a connection queued again after idling"""
+        return self._resumed.pop(request, 0)
+
+    def process_request(self, request, client_address):
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            self._resumed.pop(request, None)
+            try:
+                request.sendall(self.BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            handler = None
+            try:
+                handler = self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                if handler is not None and handler.idle is not None and not self._closing:
+                    self._parked.append((request, client_address, handler.idle))
+                    self._wake()
+                else:
+                    self.shutdown_request(request)
+
+    def _wake(self):
+        try:
+            self._wakeup_writer.send(b'\0')
+        except OSError:
+            # Buffer full: the idle thread has wakeups pending already
+            pass
+
+    def _watch_idle(self):
+        """Queue idle connections when their next request arrives; close them on timeout"""
+        while not self._closing:
+            while self._parked:
+                request, client_address, served = self._parked.popleft()
+                self._idle[request] = (client_address, served,
+                                       time.monotonic() + KEEPALIVE_TIMEOUT)
+                self._selector.register(request, selectors.EVENT_READ)
+            deadline = min((d for _, _, d in self._idle.values()), default=None)
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            for key, _ in self._selector.select(timeout):
+                request = key.fileobj
+                if request is self._wakeup:
+                    try:
+                        while request.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                self._selector.unregister(request)
+                client_address, served, _ = self._idle.pop(request)
+                self._resumed[request] = served
+                self.process_request(request, client_address)
+            now = time.monotonic()
+            for request in [r for r, (_, _, d) in self._idle.items() if d <= now]:
+                self._selector.unregister(request)
+                del self._idle[request]
+                self.shutdown_request(request)
+        for request in [*self._idle, *(r for r, _, _ in self._parked)]:
+            self.shutdown_request(request)
+        self._selector.close()
+        self._wakeup.close()
+        self._wakeup_writer.close()
+
+    def server_close(self):
+        super().server_close()
+        self._closing = True
+        self._wake()
+        for _ in self._workers:
+            self._requests.put(None)
+
+def rebuild_views():
+    """Build the in-memory report, search, schedule and inventory indexes.
+
+    Each decodes its whole collection, so this takes time in proportion to
+    the data whatever the storage backend.
+    """
+    DASHBOARD.rebuild()
+    TIMESERIES.rebuild()
+    SEARCH.rebuild()
+    SCHEDULE.rebuild()
+    INVENTORY.rebuild()
+
+def run_server(port=8000, threads=SERVER_THREADS, queue_depth=SERVER_QUEUE_DEPTH):
     """Run the HTTP server"""
     initialize_database()
     server_address = ('', port)
-    httpd = HTTPServer(server_address, HospitalAPIHandler)
+    if threads > 0:
+        httpd = PooledHTTPServer(server_address, HospitalAPIHandler, threads, queue_depth)
+    else:
+        httpd = HTTPServer(server_address, HospitalAPIHandler)
     print(f'Hospital Management System Server running on port {port}...')
+    if threads > 0:
+        print(f'Serving with {threads} threads (queue depth {queue_depth})')
     print(f'Default login: username=admin, password=admin123')
+    SESSIONS.start_sweeper()
+    ARCHIVE.start(ARCHIVED_COLLECTIONS)
+    rebuild_views()
     httpd.serve_forever()
 
+def _serve_worker(listener, threads, queue_depth, archiver=False):
+    """Serve requests from an already-listening socket (prefork child)
+
+    Only the worker given archiver=True moves records to the archive; the
+    others see its moves on disk.
+    """
+    httpd = PooledHTTPServer(listener.getsockname(), HospitalAPIHandler, threads,
+                             queue_depth, bind_and_activate=False)
+    httpd.socket.close()
+    httpd.socket = listener
+    httpd.server_name = socket.getfqdn()
+    httpd.server_port = listener.getsockname()[1]
+    SESSIONS.start_sweeper()
+    if archiver:
+        ARCHIVE.start(ARCHIVED_COLLECTIONS)
+    rebuild_views()
+    httpd.serve_forever()
+
+def run_prefork(port=8000, workers=2, threads=SERVER_THREADS, queue_depth=SERVER_QUEUE_DEPTH):
+    """Run several server processes on one listening socket, restarting any that die.
+
+    Workers share nothing in memory: every write goes through the storage
+    layer's cross-process locks and every read revalidates against disk, so
+    sessions created or revoked in one worker are seen by the others on
+    their next request.
+    """
+    if not hasattr(os, 'fork'):
+        print('Prefork mode needs os.fork(); running a single process instead')
+        run_server(port, threads, queue_depth)
+        return
+
+    initialize_database()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', port))
+    listener.listen(max(queue_depth, 5))
+    children = {}
+    stopping = False
+
+    # Worker slot 0 runs the archiver, and its replacement takes it over
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 0
+            try:
+                _serve_worker(listener, threads, queue_depth, archiver=slot == 0)
+            except BaseException:
+                # os._exit skips the usual exit handling (and stderr flush)
+                traceback.print_exc()
+                sys.stderr.flush()
+                status = 1
+            finally:
+                os._exit(status)
+        children[pid] = (slot, time.monotonic())
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for slot in range(workers):
+        spawn(slot)
+    print(f'Hospital Management System Server running on port {port}...')
+    print(f'Prefork mode: {workers} worker processes x {threads} threads')
+    print(f'Default login: username=admin, password=admin123')
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        child = children.pop(pid, None)
+        if stopping or child is None:
+            continue
+        slot, started = child
+        print(f'Worker {pid} exited with status {status}; restarting')
+        # Avoid a tight restart loop when workers die on startup
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+        spawn(slot)
+    listener.close()
+
+def parse_args(argv=None):
+    """Command line options (defaults come from the environment)"""
+    parser = argparse.ArgumentParser(description='Hospital Management System API server')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+                        help='server processes sharing the port (1 = no prefork)')
+    parser.add_argument('--threads', type=int, default=SERVER_THREADS,
+                        help='worker threads per process (0 = single-threaded)')
+    parser.add_argument('--queue-depth', type=int, default=SERVER_QUEUE_DEPTH,
+                        help='connections allowed to wait for a worker thread')
+    return parser.parse_args(argv)
+
 if __name__ == '__main__':
-    run_server()
+    args = parse_args()
+    if args.workers > 1:
+        run_prefork(args.port, args.workers, max(args.threads, 1), args.queue_depth)
+    else:
+        run_server(args.port, args.threads, args.queue_depth)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Sessions
+Token authentication backed by the sessions collection
+
+The storage layer keeps every list collection in memory keyed by its key
+field, so sessions are already a token -> session map and users an
+id -> user map; verifying a token is two dictionary lookups. Expired
+sessions are removed by a background sweeper driven by a min-heap of
+expiry times, so a sweep only touches sessions that are actually due.
+"""
+
+import heapq
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+
+from storage import (get_record, insert_record, delete_record, load_db,
+                     count_records, db_generation)
+
+# Session configuration
+SESSION_TTL_HOURS = float(os.environ.get('SESSION_TTL_HOURS', 24))
+SESSION_SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', 300))
+
+
+def generate_token():
+    """Generate secure random token"""
+    return secrets.token_urlsafe(32)
+
+
+def _expires_at(session, ttl):
+    """Expiry time of a session as a timestamp, or None if it cannot be parsed"""
+    try:
+        return (datetime.fromisoformat(session.get('created_at')) + ttl).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class SessionManager:
+    """Create, verify and expire login sessions"""
+
+    def __init__(self, sessions_db, users_db, ttl_hours=SESSION_TTL_HOURS,
+                 sweep_interval=SESSION_SWEEP_INTERVAL):
+        self.sessions_db = sessions_db
+        self.users_db = users_db
+        self.ttl = timedelta(hours=ttl_hours)
+        self.sweep_interval = sweep_interval
+        self._expiry = []
+        self._generation = None
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self.swept = 0
+
+    def create(self, user):
+        """Start a new session for user and return it"""
+        session = {
+            "token": generate_token(),
+            "user_id": user.get('id'),
+            "created_at": datetime.now().isoformat()
+        }
+        insert_record(self.sessions_db, session)
+        with self._lock:
+            heapq.heappush(self._expiry, (_expires_at(session, self.ttl), session['token']))
+            self._generation = db_generation(self.sessions_db)
+        return session
+
+    def revoke(self, token):
+        """End a session (its heap entry is skipped when it comes due)"""
+        if token:
+            delete_record(self.sessions_db, token)
+
+    def verify(self, token):
+        """user_id for a valid, unexpired token, else None"""
+        if not token:
+            return None
+        session = get_record(self.sessions_db, token)
+        if session is None:
+            return None
+        expires_at = _expires_at(session, self.ttl)
+        if expires_at is None or expires_at <= time.time():
+            return None
+        return session.get('user_id')
+
+    def user_for_token(self, token):
+        """User record for a valid token, else None"""
+        user_id = self.verify(token)
+        if not user_id:
+            return None
+        return get_record(self.users_db, user_id)
+
+    def rebuild(self):
+        """Rebuild the expiry heap from the sessions collection"""
+        sessions = load_db(self.sessions_db, [])
+        expiry = []
+        for session in sessions:
+            token = session.get('token')
+            if token:
+                # Unparseable sessions can never be valid; sweep them right away
+                expiry.append((_expires_at(session, self.ttl) or 0, token))
+        heapq.heapify(expiry)
+        with self._lock:
+            self._expiry = expiry
+            self._generation = db_generation(self.sessions_db)
+
+    def sweep(self, now=None):
+        """Delete sessions that have expired; returns how many were removed"""
+        now = time.time() if now is None else now
+        # Sessions written by other processes are not in our heap; pick them up
+        if self._generation != db_generation(self.sessions_db):
+            self.rebuild()
+
+        due = []
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                due.append(heapq.heappop(self._expiry)[1])
+
+        removed = 0
+        for token in due:
+            session = get_record(self.sessions_db, token)
+            if session is None:
+                continue
+            expires_at = _expires_at(session, self.ttl)
+            if expires_at is not None and expires_at > now:
+                # Session was replaced with a newer one; track its real expiry
+                with self._lock:
+                    heapq.heappush(self._expiry, (expires_at, token))
+                continue
+            if delete_record(self.sessions_db, token):
+                removed += 1
+        with self._lock:
+            self.swept += removed
+            self._generation = db_generation(self.sessions_db)
+        return removed
+
+    def start_sweeper(self):
+        """Run sweep() every sweep_interval seconds in a daemon thread"""
+        if self._sweeper is not None or self.sweep_interval <= 0:
+            return
+        self.rebuild()
+        self._sweeper = threading.Thread(target=self._sweep_loop, daemon=True,
+                                         name='session-sweeper')
+        self._sweeper.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Session sweep failed: {e}")
+
+    def stats(self):
+        """Session counters"""
+        with self._lock:
+            tracked = len(self._expiry)
+            swept = self.swept
+        return {
+            "active": count_records(self.sessions_db),
+            "tracked_expiries": tracked,
+            "swept": swept
+        }
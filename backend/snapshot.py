@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Snapshot Files
+Compact on-disk copy of a collection with a key index, read through mmap
+
+Layout (integers little-endian):
+  header  - magic, record count, index offset and the key field name
+            (empty for a single value, e.g. settings)
+  data    - a compact JSON array of the records in collection order (or the
+            single value), padded with spaces to 8 bytes
+  index   - key hashes (u64, sorted), then for each hash the record's
+            offset (u64) and length (u32)
+
+Opening a snapshot maps the file and reads the header, whatever its size.
+get() hashes the key, binary-searches the hash column in the mapping and
+decodes just that record; data() decodes the whole array in one pass.
+"""
+
+import array
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b'HMSSNAP1'
+SNAPSHOT_SUFFIX = '.snap'
+
+_HEADER = struct.Struct('<8sQQ32s')
+_ALIGN = 8
+
+
+def key_hash(key):
+    """Stable 64-bit hash of a record key (the same in every process)"""
+    digest = hashlib.blake2b(json.dumps(key).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def _encode(value):
+    return json.dumps(value, separators=(',', ':')).encode()
+
+
+def _column_bytes(typecode, values):
+    column = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column.tobytes()
+
+
+def _column(view, typecode):
+    """Read-only sequence over a little-endian column of the mapping"""
+    if sys.byteorder == 'little':
+        return view.cast(typecode)
+    column = array.array(typecode)
+    column.frombytes(view)
+    column.byteswap()
+    return column
+
+
+def write_snapshot(path, data, key_field=None):
+    """Write a snapshot file.
+
+    With a key_field, data is the collection's (key, record) pairs; without
+    one it is a single value.
+    """
+    with open(path, 'wb') as f:
+        f.write(b'\0' * _HEADER.size)
+        entries = []
+        if key_field:
+            offset = _HEADER.size + f.write(b'[')
+            for key, record in data:
+                if entries:
+                    offset += f.write(b',')
+                encoded = _encode(record)
+                entries.append((key_hash(key), offset, len(encoded)))
+                offset += f.write(encoded)
+            offset += f.write(b']')
+        else:
+            offset = _HEADER.size + f.write(_encode(data))
+        # Trailing whitespace is still valid JSON
+        padding = -offset % _ALIGN
+        f.write(b' ' * padding)
+        index_offset = offset + padding
+
+        entries.sort()
+        f.write(_column_bytes('Q', (h for h, _, _ in entries)))
+        f.write(_column_bytes('Q', (o for _, o, _ in entries)))
+        f.write(_column_bytes('I', (n for _, _, n in entries)))
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, len(entries), index_offset, (key_field or '').encode()))
+
+
+class SnapshotFile:
+    """A snapshot file mapped read-only; close() it when done"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < _HEADER.size:
+                raise ValueError(f'{path}: not a snapshot file')
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, index_offset, key_field = _HEADER.unpack_from(self._map)
+        if magic != MAGIC or index_offset + 20 * count > len(self._map):
+            self._map.close()
+            raise ValueError(f'{path}: not a snapshot file')
+        self.key_field = key_field.rstrip(b'\0').decode()
+        self.is_list = bool(self.key_field)
+        self.count = count
+        self._data_end = index_offset
+        self._views = []
+        if self.is_list:
+            # Exported views keep the mapping open; close() releases them newest first
+            view = memoryview(self._map)
+            starts = [index_offset + width * count for width in (0, 8, 16, 20)]
+            slices = [view[a:b] for a, b in zip(starts, starts[1:])]
+            self._hashes, self._offsets, self._lengths = (
+                _column(v, t) for v, t in zip(slices, 'QQI'))
+            self._views = [view, *slices, self._hashes, self._offsets, self._lengths]
+
+    def _decode(self, i):
+        offset = self._offsets[i]
+        return json.loads(self._map[offset:offset + self._lengths[i]])
+
+    def get(self, key):
+        """Record stored under key, or None; decodes only that record"""
+        if not self.is_list:
+            return None
+        h = key_hash(key)
+        i = bisect.bisect_left(self._hashes, h)
+        while i < self.count and self._hashes[i] == h:
+            record = self._decode(i)
+            stored = record.get(self.key_field) if isinstance(record, dict) else None
+            # Records without a key are indexed by position; trust the hash for those
+            if stored == key or stored is None:
+                return record
+            i += 1
+        return None
+
+    def data(self):
+        """Collection contents in the shape load_db returns them"""
+        return json.loads(self._map[_HEADER.size:self._data_end])
+
+    def close(self):
+        for view in reversed(self._views):
+            if isinstance(view, memoryview):
+                view.release()
+        self._views = []
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,11 +1,12 @@
 #!/bin/bash
 
 # Start Hospital Management System Backend
+# Any arguments are passed to server.py, e.g. ./start.sh --workers 4
 
 echo "Starting Hospital Management System Backend..."
 
 # Start main server
-python3 server.py &
+python3 server.py "$@" &
 SERVER_PID=$!
 
 # Wait a moment for server to start
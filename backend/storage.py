@@ -0,0 +1,1861 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Storage Layer
+Keeps collections in memory and writes them back through one place.
+
+Collections are addressed by their JSON file path (e.g. database/patients.json)
+whatever the backend. Available backends (STORAGE_BACKEND):
+  json    - each collection is one JSON file, rewritten on every change (default)
+  journal - each change is appended to <collection>.journal and folded into
+            the JSON snapshot by a background compactor
+  sqlite  - one table per collection in SQLITE_PATH (migrate existing data
+            with: python3 storage.py migrate)
+  snapshot - like journal, but the snapshot is <collection>.snap, a compact
+             indexed file read through mmap, so opening a collection and
+             fetching single records does not parse all of it (convert
+             with: python3 storage.py to-snapshot / to-json)
+"""
+
+import bisect
+import functools
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+from snapshot import SNAPSHOT_SUFFIX, SnapshotFile, write_snapshot
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking
+    fcntl = None
+
+# Storage configuration
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json')
+JOURNAL_COMPACT_BYTES = int(os.environ.get('JOURNAL_COMPACT_BYTES', 4 * 1024 * 1024))
+JOURNAL_COMPACT_INTERVAL = float(os.environ.get('JOURNAL_COMPACT_INTERVAL', 30))
+JOURNAL_FSYNC = os.environ.get('JOURNAL_FSYNC', '0') == '1'
+SQLITE_PATH = os.environ.get('SQLITE_PATH', os.path.join('database', 'hospital.db'))
+
+# Field that identifies a record in each collection (default: id)
+KEY_FIELDS = {
+    'sessions.json': 'token',
+}
+
+# Secondary indexes kept up to date on every write: field -> unique?
+INDEXES = {
+    'users.json': {'username': True},
+    'appointments.json': {'patient_id': False, 'status': False},
+    'billing.json': {'patient_id': False, 'status': False},
+    'prescriptions.json': {'patient_id': False},
+    'notifications.json': {'status': False},
+}
+
+# Instrumentation
+STORAGE_SECONDS = metrics.histogram(
+    'hms_storage_operation_seconds', 'Storage calls (load_db, get_record, ...) by collection',
+    ('op', 'collection'), span='storage')
+STORAGE_PARSE_SECONDS = metrics.histogram(
+    'hms_storage_parse_seconds', 'Reading and parsing a collection from disk',
+    ('collection',))
+STORAGE_WRITE_SECONDS = metrics.histogram(
+    'hms_storage_write_seconds', 'Writing changes to disk (file rewrite, journal append or SQLite commit)',
+    ('collection',))
+
+
+class IntegrityError(ValueError):
+    """A write would break a unique index"""
+
+
+class Query:
+    """Filters for a list query.
+
+    equals maps field -> value; date_from/date_to bound the record's 'date'
+    (or the day of created_at) inclusively. With a limit (or a cursor) results
+    are ordered by (created_at, key) and after is the (created_at, key) of the
+    last record already returned.
+    """
+
+    def __init__(self, equals=None, date_from=None, date_to=None, after=None, limit=None):
+        self.equals = dict(equals or {})
+        self.date_from = date_from
+        self.date_to = date_to
+        self.after = tuple(after) if after else None
+        self.limit = limit
+
+    @property
+    def paged(self):
+        return self.limit is not None or self.after is not None
+
+    def matches(self, record):
+        if not isinstance(record, dict):
+            return False
+        for field, value in self.equals.items():
+            actual = record.get(field)
+            if actual != value and (actual is None or str(actual) != str(value)):
+                return False
+        if self.date_from or self.date_to:
+            day = record.get('date') or str(record.get('created_at') or '')[:10]
+            if not isinstance(day, str):
+                return False
+            if self.date_from and day < self.date_from:
+                return False
+            if self.date_to and day > self.date_to:
+                return False
+        return True
+
+
+def sort_key(record, key):
+    """Keyset ordering used for paged queries: (created_at, key)"""
+    created_at = record.get('created_at') if isinstance(record, dict) else None
+    return (created_at if isinstance(created_at, str) else '', key)
+
+
+def key_field(db_path):
+    """Name of the key field for records in db_path"""
+    return KEY_FIELDS.get(os.path.basename(db_path), 'id')
+
+
+def index_spec(db_path):
+    """Secondary indexes for db_path as {field: unique}"""
+    return INDEXES.get(os.path.basename(db_path), {})
+
+
+def _copy(data):
+    """Shallow copy so callers can append/remove without touching the cache"""
+    if isinstance(data, list):
+        return list(data)
+    if isinstance(data, dict):
+        return dict(data)
+    return data
+
+
+def _stamp(db_path):
+    """File identity used to detect changes made by other processes"""
+    st = os.stat(db_path)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _write_json_atomic(db_path, data):
+    """Write a JSON file via temp file + rename so readers never see half a file"""
+    tmp_path = f'{db_path}.tmp.{os.getpid()}.{threading.get_ident()}'
+    with STORAGE_WRITE_SECONDS.time(collection_name(db_path)):
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, db_path)
+
+
+class Collection:
+    """A loaded collection: records by key for lists, the raw value otherwise.
+
+    List collections also maintain the secondary indexes from INDEXES:
+    unique ones map value -> key, the others value -> {key: None} (an
+    insertion-ordered set).
+    """
+
+    def __init__(self, data, key, indexes=None):
+        self.key = key
+        self.is_list = isinstance(data, list)
+        self.records = {}
+        self.value = None
+        self.unique = dict(indexes or {})
+        self.indexes = {field: {} for field in self.unique}
+        # Sorted (created_at, key) list, built on the first paged query
+        self._order = None
+        if self.is_list:
+            for record in data:
+                self.put(self._key_of(record), record)
+        else:
+            self.value = data
+
+    def _key_of(self, record):
+        if isinstance(record, dict) and record.get(self.key) is not None:
+            return record[self.key]
+        # Records without a key keep their position instead
+        return f'#{len(self.records)}'
+
+    def data(self):
+        """Collection contents in the shape they are stored on disk"""
+        if self.is_list:
+            return list(self.records.values())
+        return _copy(self.value)
+
+    @staticmethod
+    def _indexable(value):
+        return value is not None and isinstance(value, (str, int, float, bool))
+
+    def _index(self, key, record):
+        for field, index in self.indexes.items():
+            value = record.get(field)
+            if not self._indexable(value):
+                continue
+            if self.unique[field]:
+                index[value] = key
+            else:
+                index.setdefault(value, {})[key] = None
+
+    def _unindex(self, key, record):
+        for field, index in self.indexes.items():
+            value = record.get(field)
+            if not self._indexable(value):
+                continue
+            if self.unique[field]:
+                if index.get(value) == key:
+                    del index[value]
+            else:
+                keys = index.get(value)
+                if keys is not None:
+                    keys.pop(key, None)
+                    if not keys:
+                        del index[value]
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def put(self, key, record):
+        old = self.records.get(key)
+        if old is not None:
+            self._unindex(key, old)
+        self.records[key] = record
+        if self.indexes and isinstance(record, dict):
+            self._index(key, record)
+        if self._order is not None:
+            new = sort_key(record, key)
+            if old is not None:
+                previous = sort_key(old, key)
+                if previous == new:
+                    return
+                self._remove_order(previous)
+            bisect.insort(self._order, new)
+
+    def delete(self, key):
+        record = self.records.pop(key, None)
+        if record is None:
+            return False
+        if self.indexes and isinstance(record, dict):
+            self._unindex(key, record)
+        if self._order is not None:
+            self._remove_order(sort_key(record, key))
+        return True
+
+    def _remove_order(self, item):
+        i = bisect.bisect_left(self._order, item)
+        if i < len(self._order) and self._order[i] == item:
+            del self._order[i]
+
+    def _ordered(self):
+        order = self._order
+        if order is None:
+            order = sorted(sort_key(r, k) for k, r in self.records.items())
+            self._order = order
+        return order
+
+    def query(self, q):
+        """Records matching q, and the cursor for the next page (or None)"""
+        # Start from the smallest indexed equality match, if any
+        candidates = None
+        for field, value in q.equals.items():
+            if field in self.indexes:
+                found = self.find(field, value)
+                if candidates is None or len(found) < len(candidates):
+                    candidates = found
+
+        if not q.paged:
+            source = self.records.values() if candidates is None else candidates
+            return [r for r in source if q.matches(r)], None
+
+        limit = q.limit if q.limit is not None else len(self.records)
+        page = []
+        if candidates is not None:
+            keyed = sorted(((sort_key(r, r.get(self.key)), r) for r in candidates
+                            if q.matches(r)), key=lambda item: item[0])
+            for position, r in keyed:
+                if q.after is None or position > q.after:
+                    page.append((position, r))
+                    if len(page) > limit:
+                        break
+        else:
+            order = self._ordered()
+            start = bisect.bisect_right(order, q.after) if q.after else 0
+            for i in range(start, len(order)):
+                r = self.records[order[i][1]]
+                if q.matches(r):
+                    page.append((order[i], r))
+                    if len(page) > limit:
+                        break
+
+        next_after = page[limit - 1][0] if len(page) > limit else None
+        return [r for _, r in page[:limit]], next_after
+
+    def check_unique(self, key, record):
+        """Raise IntegrityError if record would duplicate a unique field"""
+        for field, unique in self.unique.items():
+            value = record.get(field)
+            if unique and self._indexable(value):
+                owner = self.indexes[field].get(value)
+                if owner is not None and owner != key:
+                    raise IntegrityError(f"{field} '{value}' already exists")
+
+    def find(self, field, value):
+        """Records whose field equals value, using an index when there is one"""
+        index = self.indexes.get(field)
+        if index is None:
+            return [r for r in self.records.values()
+                    if isinstance(r, dict) and r.get(field) == value]
+        if not self._indexable(value):
+            return []
+        if self.unique[field]:
+            key = index.get(value)
+            return [] if key is None else [self.records[key]]
+        return [self.records[k] for k in index.get(value, ())]
+
+
+def new_collection(db_path, data):
+    """Collection for db_path with its key field and secondary indexes"""
+    return Collection(data, key_field(db_path), index_spec(db_path))
+
+
+class _Entry:
+    """Cache bookkeeping for one collection"""
+
+    __slots__ = ('stamp', 'collection', 'offset')
+
+    def __init__(self, stamp, collection, offset=0):
+        self.stamp = stamp
+        self.collection = collection
+        self.offset = offset
+
+
+class RWLock:
+    """Reader/writer lock: many readers or one writer, writers take priority.
+
+    The writing thread may re-enter (as reader or writer); readers must not
+    upgrade to writer while holding the read lock. With a lock_path the
+    outermost write also takes an exclusive flock() on that file, so writers
+    in other processes (prefork workers, the WhatsApp service) are excluded too.
+    """
+
+    def __init__(self, lock_path=None):
+        self.lock_path = lock_path
+        self._fd = None
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._depth += 1
+                return
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            if self._writer == threading.get_ident():
+                self._depth -= 1
+                return
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._depth += 1
+                return
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = me
+            self._depth = 1
+        if self.lock_path and fcntl is not None:
+            try:
+                self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except BaseException:
+                self._release_file()
+                self.release_write()
+                raise
+
+    def _release_file(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def release_write(self):
+        with self._cond:
+            self._depth -= 1
+            if not self._depth:
+                self._release_file()
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class Store:
+    """Storage backend interface used by load_db/save_db and the record helpers.
+
+    Every collection has its own RWLock: loads take it shared, writes take it
+    exclusively (in this process and, through a lock file, across processes),
+    and transaction() lets callers hold it across a read-modify-write sequence.
+    """
+
+    name = None
+
+    def __init__(self):
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._counters_guard = threading.Lock()
+        self._listeners = {}
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def lock_path(self, db_path):
+        """File used to serialize writers to db_path across processes"""
+        return db_path + '.lock'
+
+    def lock_for(self, db_path):
+        """The RWLock guarding one collection"""
+        lock = self._locks.get(db_path)
+        if lock is None:
+            with self._locks_guard:
+                lock = self._locks.get(db_path)
+                if lock is None:
+                    lock = self._locks[db_path] = RWLock(self.lock_path(db_path))
+        return lock
+
+    def after_fork(self):
+        """Reset per-process state in a freshly forked child"""
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._counters_guard = threading.Lock()
+
+    def transaction(self, db_path):
+        """Hold the collection's write lock across several operations"""
+        return self.lock_for(db_path).write()
+
+    def _count(self, counter, n=1):
+        with self._counters_guard:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def subscribe(self, db_path, listener):
+        """Call listener(old, new, generation) after each record change made here.
+
+        old is None for an insert and new is None for a delete; generation is
+        the collection's generation after the change (it was generation - 1
+        just before). Listeners run under the collection's write lock. Changes
+        other processes append to a journal are reported too, when this
+        process next reads the collection. Whole collection saves, and other
+        processes' changes on backends without a journal, are not reported;
+        they only show up as a generation the listener has not seen.
+        """
+        with self._locks_guard:
+            self._listeners.setdefault(db_path, []).append(listener)
+
+    def _notify(self, db_path, old, new, generation=None):
+        listeners = self._listeners.get(db_path)
+        if listeners:
+            if generation is None:
+                generation = self._generation_now(db_path)
+            for listener in listeners:
+                listener(old, new, generation)
+
+    def _generation_now(self, db_path):
+        """generation() from inside a write, without refreshing anything"""
+        return self.generation(db_path)
+
+    def exists(self, db_path):
+        """Whether the collection has been created"""
+        raise NotImplementedError
+
+    def load(self, db_path, default):
+        """Whole collection (list of records, or a dict for settings)"""
+        raise NotImplementedError
+
+    def save(self, db_path, data):
+        """Replace the whole collection"""
+        raise NotImplementedError
+
+    def get(self, db_path, key):
+        """One record by key, or None"""
+        raise NotImplementedError
+
+    def count(self, db_path):
+        """Number of records in a list collection"""
+        raise NotImplementedError
+
+    def find(self, db_path, field, value):
+        """Records whose field equals value"""
+        raise NotImplementedError
+
+    def query(self, db_path, q):
+        """(records matching Query q, next cursor or None)"""
+        raise NotImplementedError
+
+    def insert(self, db_path, record):
+        """Add (or replace) one record, keyed by key_field(db_path)"""
+        raise NotImplementedError
+
+    def insert_many(self, db_path, records):
+        """Add (or replace) several records in one write; all or none on IntegrityError.
+
+        Listeners are still called once per record, each with its own generation.
+        """
+        raise NotImplementedError
+
+    def update(self, db_path, key, changes):
+        """Merge changes into one record; None if the key does not exist"""
+        raise NotImplementedError
+
+    def delete(self, db_path, key):
+        """Remove one record; False if the key does not exist"""
+        raise NotImplementedError
+
+    def generation(self, db_path):
+        """Counter that changes whenever the collection changes"""
+        raise NotImplementedError
+
+    def version(self, db_path):
+        """(tag, modified) for a collection, the same in every process.
+
+        tag changes whenever the collection changes; modified is the time of
+        the last change in epoch seconds (0 if the collection does not exist).
+        """
+        raise NotImplementedError
+
+    def invalidate(self, db_path=None):
+        """Forget cached state for one collection (or all)"""
+
+    def stats(self):
+        """Backend counters"""
+        with self._counters_guard:
+            return {
+                "backend": self.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "reloads": self.reloads
+            }
+
+
+class JsonStore(Store):
+    """Whole-file JSON collections, cached in memory and invalidated by file stamp"""
+
+    name = 'json'
+
+    def __init__(self):
+        super().__init__()
+        self._entries = {}
+        self._generations = {}
+
+    def _bump(self, db_path):
+        self._generations[db_path] = self._generations.get(db_path, 0) + 1
+
+    def _drop(self, db_path):
+        if self._entries.pop(db_path, None) is not None:
+            self._bump(db_path)
+
+    def _fresh_entry(self, db_path):
+        """Cached entry if it still matches the file, without touching the cache"""
+        entry = self._entries.get(db_path)
+        if entry is None:
+            return None
+        try:
+            if entry.stamp == _stamp(db_path):
+                return entry
+        except FileNotFoundError:
+            pass
+        return None
+
+    def _collection(self, db_path):
+        """Fresh Collection for db_path, or None if it does not exist.
+
+        May reload the cached copy, so callers must hold the write lock.
+        """
+        try:
+            stamp = _stamp(db_path)
+        except FileNotFoundError:
+            self._drop(db_path)
+            return None
+
+        entry = self._entries.get(db_path)
+        if entry is not None and entry.stamp == stamp:
+            self._count('hits')
+            return entry.collection
+
+        try:
+            with STORAGE_PARSE_SECONDS.time(collection_name(db_path)):
+                with open(db_path, 'r') as f:
+                    data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        self._count('reloads' if entry is not None else 'misses')
+        collection = new_collection(db_path, data)
+        self._entries[db_path] = _Entry(stamp, collection)
+        self._bump(db_path)
+        return collection
+
+    def _read(self, db_path, fn):
+        """Call fn(collection) under the read lock, refreshing the cache first if needed"""
+        lock = self.lock_for(db_path)
+        with lock.read():
+            entry = self._fresh_entry(db_path)
+            if entry is not None:
+                self._count('hits')
+                return fn(entry.collection)
+        with lock.write():
+            return fn(self._collection(db_path))
+
+    def _write(self, db_path, collection):
+        """Persist a whole collection and remember it as the cached copy"""
+        _write_json_atomic(db_path, collection.data())
+        self._entries[db_path] = _Entry(_stamp(db_path), collection)
+        self._bump(db_path)
+
+    def _commit(self, db_path, collection, ops):
+        """Persist changes that have already been applied to collection"""
+        self._write(db_path, collection)
+
+    def exists(self, db_path):
+        return os.path.exists(db_path)
+
+    def load(self, db_path, default):
+        return self._read(db_path, lambda c: default if c is None else c.data())
+
+    def save(self, db_path, data):
+        with self.lock_for(db_path).write():
+            self._write(db_path, new_collection(db_path, _copy(data)))
+
+    def get(self, db_path, key):
+        return self._read(db_path, lambda c: None if c is None else c.records.get(key))
+
+    def count(self, db_path):
+        return self._read(db_path, lambda c: 0 if c is None else len(c.records))
+
+    def find(self, db_path, field, value):
+        return self._read(db_path, lambda c: [] if c is None else c.find(field, value))
+
+    def query(self, db_path, q):
+        return self._read(db_path, lambda c: ([], None) if c is None else c.query(q))
+
+    def _list_collection(self, db_path):
+        collection = self._collection(db_path)
+        if collection is None:
+            collection = new_collection(db_path, [])
+        return collection
+
+    def insert(self, db_path, record):
+        with self.lock_for(db_path).write():
+            collection = self._list_collection(db_path)
+            key = collection._key_of(record)
+            collection.check_unique(key, record)
+            old = collection.records.get(key)
+            collection.put(key, record)
+            self._commit(db_path, collection, [{"op": "put", "key": key, "record": record}])
+            self._notify(db_path, old, record)
+        return record
+
+    def insert_many(self, db_path, records):
+        with self.lock_for(db_path).write():
+            collection = self._list_collection(db_path)
+            changes = []
+            try:
+                for record in records:
+                    key = collection._key_of(record)
+                    collection.check_unique(key, record)
+                    changes.append((key, collection.records.get(key), record))
+                    collection.put(key, record)
+            except IntegrityError:
+                # Forget the half-applied batch; the next access reloads from disk
+                self._drop(db_path)
+                raise
+            if not changes:
+                return records
+            self._commit(db_path, collection,
+                         [{"op": "put", "key": key, "record": record} for key, _, record in changes])
+            # One write, but one generation step per record for listeners
+            first = self._generations[db_path] - 1
+            self._generations[db_path] = first + len(changes)
+            for i, (key, old, record) in enumerate(changes, 1):
+                self._notify(db_path, old, record, first + i)
+        return records
+
+    def update(self, db_path, key, changes):
+        with self.lock_for(db_path).write():
+            collection = self._list_collection(db_path)
+            current = collection.records.get(key)
+            if current is None:
+                return None
+            # Records are never modified in place; readers may still hold the old one
+            record = {**current, **changes}
+            collection.check_unique(key, record)
+            collection.put(key, record)
+            self._commit(db_path, collection, [{"op": "put", "key": key, "record": record}])
+            self._notify(db_path, current, record)
+        return record
+
+    def delete(self, db_path, key):
+        with self.lock_for(db_path).write():
+            collection = self._list_collection(db_path)
+            old = collection.records.get(key)
+            if not collection.delete(key):
+                return False
+            self._commit(db_path, collection, [{"op": "del", "key": key}])
+            self._notify(db_path, old, None)
+        return True
+
+    def generation(self, db_path):
+        # Refresh first so changes written by other processes count too
+        return self._read(db_path, lambda c: self._generations.get(db_path, 0))
+
+    def _generation_now(self, db_path):
+        return self._generations.get(db_path, 0)
+
+    def version(self, db_path):
+        try:
+            mtime_ns, size, ino = _stamp(db_path)
+        except FileNotFoundError:
+            return '0', 0
+        return f'{mtime_ns:x}-{size:x}-{ino:x}', mtime_ns / 1e9
+
+    def invalidate(self, db_path=None):
+        for path in ([db_path] if db_path else list(self._entries)):
+            with self.lock_for(path).write():
+                self._drop(path)
+
+    def stats(self):
+        stats = super().stats()
+        stats["collections"] = len(self._entries)
+        return stats
+
+
+class JournalStore(JsonStore):
+    """JSON snapshot plus an append-only per-collection journal of changes"""
+
+    name = 'journal'
+
+    def __init__(self, compact_bytes=JOURNAL_COMPACT_BYTES,
+                 compact_interval=JOURNAL_COMPACT_INTERVAL, fsync=JOURNAL_FSYNC):
+        super().__init__()
+        self.compact_bytes = compact_bytes
+        self.compact_interval = compact_interval
+        self.fsync = fsync
+        self.appends = 0
+        self.replayed = 0
+        self.compactions = 0
+        self._compactor = None
+        self._compactor_guard = threading.Lock()
+
+    @staticmethod
+    def snapshot_path(db_path):
+        """File the journal is folded into"""
+        return db_path
+
+    @staticmethod
+    def journal_path(db_path):
+        return db_path + '.journal'
+
+    def _read_snapshot(self, db_path):
+        with open(self.snapshot_path(db_path), 'r') as f:
+            return json.load(f)
+
+    def _dump_snapshot(self, db_path, data, path):
+        """Write data as db_path's snapshot to path (renamed into place by the caller)"""
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    def _stat(self, db_path):
+        """(stamp, journal size) where stamp identifies snapshot + journal file"""
+        try:
+            snapshot = _stamp(self.snapshot_path(db_path))
+        except FileNotFoundError:
+            snapshot = None
+        try:
+            journal = os.stat(self.journal_path(db_path))
+        except FileNotFoundError:
+            journal = None
+        if snapshot is None and journal is None:
+            return None, 0
+        return (snapshot, journal.st_ino if journal else None), (journal.st_size if journal else 0)
+
+    def version(self, db_path):
+        tag, modified = super().version(self.snapshot_path(db_path))
+        try:
+            journal = os.stat(self.journal_path(db_path))
+        except FileNotFoundError:
+            return tag, modified
+        return (f'{tag}.{journal.st_ino:x}-{journal.st_size:x}',
+                max(modified, journal.st_mtime_ns / 1e9))
+
+    def _replay(self, db_path, collection, offset, notify=False):
+        """Apply journal entries after offset; returns the new offset.
+
+        With notify, each entry is a change another process made to a copy
+        this process has cached: it advances the generation and is reported
+        to subscribers like a change made here.
+        """
+        try:
+            with STORAGE_PARSE_SECONDS.time(collection_name(db_path)):
+                with open(self.journal_path(db_path), 'rb') as f:
+                    f.seek(offset)
+                    chunk = f.read()
+        except FileNotFoundError:
+            return offset
+
+        # A trailing line without newline is a write still in progress (or torn)
+        end = chunk.rfind(b'\n') + 1
+        replayed = 0
+        for line in chunk[:end].splitlines():
+            try:
+                op = json.loads(line)
+            except ValueError:
+                continue
+            if op.get('op') == 'put':
+                old, new = collection.get(op['key']), op['record']
+                collection.put(op['key'], new)
+            elif op.get('op') == 'del':
+                old, new = collection.get(op['key']), None
+                collection.delete(op['key'])
+            else:
+                continue
+            replayed += 1
+            # A writer may replay its own entries again; those change nothing
+            if notify and old != new:
+                self._bump(db_path)
+                self._notify(db_path, old, new, self._generations[db_path])
+        self._count('replayed', replayed)
+        return offset + end
+
+    def _fresh_entry(self, db_path):
+        entry = self._entries.get(db_path)
+        if entry is None:
+            return None
+        stamp, size = self._stat(db_path)
+        if entry.stamp == stamp and entry.offset == size:
+            return entry
+        return None
+
+    def _collection(self, db_path):
+        stamp, size = self._stat(db_path)
+        if stamp is None:
+            self._drop(db_path)
+            return None
+
+        entry = self._entries.get(db_path)
+        if entry is not None and entry.stamp == (stamp[0], None):
+            # The snapshot's first journal: all of it is new entries
+            entry.stamp = stamp
+        if entry is not None and entry.stamp == stamp and size >= entry.offset:
+            if size > entry.offset:
+                # Another process appended; apply only the new entries
+                entry.offset = self._replay(db_path, entry.collection, entry.offset, True)
+            else:
+                self._count('hits')
+            return entry.collection
+
+        data = []
+        if stamp[0] is not None:
+            try:
+                with STORAGE_PARSE_SECONDS.time(collection_name(db_path)):
+                    data = self._read_snapshot(db_path)
+            except (OSError, ValueError):
+                return None
+
+        self._count('reloads' if entry is not None else 'misses')
+        collection = new_collection(db_path, data)
+        offset = self._replay(db_path, collection, 0) if stamp[1] is not None else 0
+        self._entries[db_path] = _Entry(stamp, collection, offset)
+        self._bump(db_path)
+        return collection
+
+    def _commit(self, db_path, collection, ops):
+        # One append for the whole batch
+        line = ''.join(json.dumps(op, separators=(',', ':')) + '\n' for op in ops).encode()
+        journal_path = self.journal_path(db_path)
+        entry = self._entries.get(db_path)
+        with STORAGE_WRITE_SECONDS.time(collection_name(db_path)):
+            fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                if self.fsync:
+                    os.fsync(fd)
+                st = os.fstat(fd)
+            finally:
+                os.close(fd)
+
+        self._count('appends')
+        self._bump(db_path)
+        self._start_compactor()
+        if entry is None:
+            return
+        # Writers hold the collection lock file, so normally nobody else appended
+        # in between; if they did, the next read replays from the old offset
+        # (puts/dels are idempotent)
+        offset = entry.offset if entry.stamp[1] == st.st_ino else 0
+        if offset + len(line) == st.st_size:
+            entry.stamp = (entry.stamp[0], st.st_ino)
+            entry.offset = st.st_size
+
+    def save(self, db_path, data):
+        # A full save is a compaction with new contents
+        with self.lock_for(db_path).write():
+            path = self.snapshot_path(db_path)
+            tmp_path = f'{path}.tmp.{os.getpid()}.{threading.get_ident()}'
+            with STORAGE_WRITE_SECONDS.time(collection_name(db_path)):
+                self._dump_snapshot(db_path, data, tmp_path)
+                os.replace(tmp_path, path)
+            try:
+                os.remove(self.journal_path(db_path))
+            except FileNotFoundError:
+                pass
+            self._entries[db_path] = _Entry((_stamp(path), None),
+                                            new_collection(db_path, _copy(data)))
+            self._bump(db_path)
+
+    def exists(self, db_path):
+        return (os.path.exists(self.snapshot_path(db_path))
+                or os.path.exists(self.journal_path(db_path)))
+
+    def compact(self, db_path):
+        """Fold the journal into the JSON snapshot"""
+        lock = self.lock_for(db_path)
+        with lock.write():
+            collection = self._collection(db_path)
+            if collection is None:
+                return
+            entry = self._entries[db_path]
+            if entry.stamp[1] is None:
+                return
+            stamp, offset = entry.stamp, entry.offset
+            data = collection.data()
+
+        # The slow part (serializing the snapshot) runs without blocking writers
+        path = self.snapshot_path(db_path)
+        tmp_path = f'{path}.compact.{os.getpid()}.{threading.get_ident()}'
+        self._dump_snapshot(db_path, data, tmp_path)
+
+        with lock.write():
+            # Pick up anything appended meanwhile; give up if another process compacted
+            self._collection(db_path)
+            entry = self._entries.get(db_path)
+            if entry is None or entry.stamp != stamp:
+                os.remove(tmp_path)
+                return
+
+            journal_path = self.journal_path(db_path)
+            with open(journal_path, 'rb') as f:
+                f.seek(offset)
+                tail = f.read()
+            tail = tail[:tail.rfind(b'\n') + 1]
+
+            os.replace(tmp_path, path)
+            # Crashing here is safe: replaying the old journal over the new
+            # snapshot gives the same result
+            if tail:
+                tmp_journal = f'{journal_path}.tmp.{os.getpid()}.{threading.get_ident()}'
+                with open(tmp_journal, 'wb') as f:
+                    f.write(tail)
+                os.replace(tmp_journal, journal_path)
+                journal_ino = os.stat(journal_path).st_ino
+            else:
+                os.remove(journal_path)
+                journal_ino = None
+            entry.stamp = (_stamp(path), journal_ino)
+            entry.offset = len(tail)
+            self._count('compactions')
+
+    def compact_all(self, min_bytes=0):
+        """Compact every known collection whose journal is at least min_bytes"""
+        for db_path in list(self._entries):
+            try:
+                size = os.path.getsize(self.journal_path(db_path))
+            except OSError:
+                continue
+            if size >= min_bytes:
+                self.compact(db_path)
+
+    def _start_compactor(self):
+        if self._compactor is not None or self.compact_interval <= 0:
+            return
+        with self._compactor_guard:
+            if self._compactor is None:
+                self._compactor = threading.Thread(target=self._compact_loop, daemon=True,
+                                                   name='journal-compactor')
+                self._compactor.start()
+
+    def _compact_loop(self):
+        while True:
+            time.sleep(self.compact_interval)
+            try:
+                self.compact_all(self.compact_bytes)
+            except Exception as e:
+                print(f"Journal compaction failed: {e}")
+
+    def stats(self):
+        stats = super().stats()
+        with self._counters_guard:
+            stats.update({
+                "appends": self.appends,
+                "replayed": self.replayed,
+                "compactions": self.compactions
+            })
+        return stats
+
+
+class _Overlay:
+    """A mapped snapshot plus the journal's changes on top of it"""
+
+    __slots__ = ('stamp', 'offset', 'snapshot', 'changes', 'size')
+
+    def __init__(self, stamp, snapshot):
+        self.stamp = stamp
+        self.offset = 0
+        self.snapshot = snapshot
+        # key -> record, or None once deleted
+        self.changes = {}
+        self.size = snapshot.count if snapshot is not None else 0
+
+    def get(self, key):
+        if key in self.changes:
+            return self.changes[key]
+        return self.snapshot.get(key) if self.snapshot is not None else None
+
+    # put() and delete() let JournalStore._replay apply the journal here
+
+    def put(self, key, record):
+        if self.get(key) is None:
+            self.size += 1
+        self.changes[key] = record
+
+    def delete(self, key):
+        if self.get(key) is not None:
+            self.size -= 1
+        self.changes[key] = None
+
+    def close(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+
+
+class SnapshotStore(JournalStore):
+    """Journal over a binary snapshot (<collection>.snap) read through mmap.
+
+    Opening a collection maps its snapshot and replays the journal into a
+    small overlay, so get(), count() and generation() cost the same whatever
+    the collection's size and decode only the records they return. The whole
+    collection is decoded the first time anything else (a query, a full
+    load, a write) needs it; from then on it works like the journal backend.
+    """
+
+    name = 'snapshot'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._overlays = {}
+        self.lazy_reads = 0
+
+    @staticmethod
+    def snapshot_path(db_path):
+        return os.path.splitext(db_path)[0] + SNAPSHOT_SUFFIX
+
+    @staticmethod
+    def journal_path(db_path):
+        return SnapshotStore.snapshot_path(db_path) + '.journal'
+
+    def _read_snapshot(self, db_path):
+        with SnapshotFile(self.snapshot_path(db_path)) as snapshot:
+            return snapshot.data()
+
+    def _dump_snapshot(self, db_path, data, path):
+        # Key the records exactly as the decoded collection will
+        collection = Collection(data, key_field(db_path))
+        if collection.is_list:
+            write_snapshot(path, collection.records.items(), collection.key)
+        else:
+            write_snapshot(path, collection.value)
+
+    def _close_overlay(self, db_path):
+        overlay = self._overlays.pop(db_path, None)
+        if overlay is not None:
+            overlay.close()
+        return overlay is not None
+
+    def _fresh_overlay(self, db_path):
+        overlay = self._overlays.get(db_path)
+        if overlay is None:
+            return None
+        stamp, size = self._stat(db_path)
+        if overlay.stamp == stamp and overlay.offset == size:
+            return overlay
+        return None
+
+    def _overlay(self, db_path):
+        """Fresh overlay for db_path, or None if it does not exist; callers hold the write lock"""
+        stamp, size = self._stat(db_path)
+        if stamp is None:
+            if self._close_overlay(db_path):
+                self._bump(db_path)
+            return None
+
+        overlay = self._overlays.get(db_path)
+        if overlay is not None and overlay.stamp == (stamp[0], None):
+            overlay.stamp = stamp
+        if overlay is not None and overlay.stamp == stamp and size >= overlay.offset:
+            if size > overlay.offset:
+                overlay.offset = self._replay(db_path, overlay, overlay.offset, True)
+            else:
+                self._count('hits')
+            return overlay
+
+        reopened = self._close_overlay(db_path)
+        try:
+            snapshot = SnapshotFile(self.snapshot_path(db_path)) if stamp[0] is not None else None
+        except (OSError, ValueError):
+            return None
+        self._count('reloads' if reopened else 'misses')
+        overlay = _Overlay(stamp, snapshot)
+        if stamp[1] is not None:
+            overlay.offset = self._replay(db_path, overlay, 0)
+        self._overlays[db_path] = overlay
+        self._bump(db_path)
+        return overlay
+
+    def _collection(self, db_path):
+        # The decoded collection takes over from the overlay
+        self._close_overlay(db_path)
+        return super()._collection(db_path)
+
+    def _peek(self, db_path, decoded, mapped):
+        """decoded(collection) if db_path is decoded already, else mapped(overlay)"""
+        lock = self.lock_for(db_path)
+        with lock.read():
+            entry = self._fresh_entry(db_path)
+            if entry is not None:
+                self._count('hits')
+                return decoded(entry.collection)
+            overlay = self._fresh_overlay(db_path)
+            if overlay is not None:
+                self._count('hits')
+                self._count('lazy_reads')
+                return mapped(overlay)
+        with lock.write():
+            if db_path in self._entries:
+                return decoded(self._collection(db_path))
+            self._count('lazy_reads')
+            return mapped(self._overlay(db_path))
+
+    def get(self, db_path, key):
+        return self._peek(db_path,
+                          lambda c: None if c is None else c.records.get(key),
+                          lambda o: None if o is None else o.get(key))
+
+    def count(self, db_path):
+        return self._peek(db_path,
+                          lambda c: 0 if c is None else len(c.records),
+                          lambda o: 0 if o is None else o.size)
+
+    def generation(self, db_path):
+        return self._peek(db_path,
+                          lambda c: self._generations.get(db_path, 0),
+                          lambda o: self._generations.get(db_path, 0))
+
+    def save(self, db_path, data):
+        with self.lock_for(db_path).write():
+            self._close_overlay(db_path)
+            super().save(db_path, data)
+
+    def invalidate(self, db_path=None):
+        for path in ([db_path] if db_path else list(self._overlays)):
+            with self.lock_for(path).write():
+                if self._close_overlay(path):
+                    self._bump(path)
+        super().invalidate(db_path)
+
+    def stats(self):
+        stats = super().stats()
+        with self._counters_guard:
+            stats.update({"mapped": len(self._overlays), "lazy_reads": self.lazy_reads})
+        return stats
+
+
+def collection_name(db_path):
+    """Table name for a collection path (database/patients.json -> patients)"""
+    return os.path.splitext(os.path.basename(db_path))[0]
+
+
+class SQLiteStore(Store):
+    """One SQLite table per collection, with indexed columns for common lookups"""
+
+    name = 'sqlite'
+
+    # Record fields copied into their own columns so they can be indexed
+    COLUMNS = ('id', 'patient_id', 'date', 'status', 'username')
+
+    # Indexed columns per collection (the key column is always the primary key)
+    INDEXES = {
+        'patients': ('id',),
+        'appointments': ('id', 'patient_id', 'date', 'status'),
+        'billing': ('id', 'patient_id', 'status'),
+        'pharmacy': ('id',),
+        'prescriptions': ('id', 'patient_id'),
+        'sessions': (),
+        'users': ('id', 'username'),
+        'notifications': ('id', 'status'),
+    }
+
+    def __init__(self, path=SQLITE_PATH):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        self._entries = {}
+        self._tables = set()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS _collections ('
+            'name TEXT PRIMARY KEY, version INTEGER NOT NULL, doc TEXT, modified REAL)'
+        )
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(_collections)')]
+        if 'modified' not in columns:
+            conn.execute('ALTER TABLE _collections ADD COLUMN modified REAL')
+        # Versions restart if the database file is recreated; tell them apart
+        self._created = os.stat(path).st_ino
+
+    def lock_path(self, db_path):
+        return f'{self.path}.{collection_name(db_path)}.lock'
+
+    def after_fork(self):
+        # Connections and cached copies must not be shared with the parent
+        super().after_fork()
+        self._local = threading.local()
+        self._entries = {}
+
+    def _conn(self):
+        """Per-thread connection (sqlite3 connections are not shared across threads)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _ensure_table(self, conn, name):
+        if name in self._tables:
+            return
+        columns = ', '.join(f'"{c}"' for c in self.COLUMNS)
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS "{name}" ('
+            f'key TEXT PRIMARY KEY, {columns}, created_at TEXT, doc TEXT NOT NULL)'
+        )
+        for column in self.INDEXES.get(name, self.COLUMNS):
+            conn.execute(
+                f'CREATE INDEX IF NOT EXISTS "idx_{name}_{column}" ON "{name}"("{column}")'
+            )
+        self._tables.add(name)
+
+    def _row(self, key, record):
+        """Column values for one record"""
+        values = [key]
+        for column in self.COLUMNS + ('created_at',):
+            value = record.get(column)
+            values.append(value if isinstance(value, (str, int, float)) else None)
+        values.append(json.dumps(record, separators=(',', ':')))
+        return values
+
+    def _upsert_sql(self, name):
+        columns = ('key',) + self.COLUMNS + ('created_at', 'doc')
+        names = ', '.join(f'"{c}"' for c in columns)
+        marks = ', '.join('?' for _ in columns)
+        updates = ', '.join(f'"{c}"=excluded."{c}"' for c in columns[1:])
+        return (f'INSERT INTO "{name}" ({names}) VALUES ({marks}) '
+                f'ON CONFLICT(key) DO UPDATE SET {updates}')
+
+    def _version(self, conn, name):
+        row = conn.execute('SELECT version FROM _collections WHERE name=?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def _bump(self, conn, name, doc=None, steps=1):
+        """Advance the collection version inside the current transaction"""
+        conn.execute(
+            'INSERT INTO _collections (name, version, doc, modified) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET version=version+excluded.version, '
+            'doc=excluded.doc, modified=excluded.modified',
+            (name, steps, doc, time.time())
+        )
+        return self._version(conn, name)
+
+    def _write(self, db_path, apply, steps=1):
+        """Run apply(conn, name) in a write transaction and bump the version by steps.
+
+        Callers hold the collection write lock.
+        """
+        name = collection_name(db_path)
+        conn = self._conn()
+        with STORAGE_WRITE_SECONDS.time(name):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                before = self._version(conn, name)
+                self._ensure_table(conn, name)
+                result = apply(conn, name)
+                version = self._bump(conn, name, steps=steps)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return before, version, result
+
+    def _refresh_entry(self, db_path, before, version, change):
+        """Apply a committed change to the cached copy if it was current"""
+        entry = self._entries.get(db_path)
+        if entry is None:
+            return
+        if entry.stamp == before:
+            change(entry.collection)
+            entry.stamp = version
+        else:
+            self._entries.pop(db_path, None)
+
+    def exists(self, db_path):
+        return self._version(self._conn(), collection_name(db_path)) is not None
+
+    def load(self, db_path, default):
+        name = collection_name(db_path)
+        conn = self._conn()
+        lock = self.lock_for(db_path)
+        with lock.read():
+            row = conn.execute('SELECT version, doc FROM _collections WHERE name=?',
+                               (name,)).fetchone()
+            if row is None:
+                return default
+            version, doc = row
+            if doc is not None:
+                return json.loads(doc)
+            entry = self._entries.get(db_path)
+            if entry is not None and entry.stamp == version:
+                self._count('hits')
+                return entry.collection.data()
+
+        with lock.write():
+            version = self._version(conn, name)
+            entry = self._entries.get(db_path)
+            if entry is not None and entry.stamp == version:
+                self._count('hits')
+                return entry.collection.data()
+            self._ensure_table(conn, name)
+            records = [json.loads(d) for (d,) in
+                       conn.execute(f'SELECT doc FROM "{name}" ORDER BY rowid')]
+            self._count('reloads' if entry is not None else 'misses')
+            collection = new_collection(db_path, records)
+            self._entries[db_path] = _Entry(version, collection)
+            return collection.data()
+
+    def save(self, db_path, data):
+        name = collection_name(db_path)
+        conn = self._conn()
+        with self.lock_for(db_path).write():
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if isinstance(data, list):
+                    self._ensure_table(conn, name)
+                    collection = new_collection(db_path, _copy(data))
+                    conn.execute(f'DELETE FROM "{name}"')
+                    conn.executemany(self._upsert_sql(name),
+                                     (self._row(k, r) for k, r in collection.records.items()))
+                    version = self._bump(conn, name)
+                else:
+                    collection = None
+                    version = self._bump(conn, name, json.dumps(data))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            if collection is not None:
+                self._entries[db_path] = _Entry(version, collection)
+            else:
+                self._entries.pop(db_path, None)
+
+    def get(self, db_path, key):
+        name = collection_name(db_path)
+        conn = self._conn()
+        with self.lock_for(db_path).read():
+            if self._version(conn, name) is None:
+                return None
+            self._ensure_table(conn, name)
+            row = conn.execute(f'SELECT doc FROM "{name}" WHERE key=?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def count(self, db_path):
+        name = collection_name(db_path)
+        conn = self._conn()
+        with self.lock_for(db_path).read():
+            version = self._version(conn, name)
+            if version is None:
+                return 0
+            entry = self._entries.get(db_path)
+            if entry is not None and entry.stamp == version:
+                return len(entry.collection.records)
+            self._ensure_table(conn, name)
+            return conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+
+    def find(self, db_path, field, value):
+        if field not in self.COLUMNS:
+            return [r for r in self.load(db_path, []) if r.get(field) == value]
+        name = collection_name(db_path)
+        conn = self._conn()
+        with self.lock_for(db_path).read():
+            if self._version(conn, name) is None:
+                return []
+            self._ensure_table(conn, name)
+            rows = conn.execute(f'SELECT doc FROM "{name}" WHERE "{field}"=? ORDER BY rowid',
+                                (value,)).fetchall()
+        return [json.loads(d) for (d,) in rows]
+
+    def _field_sql(self, field):
+        if field in self.COLUMNS or field == 'created_at':
+            return f'"{field}"'
+        return f"json_extract(doc, '$.{field}')"
+
+    def query(self, db_path, q):
+        name = collection_name(db_path)
+        conn = self._conn()
+        where, params = [], []
+        for field, value in q.equals.items():
+            if not field.replace('_', '').isalnum():
+                return [], None
+            where.append(f'{self._field_sql(field)} = ?')
+            params.append(value)
+        day = "COALESCE(\"date\", substr(created_at, 1, 10))"
+        if q.date_from:
+            where.append(f'{day} >= ?')
+            params.append(q.date_from)
+        if q.date_to:
+            where.append(f'{day} <= ?')
+            params.append(q.date_to)
+        if q.after:
+            where.append("(COALESCE(created_at, ''), key) > (?, ?)")
+            params.extend(q.after)
+        sql = f'SELECT doc, COALESCE(created_at, \'\'), key FROM "{name}"'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        if q.paged:
+            sql += " ORDER BY COALESCE(created_at, ''), key"
+            if q.limit is not None:
+                sql += ' LIMIT ?'
+                params.append(q.limit + 1)
+        else:
+            sql += ' ORDER BY rowid'
+
+        with self.lock_for(db_path).read():
+            if self._version(conn, name) is None:
+                return [], None
+            self._ensure_table(conn, name)
+            rows = conn.execute(sql, params).fetchall()
+        next_after = None
+        if q.limit is not None and len(rows) > q.limit:
+            rows = rows[:q.limit]
+            next_after = (rows[-1][1], rows[-1][2])
+        return [json.loads(doc) for doc, _, _ in rows], next_after
+
+    def _check_unique(self, conn, db_path, name, key, record):
+        for field, unique in index_spec(db_path).items():
+            value = record.get(field)
+            if unique and field in self.COLUMNS and value is not None:
+                row = conn.execute(f'SELECT key FROM "{name}" WHERE "{field}"=? AND key<>? LIMIT 1',
+                                   (value, key)).fetchone()
+                if row:
+                    raise IntegrityError(f"{field} '{value}' already exists")
+
+    def _old_doc(self, conn, db_path, name, key):
+        """Current record for key when someone is listening for changes"""
+        if not self._listeners.get(db_path):
+            return None
+        row = conn.execute(f'SELECT doc FROM "{name}" WHERE key=?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def insert(self, db_path, record):
+        key = record.get(key_field(db_path))
+
+        def apply(conn, name):
+            nonlocal key
+            if key is None:
+                count = conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+                key = f'#{count}'
+            self._check_unique(conn, db_path, name, key, record)
+            old = self._old_doc(conn, db_path, name, key)
+            conn.execute(self._upsert_sql(name), self._row(key, record))
+            return old
+
+        with self.lock_for(db_path).write():
+            before, version, old = self._write(db_path, apply)
+            self._refresh_entry(db_path, before, version, lambda c: c.put(key, record))
+            self._notify(db_path, old, record)
+        return record
+
+    def insert_many(self, db_path, records):
+        if not records:
+            return records
+        field = key_field(db_path)
+
+        def apply(conn, name):
+            changes = []
+            for record in records:
+                key = record.get(field)
+                if key is None:
+                    count = conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+                    key = f'#{count}'
+                self._check_unique(conn, db_path, name, key, record)
+                old = self._old_doc(conn, db_path, name, key)
+                conn.execute(self._upsert_sql(name), self._row(key, record))
+                changes.append((key, old, record))
+            return changes
+
+        def change(collection):
+            for key, _, record in changes:
+                collection.put(key, record)
+
+        with self.lock_for(db_path).write():
+            before, version, changes = self._write(db_path, apply, steps=len(records))
+            self._refresh_entry(db_path, before, version, change)
+            first = version - len(changes)
+            for i, (key, old, record) in enumerate(changes, 1):
+                self._notify(db_path, old, record, first + i)
+        return records
+
+    def update(self, db_path, key, changes):
+        def apply(conn, name):
+            row = conn.execute(f'SELECT doc FROM "{name}" WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            current = json.loads(row[0])
+            record = {**current, **changes}
+            self._check_unique(conn, db_path, name, key, record)
+            conn.execute(self._upsert_sql(name), self._row(key, record))
+            return current, record
+
+        with self.lock_for(db_path).write():
+            before, version, result = self._write(db_path, apply)
+            if result is None:
+                return None
+            current, record = result
+            self._refresh_entry(db_path, before, version, lambda c: c.put(key, record))
+            self._notify(db_path, current, record)
+        return record
+
+    def delete(self, db_path, key):
+        def apply(conn, name):
+            old = self._old_doc(conn, db_path, name, key)
+            deleted = conn.execute(f'DELETE FROM "{name}" WHERE key=?', (key,)).rowcount > 0
+            return old, deleted
+
+        with self.lock_for(db_path).write():
+            before, version, (old, deleted) = self._write(db_path, apply)
+            self._refresh_entry(db_path, before, version, lambda c: c.delete(key))
+            if deleted:
+                self._notify(db_path, old, None)
+        return deleted
+
+    def generation(self, db_path):
+        return self._version(self._conn(), collection_name(db_path)) or 0
+
+    def version(self, db_path):
+        row = self._conn().execute('SELECT version, modified FROM _collections WHERE name=?',
+                                   (collection_name(db_path),)).fetchone()
+        if row is None:
+            return '0', 0
+        return f'{self._created:x}-{row[0]:x}', row[1] or 0
+
+    def invalidate(self, db_path=None):
+        for path in ([db_path] if db_path else list(self._entries)):
+            with self.lock_for(path).write():
+                self._entries.pop(path, None)
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({"path": self.path, "collections": len(self._entries)})
+        return stats
+
+
+def _copy_collections(db_dir, suffix, source, target):
+    """Copy every collection stored in db_dir as *suffix from source to target"""
+    copied = {}
+    for filename in sorted(os.listdir(db_dir)):
+        if not filename.endswith(suffix):
+            continue
+        db_path = os.path.join(db_dir, filename[:-len(suffix)] + '.json')
+        data = source.load(db_path, None)
+        if data is None:
+            continue
+        target.save(db_path, data)
+        copied[collection_name(db_path)] = len(data) if isinstance(data, list) else 1
+    return copied
+
+
+def migrate_json_to_sqlite(db_dir='database', sqlite_path=SQLITE_PATH):
+    """Copy every JSON collection in db_dir (including unfolded journals) into SQLite"""
+    return _copy_collections(db_dir, '.json', JournalStore(compact_interval=0),
+                             SQLiteStore(sqlite_path))
+
+
+def convert_json_to_snapshot(db_dir='database'):
+    """Write a .snap snapshot of every JSON collection in db_dir (including unfolded journals)"""
+    return _copy_collections(db_dir, '.json', JournalStore(compact_interval=0),
+                             SnapshotStore(compact_interval=0))
+
+
+def convert_snapshot_to_json(db_dir='database'):
+    """Write every .snap collection in db_dir (including its journal) back to JSON"""
+    return _copy_collections(db_dir, SNAPSHOT_SUFFIX, SnapshotStore(compact_interval=0),
+                             JournalStore(compact_interval=0))
+
+
+def open_store(backend=STORAGE_BACKEND):
+    """Create the store for a backend name"""
+    if backend == 'journal':
+        return JournalStore()
+    if backend == 'sqlite':
+        return SQLiteStore()
+    if backend == 'snapshot':
+        return SnapshotStore()
+    if backend == 'json':
+        return JsonStore()
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+_store = open_store()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=lambda: _store.after_fork())
+
+
+def _timed(op):
+    """Record a module-level storage call in STORAGE_SECONDS"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def timed(db_path, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(db_path, *args, **kwargs)
+            finally:
+                STORAGE_SECONDS.observe(time.perf_counter() - start, op, collection_name(db_path))
+        return timed
+    return decorate
+
+
+@_timed('load')
+def load_db(db_path, default=None):
+    """Load database from JSON file (served from memory when unchanged)"""
+    if default is None:
+        default = []
+    return _store.load(db_path, default)
+
+
+@_timed('save')
+def save_db(db_path, data):
+    """Save database to JSON file"""
+    _store.save(db_path, data)
+
+
+def db_exists(db_path):
+    """Check whether a collection has been created"""
+    return _store.exists(db_path)
+
+
+@_timed('get')
+def get_record(db_path, key):
+    """One record by key (id, or token for sessions); None if missing"""
+    return _store.get(db_path, key)
+
+
+@_timed('count')
+def count_records(db_path):
+    """Number of records in a collection"""
+    return _store.count(db_path)
+
+
+@_timed('find')
+def find_records(db_path, field, value):
+    """Records whose field equals value (indexed for the fields in INDEXES)"""
+    return _store.find(db_path, field, value)
+
+
+@_timed('find')
+def find_record(db_path, field, value):
+    """First record whose field equals value, or None"""
+    records = _store.find(db_path, field, value)
+    return records[0] if records else None
+
+
+@_timed('query')
+def query_records(db_path, q):
+    """(records matching a Query, next keyset cursor or None)"""
+    return _store.query(db_path, q)
+
+
+@_timed('insert')
+def insert_record(db_path, record):
+    """Add one record to a list collection"""
+    return _store.insert(db_path, record)
+
+
+@_timed('insert_many')
+def insert_records(db_path, records):
+    """Add several records in one storage write (one file rewrite, append or transaction)"""
+    return _store.insert_many(db_path, records)
+
+
+@_timed('update')
+def update_record(db_path, key, changes):
+    """Merge changes into the record with this key; None if it does not exist.
+
+    insert_record and update_record raise IntegrityError on a unique index clash.
+    """
+    return _store.update(db_path, key, changes)
+
+
+@_timed('delete')
+def delete_record(db_path, key):
+    """Remove the record with this key; False if it did not exist"""
+    return _store.delete(db_path, key)
+
+
+def transaction(db_path):
+    """Hold a collection's write lock across a read-modify-write sequence"""
+    return _store.transaction(db_path)
+
+
+def db_generation(db_path):
+    """Change counter for a collection, bumped on every write or reload"""
+    return _store.generation(db_path)
+
+
+def subscribe(db_path, listener):
+    """Register listener(old, new, generation) for record changes to a collection"""
+    _store.subscribe(db_path, listener)
+
+
+class MaterializedView:
+    """Derived state over one collection, maintained from change notifications.
+
+    Subclasses implement reset() and apply(). The view remembers which
+    collection generation it reflects; if a change arrives out of sequence,
+    or read() finds the collection has moved on (the whole collection was
+    saved or compacted, or another process wrote to a json or sqlite
+    collection), it rebuilds from a full load.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._generation = None
+        self.rebuilds = 0
+        subscribe(db_path, self._on_change)
+
+    def reset(self):
+        """Clear the derived state"""
+        raise NotImplementedError
+
+    def apply(self, record, sign):
+        """Add (sign 1) or remove (sign -1) one record's contribution"""
+        raise NotImplementedError
+
+    def _on_change(self, old, new, generation):
+        # Runs under the collection's write lock, so changes arrive in order
+        with self._lock:
+            if self._generation != generation - 1:
+                # Missed something in between; rebuild on the next read
+                self._generation = None
+                return
+            if isinstance(old, dict):
+                self.apply(old, -1)
+            if isinstance(new, dict):
+                self.apply(new, 1)
+            self._generation = generation
+
+    def rebuild(self):
+        """Recompute from the full collection"""
+        # Same lock order as _on_change: collection first, then the view
+        with transaction(self.db_path):
+            records = load_db(self.db_path, [])
+            generation = db_generation(self.db_path)
+            with self._lock:
+                self._seed()
+                for record in records:
+                    if isinstance(record, dict):
+                        self.apply(record, 1)
+                self._generation = generation
+                self.rebuilds += 1
+
+    def _seed(self):
+        """State a rebuild applies the collection's records to"""
+        self.reset()
+
+    def read(self, fn):
+        """fn(self) on up-to-date state"""
+        if db_generation(self.db_path) != self._generation:
+            self.rebuild()
+        with self._lock:
+            return fn(self)
+
+
+def db_version(db_path):
+    """(tag, modified) identifying the collection's current contents across processes"""
+    return _store.version(db_path)
+
+
+def cache_stats():
+    """Collection cache counters"""
+    return _store.stats()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'migrate':
+        db_dir = sys.argv[2] if len(sys.argv) > 2 else 'database'
+        sqlite_path = sys.argv[3] if len(sys.argv) > 3 else SQLITE_PATH
+        for name, count in migrate_json_to_sqlite(db_dir, sqlite_path).items():
+            print(f'{name}: {count} records')
+        print(f'Migrated {db_dir} into {sqlite_path}')
+        print('Start the server with STORAGE_BACKEND=sqlite to use it')
+    elif len(sys.argv) >= 2 and sys.argv[1] in ('to-snapshot', 'to-json'):
+        db_dir = sys.argv[2] if len(sys.argv) > 2 else 'database'
+        convert = convert_json_to_snapshot if sys.argv[1] == 'to-snapshot' else convert_snapshot_to_json
+        for name, count in convert(db_dir).items():
+            print(f'{name}: {count} records')
+        if sys.argv[1] == 'to-snapshot':
+            print(f'Wrote {SNAPSHOT_SUFFIX} snapshots in {db_dir}')
+            print('Start the server with STORAGE_BACKEND=snapshot to use them')
+        else:
+            print(f'Wrote JSON collections in {db_dir}')
+    else:
+        print('Usage: python3 storage.py migrate [db_dir] [sqlite_path]')
+        print('       python3 storage.py to-snapshot|to-json [db_dir]')
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Hospital Management System - Patient Search Tests
+Run from backend/: python3 -m unittest test_search
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import search
+from search import PatientSearchIndex
+from storage import save_db
+
+
+class MultiWordSearchTest(unittest.TestCase):
+    """Queries mixing a common term with a rare one"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='hms-search-')
+        self.db_path = os.path.join(self.dir, 'patients.json')
+        patients = [{"id": f"c{i}", "full_name": "John Smith"} for i in range(300)]
+        patients += [{"id": f"r{i}", "full_name": f"John Q{i}rare"} for i in range(20)]
+        save_db(self.db_path, patients)
+        self.index = PatientSearchIndex(self.db_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def ids(self, query, limit=search.SEARCH_MAX_LIMIT):
+        return [patient_id for patient_id, _ in self.index.search(query, limit)]
+
+    def test_common_term_does_not_crowd_out_rare_matches(self):
+        # Far fewer candidates than patients named John
+        with mock.patch.object(search, 'SEARCH_MAX_CANDIDATES', 50):
+            for i in range(20):
+                self.assertEqual(self.ids(f'John Q{i}rare'), [f'r{i}'])
+                self.assertEqual(self.ids(f'q{i}rare john'), [f'r{i}'])
+
+    def test_cap_counts_whole_query_matches(self):
+        with mock.patch.object(search, 'SEARCH_MAX_CANDIDATES', 50):
+            found = self.ids('john smith')
+        self.assertEqual(len(found), 50)
+        self.assertTrue(all(patient_id.startswith('c') for patient_id in found))
+
+    def test_typo_in_short_term(self):
+        self.assertIn('r3', self.ids('jhon q3rare'))
+
+
+if __name__ == '__main__':
+    unittest.main()
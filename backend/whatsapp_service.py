@@ -4,48 +4,72 @@ WhatsApp Notification Service
 Handles sending notifications via WhatsApp API
 """
 
+import heapq
 import json
 import os
+import socket
+import sys
 import time
-from datetime import datetime
-from urllib.request import Request, urlopen
-from urllib.error import URLError
+from datetime import datetime, timedelta
+from http.client import HTTPException
+
+import metrics
+from dispatcher import ApiClient, DeliveryError, Dispatcher, TokenBucket, backoff_delay
+from notifications import NotificationQueue
+from scheduling import DEFAULT_HOURS, FREE_STATUSES, parse_time
+from storage import load_db, get_record, transaction, db_generation, MaterializedView
 
 DB_DIR = 'database'
 NOTIFICATIONS_DB = os.path.join(DB_DIR, 'notifications.json')
 SETTINGS_DB = os.path.join(DB_DIR, 'settings.json')
 PATIENTS_DB = os.path.join(DB_DIR, 'patients.json')
+APPOINTMENTS_DB = os.path.join(DB_DIR, 'appointments.json')
 
-def load_db(db_path, default=None):
-    """Load database from JSON file"""
-    if default is None:
-        default = []
-    if not os.path.exists(db_path):
-        return default
-    try:
-        with open(db_path, 'r') as f:
-            return json.load(f)
-    except:
-        return default
+# Provider configuration (api_url in the WhatsApp settings overrides WHATSAPP_API_URL)
+WHATSAPP_API_URL = os.environ.get('WHATSAPP_API_URL', 'https://api.whatsapp.example.com/send')
+WHATSAPP_TIMEOUT = float(os.environ.get('WHATSAPP_TIMEOUT', 10))
+WHATSAPP_CONCURRENCY = int(os.environ.get('WHATSAPP_CONCURRENCY', 4))
+# Token bucket matched to the provider quota: sustained rate and burst size
+WHATSAPP_RATE_PER_SECOND = float(os.environ.get('WHATSAPP_RATE_PER_SECOND', 10))
+WHATSAPP_BURST = int(os.environ.get('WHATSAPP_BURST', 20))
+
+# Retries: exponential backoff from NOTIFY_RETRY_BASE seconds, capped at
+# NOTIFY_RETRY_MAX; after NOTIFY_MAX_ATTEMPTS sends the entry is a dead letter
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get('NOTIFY_MAX_ATTEMPTS', 5))
+NOTIFY_RETRY_BASE = float(os.environ.get('NOTIFY_RETRY_BASE', 2))
+NOTIFY_RETRY_MAX = float(os.environ.get('NOTIFY_RETRY_MAX', 300))
+
+# Reminders: hours before each appointment, and days after a completed one
+# for the follow-up (0 turns follow-ups off). Reminders missed by more than
+# REMINDER_GRACE_SECONDS (service down, appointment booked late) are skipped;
+# keep it below NOTIFY_ARCHIVE_AFTER so a restart cannot send one twice.
+REMINDER_HOURS_BEFORE = [float(h) for h in
+                         os.environ.get('REMINDER_HOURS_BEFORE', '24,2').split(',') if h.strip()]
+REMINDER_FOLLOWUP_DAYS = float(os.environ.get('REMINDER_FOLLOWUP_DAYS', 30))
+REMINDER_GRACE_SECONDS = float(os.environ.get('REMINDER_GRACE_SECONDS', 900))
+
+# Prometheus metrics on http://127.0.0.1:<port>/metrics (0 = off)
+NOTIFY_METRICS_PORT = int(os.environ.get('NOTIFY_METRICS_PORT', 8002))
 
-def save_db(db_path, data):
-    """Save database to JSON file"""
-    with open(db_path, 'w') as f:
-        json.dump(data, f, indent=2)
+QUEUE = NotificationQueue(NOTIFICATIONS_DB)
+# Lease owner name for entries this process is sending
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+DISPATCHER = Dispatcher(QUEUE, WORKER_ID, WHATSAPP_CONCURRENCY)
+RATE_LIMIT = TokenBucket(WHATSAPP_RATE_PER_SECOND, WHATSAPP_BURST)
+CLIENTS = {}
 
-def send_whatsapp_message(phone_number, message, api_key):
+def send_whatsapp_message(client, phone_number, message, api_key):
     """
     Send WhatsApp message using API
     This is a generic implementation that can work with various WhatsApp APIs
     (Twilio, WhatsApp Business API, etc.)
+    
+    Returns the provider's response; raises DeliveryError if it was not accepted.
     """
     # Example implementation - adjust based on your WhatsApp API provider
     # This uses a generic REST API pattern
     
-    api_url = "https://api.whatsapp.example.com/send"  # Replace with actual API
-    
     headers = {
-        'Content-Type': 'application/json',
         'Authorization': f'Bearer {api_key}'
     }
     
@@ -54,21 +78,180 @@ def send_whatsapp_message(phone_number, message, api_key):
         'message': message
     }
     
+    RATE_LIMIT.acquire()
     try:
-        request = Request(
-            api_url,
-            data=json.dumps(data).encode(),
-            headers=headers,
-            method='POST'
-        )
-        
-        with urlopen(request, timeout=10) as response:
-            result = json.loads(response.read().decode())
-            return True, result
-    except URLError as e:
-        return False, str(e)
-    except Exception as e:
-        return False, str(e)
+        status, response_headers, body = client.post(data, headers)
+    except (OSError, HTTPException) as e:
+        raise DeliveryError(f"{type(e).__name__}: {e}")
+    
+    if 200 <= status < 300:
+        try:
+            return json.loads(body.decode() or 'null')
+        except ValueError:
+            return body.decode(errors='replace')
+    
+    error = f"HTTP {status}: {body[:200].decode(errors='replace')}"
+    # Throttled or provider trouble: try again later; other 4xx will not get better
+    if status == 429 or status >= 500:
+        retry_after = response_headers.get('Retry-After', '')
+        raise DeliveryError(error, retry_after=float(retry_after) if retry_after.isdigit() else None)
+    raise DeliveryError(error, retryable=False)
+
+def api_client(api_url):
+    """Keep-alive client for the provider URL (one per URL, shared by the pool)"""
+    client = CLIENTS.get(api_url)
+    if client is None:
+        client = CLIENTS[api_url] = ApiClient(api_url, WHATSAPP_TIMEOUT)
+    return client
+
+def appointment_start(record):
+    """datetime the appointment starts (day start when it has no time), else None"""
+    start = parse_time(record.get('time'))
+    if start is None:
+        start = parse_time(DEFAULT_HOURS['day_start'])
+    try:
+        day = datetime.strptime(str(record.get('date')), '%Y-%m-%d')
+    except ValueError:
+        return None
+    return day + timedelta(minutes=start)
+
+def reminder_plan(record):
+    """((fire time, kind), ...) for an appointment: upcoming reminders, or the follow-up once completed"""
+    status = record.get('status')
+    if status in FREE_STATUSES:
+        return ()
+    start = appointment_start(record)
+    if start is None:
+        return ()
+    if status == 'completed':
+        if REMINDER_FOLLOWUP_DAYS <= 0:
+            return ()
+        return (((start + timedelta(days=REMINDER_FOLLOWUP_DAYS)).timestamp(), 'followup'),)
+    return tuple(((start - timedelta(hours=h)).timestamp(), f'{h:g}h')
+                 for h in REMINDER_HOURS_BEFORE)
+
+class ReminderSchedule(MaterializedView):
+    """Min-heap of reminder due times over the appointments collection.
+
+    Firing pops only due entries; booking, rescheduling or cancelling an
+    appointment adds or invalidates just that appointment's entries. Stale
+    heap entries are skipped when they surface and compacted away in bulk.
+    """
+
+    def __init__(self, db_path):
+        self.reset()
+        super().__init__(db_path)
+
+    def reset(self):
+        self._plans = {}     # appointment id -> reminder_plan()
+        self._pending = {}   # appointment id -> {(fire time, kind)} not yet fired
+        self._heap = []      # (fire time, appointment id, kind), possibly stale
+
+    def _schedule(self, appointment_id, plan):
+        cutoff = time.time() - REMINDER_GRACE_SECONDS
+        pending = {(at, kind) for at, kind in plan if at >= cutoff}
+        if pending:
+            self._pending[appointment_id] = pending
+        else:
+            self._pending.pop(appointment_id, None)
+        for at, kind in pending:
+            heapq.heappush(self._heap, (at, appointment_id, kind))
+
+    def apply(self, record, sign):
+        appointment_id = record.get('id')
+        if appointment_id is None:
+            return
+        appointment_id = str(appointment_id)
+        if sign < 0:
+            self._plans.pop(appointment_id, None)
+            self._pending.pop(appointment_id, None)
+            return
+        plan = reminder_plan(record)
+        if plan:
+            self._plans[appointment_id] = plan
+            self._schedule(appointment_id, plan)
+
+    def rebuild(self):
+        """Resync with the collection, rescheduling only appointments whose reminders changed.
+
+        Runs at startup and whenever the collection had to be reloaded whole:
+        after a compaction or full save, and on the json and sqlite backends
+        after every write by another process (the API server). That is a
+        full scan; the journal and snapshot backends report the API server's
+        changes one by one instead. Reminders already fired stay fired.
+        """
+        with transaction(self.db_path):
+            records = load_db(self.db_path, [])
+            generation = db_generation(self.db_path)
+            with self._lock:
+                plans = {}
+                for record in records:
+                    if isinstance(record, dict) and record.get('id') is not None:
+                        plan = reminder_plan(record)
+                        if plan:
+                            plans[str(record['id'])] = plan
+                for appointment_id, plan in plans.items():
+                    if self._plans.get(appointment_id) != plan:
+                        self._schedule(appointment_id, plan)
+                for appointment_id in self._plans.keys() - plans.keys():
+                    self._pending.pop(appointment_id, None)
+                self._plans = plans
+                live = sum(len(p) for p in self._pending.values())
+                if len(self._heap) > 2 * live + 64:
+                    self._heap = [(at, i, kind) for i, p in self._pending.items() for at, kind in p]
+                    heapq.heapify(self._heap)
+                self._generation = generation
+                self.rebuilds += 1
+
+    def _drop_stale(self):
+        heap = self._heap
+        while heap and (heap[0][0], heap[0][2]) not in self._pending.get(heap[0][1], ()):
+            heapq.heappop(heap)
+
+    def next_due(self):
+        """Epoch time of the next reminder, None if nothing is scheduled"""
+        def peek(index):
+            index._drop_stale()
+            return index._heap[0][0] if index._heap else None
+        return self.read(peek)
+
+    def pop_due(self, now=None):
+        """[(appointment id, kind, fire time)] due by now, removed from the schedule"""
+        now = time.time() if now is None else now
+        def pop(index):
+            due = []
+            while True:
+                index._drop_stale()
+                if not index._heap or index._heap[0][0] > now:
+                    return due
+                at, appointment_id, kind = heapq.heappop(index._heap)
+                pending = index._pending[appointment_id]
+                pending.discard((at, kind))
+                if not pending:
+                    del index._pending[appointment_id]
+                if at >= now - REMINDER_GRACE_SECONDS:
+                    due.append((appointment_id, kind, at))
+        return self.read(pop)
+
+    def stats(self):
+        return self.read(lambda index: {
+            "appointments": len(index._plans),
+            "pending": sum(len(p) for p in index._pending.values()),
+            "heap": len(index._heap)
+        })
+
+REMINDERS = ReminderSchedule(APPOINTMENTS_DB)
+
+# Instrumentation
+SEND_SECONDS = metrics.histogram('hms_notification_send_seconds',
+                                 'Provider API calls, including rate-limit waits', ('outcome',))
+NOTIFICATIONS_TOTAL = metrics.counter('hms_notifications_total',
+                                      'Notifications handled by outcome', ('type', 'outcome'))
+REMINDERS_TOTAL = metrics.counter('hms_reminders_queued_total', 'Reminders queued', ('kind',))
+metrics.gauge('hms_notification_queue_depth', 'Notification queue entries by status',
+              QUEUE.stats, ('status',))
+metrics.gauge('hms_reminders_scheduled', 'Reminders waiting to fire',
+              lambda: REMINDERS.stats()['pending'])
 
 def format_appointment_message(appointment, patient):
     """Format appointment notification message"""
@@ -107,78 +290,172 @@ Thank you for choosing our hospital!
     """.strip()
     return message
 
+def fire_reminders():
+    """Queue the reminders that are due; returns how many were queued"""
+    due = REMINDERS.pop_due()
+    if not due:
+        return 0
+    settings = load_db(SETTINGS_DB, {})
+    if not settings.get('whatsapp', {}).get('enabled'):
+        return 0
+    queued = 0
+    for appointment_id, kind, at in due:
+        appointment = get_record(APPOINTMENTS_DB, appointment_id)
+        if not appointment:
+            continue
+        notification_type = 'followup_reminder' if kind == 'followup' else 'appointment_reminder'
+        # The id makes this idempotent across restarts and repeated firings
+        if QUEUE.enqueue(notification_type, appointment,
+                         notification_id=f'reminder:{appointment_id}:{kind}:{int(at)}'):
+            REMINDERS_TOTAL.inc('followup' if kind == 'followup' else 'before')
+            queued += 1
+    return queued
+
+# Why sending was last skipped, so the service logs it once rather than on every pass
+_not_sending = None
+
+
+def _skip_sending(reason):
+    global _not_sending
+    if reason != _not_sending:
+        print(reason)
+    _not_sending = reason
+    return False
+
+
 def process_notifications():
-    """Process pending notifications"""
+    """Process pending notifications; False if sending is disabled or not configured"""
+    global _not_sending
     settings = load_db(SETTINGS_DB, {})
     whatsapp = settings.get('whatsapp', {})
     
     if not whatsapp.get('enabled'):
-        print("WhatsApp notifications are disabled")
-        return
+        return _skip_sending("WhatsApp notifications are disabled")
     
     api_key = whatsapp.get('api_key')
     if not api_key:
-        print("WhatsApp API key not configured")
+        return _skip_sending("WhatsApp API key not configured")
+    
+    try:
+        client = api_client(whatsapp.get('api_url') or WHATSAPP_API_URL)
+    except ValueError as e:
+        return _skip_sending(str(e))
+    _not_sending = None
+    
+    # Each claimed entry is leased to this process, so a second service
+    # instance skips it
+    DISPATCHER.drain(lambda notification: send_notification(notification, client, api_key))
+    return True
+
+def send_notification(notification, client, api_key):
+    """Send one claimed notification and record the outcome"""
+    # Get patient information
+    data = notification.get('data', {})
+    patient_id = data.get('patient_id')
+    
+    notification_type = notification.get('type')
+    patient = get_record(PATIENTS_DB, patient_id) if patient_id else None
+    if not patient:
+        QUEUE.fail(notification['id'], WORKER_ID, 'Patient not found')
+        NOTIFICATIONS_TOTAL.inc(notification_type, 'failed')
         return
     
-    notifications = load_db(NOTIFICATIONS_DB, [])
-    patients = load_db(PATIENTS_DB, [])
+    phone = patient.get('phone')
+    if not phone:
+        QUEUE.fail(notification['id'], WORKER_ID, 'No phone number')
+        NOTIFICATIONS_TOTAL.inc(notification_type, 'failed')
+        return
     
-    for notification in notifications:
-        if notification.get('status') != 'pending':
-            continue
-        
-        # Get patient information
-        data = notification.get('data', {})
-        patient_id = data.get('patient_id')
-        
-        patient = next((p for p in patients if p.get('id') == patient_id), None)
-        if not patient:
-            notification['status'] = 'failed'
-            notification['error'] = 'Patient not found'
-            continue
-        
-        phone = patient.get('phone')
-        if not phone:
-            notification['status'] = 'failed'
-            notification['error'] = 'No phone number'
-            continue
-        
-        # Format message based on notification type
-        notification_type = notification.get('type')
-        if notification_type == 'appointment_scheduled':
-            message = format_appointment_message(data, patient)
-        elif notification_type == 'followup_reminder':
-            message = format_followup_message(patient)
-        else:
-            message = f"Hospital notification: {notification_type}"
-        
-        # Send message
-        success, result = send_whatsapp_message(phone, message, api_key)
-        
-        if success:
-            notification['status'] = 'sent'
-            notification['sent_at'] = datetime.now().isoformat()
+    # Format message based on notification type
+    if notification_type in ('appointment_scheduled', 'appointment_reminder'):
+        message = format_appointment_message(data, patient)
+    elif notification_type == 'followup_reminder':
+        message = format_followup_message(patient)
+    else:
+        message = f"Hospital notification: {notification_type}"
+    
+    # Send message
+    start = time.perf_counter()
+    try:
+        send_whatsapp_message(client, phone, message, api_key)
+    except DeliveryError as e:
+        SEND_SECONDS.observe(time.perf_counter() - start, 'error')
+        attempts = notification.get('attempts', 1)
+        detail = str(e)
+        if not e.retryable:
+            QUEUE.fail(notification['id'], WORKER_ID, e)
+            outcome = 'failed'
+        elif attempts >= NOTIFY_MAX_ATTEMPTS:
+            QUEUE.dead(notification['id'], WORKER_ID, e)
+            outcome = 'dead'
         else:
-            notification['status'] = 'failed'
-            notification['error'] = str(result)
-        
-        print(f"Notification {notification['id']}: {notification['status']}")
+            delay = max(backoff_delay(attempts, NOTIFY_RETRY_BASE, NOTIFY_RETRY_MAX),
+                        e.retry_after or 0)
+            QUEUE.retry(notification['id'], WORKER_ID, e, delay)
+            # Let the service loop recompute how long to sleep
+            QUEUE.wake()
+            outcome = 'retry'
+            detail += f'; retry in {delay:.1f}s'
+        NOTIFICATIONS_TOTAL.inc(notification_type, outcome)
+        print(f"Notification {notification['id']}: {outcome} ({detail})")
+        return
     
-    save_db(NOTIFICATIONS_DB, notifications)
+    SEND_SECONDS.observe(time.perf_counter() - start, 'sent')
+    NOTIFICATIONS_TOTAL.inc(notification_type, 'sent')
+    QUEUE.complete(notification['id'], WORKER_ID)
+    print(f"Notification {notification['id']}: sent")
 
 def run_notification_service(interval=60):
-    """Run notification service continuously"""
+    """Run notification service continuously.
+
+    New notifications wake the service immediately; interval is only the
+    fallback poll (for expired leases, or wakeups missed while it was down).
+    """
     print("WhatsApp Notification Service started")
-    print(f"Checking for notifications every {interval} seconds")
+    if NOTIFY_METRICS_PORT:
+        try:
+            metrics.serve(NOTIFY_METRICS_PORT)
+            print(f"Metrics on http://127.0.0.1:{NOTIFY_METRICS_PORT}/metrics")
+        except OSError as e:
+            print(f"Metrics port unavailable ({e})")
+    try:
+        QUEUE.listen()
+        print(f"Waiting for wakeups on udp://127.0.0.1:{QUEUE.wake_port}, "
+              f"polling every {interval} seconds")
+    except OSError as e:
+        print(f"Wakeup socket unavailable ({e}); checking every {interval} seconds")
+    
+    try:
+        REMINDERS.rebuild()
+        print(f"Scheduled reminders: {REMINDERS.stats()['pending']}")
+    except Exception as e:
+        print(f"Error loading appointments for reminders: {e}")
     
+    last_archive = 0
     while True:
+        timeout = interval
         try:
-            process_notifications()
+            queued = fire_reminders()
+            if queued:
+                print(f"Queued {queued} reminders")
+            sending = process_notifications()
+            if time.time() - last_archive >= interval:
+                archived = QUEUE.archive()
+                if archived:
+                    print(f"Archived {archived} finished notifications")
+                last_archive = time.time()
+            # Wake up in time for the next scheduled retry (if anything can be
+            # sent) or reminder
+            for due in (QUEUE.next_due() if sending else None, REMINDERS.next_due()):
+                if due is not None:
+                    timeout = min(timeout, max(due - time.time(), 0.05))
         except Exception as e:
             print(f"Error processing notifications: {e}")
         
-        time.sleep(interval)
+        QUEUE.wait(timeout)
 
 if __name__ == '__main__':
-    run_notification_service()
+    if sys.argv[1:] == ['requeue-dead']:
+        print(f"Requeued {QUEUE.requeue_dead()} dead notifications")
+    else:
+        run_notification_service()
@@ -274,6 +274,17 @@ export default function SettingsPage() {
           />
         </div>
 
+        <div className="form-group">
+          <label className="form-label">WhatsApp API URL</label>
+          <input
+            type="url"
+            className="form-input"
+            value={settings?.whatsapp?.api_url || ''}
+            onChange={(e) => handleWhatsAppUpdate('api_url', e.target.value)}
+            placeholder="https://api.provider.example/v1/messages"
+          />
+        </div>
+
         <div className="form-group">
           <label className="form-label">WhatsApp Phone Number</label>
           <input
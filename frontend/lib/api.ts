@@ -86,6 +86,11 @@ class ApiClient {
     return this.request<any[]>('/api/patients');
   }
 
+  async searchPatients(query: string, limit = 20) {
+    const params = new URLSearchParams({ q: query, limit: String(limit) });
+    return this.request<any[]>(`/api/patients/search?${params}`);
+  }
+
   async getPatient(id: string) {
     return this.request<any>(`/api/patients/${id}`);
   }
@@ -115,6 +120,12 @@ class ApiClient {
     return this.request<any[]>('/api/appointments');
   }
 
+  async getAvailability(doctorId: string, date: string, duration?: number) {
+    const params = new URLSearchParams({ doctor_id: doctorId, date });
+    if (duration) params.set('duration', String(duration));
+    return this.request<any>(`/api/appointments/availability?${params}`);
+  }
+
   async createAppointment(data: any) {
     return this.request<any>('/api/appointments', {
       method: 'POST',
@@ -173,11 +184,26 @@ class ApiClient {
     });
   }
 
+  async getLowStock() {
+    return this.request<any[]>('/api/pharmacy/low-stock');
+  }
+
+  async getExpiring(days = 30) {
+    return this.request<any[]>(`/api/pharmacy/expiring?days=${days}`);
+  }
+
   // Prescriptions
   async getPrescriptions() {
     return this.request<any[]>('/api/prescriptions');
   }
 
+  async dispensePrescription(id: string) {
+    return this.request<any>(`/api/prescriptions/${id}/dispense`, {
+      method: 'POST',
+      body: {},
+    });
+  }
+
   async createPrescription(data: any) {
     return this.request<any>('/api/prescriptions', {
       method: 'POST',